@@ -0,0 +1,36 @@
+import asyncio
+from functools import partial
+from config import config
+import metrics
+from router import HTTPError
+
+# Runs the independent backend calls of a request concurrently. The calls keep using the
+# shared synchronous clients (and their metrics hooks), each one runs on this pool and is
+# awaited with a timeout, so a request waits about as long as its slowest call instead of
+# the sum of them
+
+# Separate from the fan-out pool, calls made here may themselves wait on fan-out batches
+executor = metrics.Executor(max_workers=config.ASYNC_MAX_WORKERS)
+
+# One event loop per container, reused across warm invocations
+loop = None
+
+def run(coroutine):
+    global loop
+    if loop is None:
+        loop = asyncio.new_event_loop()
+        loop.set_default_executor(executor)
+    return loop.run_until_complete(coroutine)
+
+async def call(function, *args, timeout_ms=None, **kwargs):
+    timeout_ms = timeout_ms or config.BACKEND_CALL_TIMEOUT_MS
+    future = asyncio.get_running_loop().run_in_executor(executor, partial(function, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout_ms / 1000)
+    except asyncio.TimeoutError:
+        # The thread can't be interrupted, it finishes the call in the background and the result is dropped
+        raise HTTPError(504, f"{function.__name__} timed out after {timeout_ms} ms")
+
+async def gather(*calls):
+    # (function, *args) tuples run concurrently, results in the same order
+    return await asyncio.gather(*(call(*entry) for entry in calls))
@@ -0,0 +1,216 @@
+import gzip
+import json
+import logging
+import os
+from datetime import datetime, timezone
+from functools import partial
+from itertools import chain
+from config import config
+from clients import Key, LazyClient, get_s3
+from collections import OrderedDict
+from threading import Lock
+from crud import (
+    messages_table, group_timeline_table, get_conversation_id, get_timeline_group, get_archive_owner,
+    create_manifest_entries, get_manifest_entries, record_archive_day
+)
+from fanout import BATCH_WRITE_SIZE, batch_write, chunked, executor
+from segments import decode_block
+import metrics
+
+logger = logging.getLogger()
+
+s3 = LazyClient(get_s3)
+
+# S3 rejects multipart parts under 5 MiB, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# Recently read archive chunks, shared across warm invocations and bounded by ARCHIVE_CACHE_BYTES
+chunk_cache = OrderedDict()
+chunk_cache_bytes = 0
+chunk_cache_lock = Lock()
+
+def get_chat_table(chat_id):
+    # (table, partition key, its value) holding a conversation's messages. Large group timelines
+    # are stored once per group in group_timeline
+    group_id = get_timeline_group(chat_id)
+    if group_id is not None:
+        return group_timeline_table, 'group_id', group_id
+    return messages_table, 'chat_id', chat_id
+
+def iter_chat_pages(chat_id, max_messages=None, after=None, upto=None, keys_only=False):
+    # Oldest first, one DynamoDB page at a time, so callers never hold more than a page. Every
+    # message carries chat_id, the archive and compaction group by it
+    table, partition_key, partition = get_chat_table(chat_id)
+    key_condition = Key(partition_key).eq(partition)
+    if after and upto:
+        key_condition = key_condition & Key('sort_key').between(after, upto)
+    elif after:
+        key_condition = key_condition & Key('sort_key').gt(after)
+    elif upto:
+        key_condition = key_condition & Key('sort_key').lte(upto)
+    query_kwargs = {'KeyConditionExpression': key_condition}
+    if keys_only:
+        query_kwargs['ProjectionExpression'] = f"{partition_key}, sort_key"
+    remaining = max_messages
+    while remaining is None or remaining > 0:
+        query_kwargs['Limit'] = config.ARCHIVE_PAGE_SIZE if remaining is None else min(config.ARCHIVE_PAGE_SIZE, remaining)
+        response = table.query(**query_kwargs)
+        items = [dict(item, chat_id=chat_id) for item in response['Items'] if item['sort_key'] != after]
+        if items:
+            yield items
+        if remaining is not None:
+            remaining -= len(items)
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def encode_page(messages):
+    lines = "".join(json.dumps(message, default=str, separators=(',', ':')) + "\n" for message in messages)
+    # Every page is its own gzip member, their concatenation is still one valid gzip stream
+    return gzip.compress(lines.encode())
+
+def get_archive_key(user_id, chat_id, now=None):
+    # One object per archive run, a chat archived twice within the hour must not overwrite
+    # the object its earlier manifest entries point into
+    now = now or datetime.now(timezone.utc)
+    return f"{user_id}/{now.year}/{now.timetuple().tm_yday}/{now.hour}/{chat_id}/{now:%H%M%S%f}.ndjson.gz"
+
+def upload_pages(key, pages):
+    # Streams pages of messages into one multipart upload of gzip compressed NDJSON.
+    # Nothing is written when there are no pages
+    pages = iter(pages)
+    first_page = next(pages, None)
+    # Each page is an independently decompressible chunk at a known byte range of the object
+    archive = {'key': key, 'count': 0, 'last_sort_key': None, 'chunks': []}
+    if first_page is None:
+        return archive
+    bucket = os.environ['S3_BUCKET_NAME']
+    part_size = max(config.ARCHIVE_PART_SIZE, MIN_PART_SIZE)
+    upload_id = s3.create_multipart_upload(
+        Bucket=bucket,
+        Key=key,
+        ContentType='application/x-ndjson',
+        ContentEncoding='gzip'
+    )['UploadId']
+    parts = []
+    buffer = bytearray()
+    offset = 0
+
+    def upload_part():
+        part_number = len(parts) + 1
+        response = s3.upload_part(Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=part_number, Body=bytes(buffer))
+        parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        buffer.clear()
+
+    try:
+        for page in chain([first_page], pages):
+            chunk = encode_page(page)
+            buffer += chunk
+            archive['chunks'].append({
+                'start_sort_key': page[0]['sort_key'],
+                'end_sort_key': page[-1]['sort_key'],
+                'offset': offset,
+                'length': len(chunk),
+                'count': len(page)
+            })
+            offset += len(chunk)
+            archive['count'] += len(page)
+            archive['last_sort_key'] = page[-1]['sort_key']
+            if len(buffer) >= part_size:
+                upload_part()
+        if buffer:
+            upload_part()
+        s3.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+    return archive
+
+def save_to_s3(user_id, chat_id, pages, now=None):
+    return upload_pages(get_archive_key(user_id, chat_id, now), pages)
+
+def delete_archived_messages(chat_id, upto):
+    table, partition_key, partition = get_chat_table(chat_id)
+    deleted = 0
+    for page in iter_chat_pages(chat_id, upto=upto, keys_only=True):
+        requests = [
+            {'DeleteRequest': {'Key': {partition_key: partition, 'sort_key': message['sort_key']}}}
+            for message in page
+        ]
+        failed = sum(map(len, executor.map(partial(batch_write, table.name), chunked(requests, BATCH_WRITE_SIZE))))
+        if failed:
+            raise RuntimeError(f"Failed to delete {failed} archived messages of {chat_id}")
+        deleted += len(page)
+    return deleted
+
+def archive_messages(conversation_id, pages):
+    # Moves the given pages of one conversation to S3, deleting them only once the upload completed
+    user_id, chat_id = get_archive_owner(conversation_id)
+    now = datetime.now(timezone.utc)
+    archive = save_to_s3(user_id, chat_id, pages, now)
+    if not archive['count']:
+        return 0
+    # Compaction finds the user/day prefixes to compact through this record
+    record_archive_day(user_id, now.year, now.timetuple().tm_yday)
+    create_manifest_entries(
+        dict(chunk, chat_id=conversation_id, s3_key=archive['key'])
+        for chunk in archive['chunks']
+    )
+    deleted = delete_archived_messages(conversation_id, archive['last_sort_key'])
+    logger.info("Archived %d messages of %s to %s", deleted, conversation_id, archive['key'])
+    return deleted
+
+def backup_and_delete_old_messages(user_id: str, chat_id: str, message_count: int):
+    # Archive everything but the last Y messages, returns how many were moved out of the DB.
+    # The kept Y messages are a wide margin, so no late write can land inside the archived range.
+    archive_count = message_count - config.DB_LAST_Y_MESSAGES
+    if archive_count <= 0:
+        return 0
+    conversation_id = get_conversation_id(user_id, chat_id)
+    return archive_messages(conversation_id, iter_chat_pages(conversation_id, max_messages=archive_count))
+
+def archive_messages_before(conversation_id: str, upto: str):
+    # Any conversation, direct, group copy or timeline
+    return archive_messages(conversation_id, iter_chat_pages(conversation_id, upto=upto))
+
+def decode_chunk(data):
+    return [json.loads(line) for line in gzip.decompress(data).decode().splitlines() if line]
+
+def read_archive_chunk(entry):
+    global chunk_cache_bytes
+    cache_key = (entry['s3_key'], int(entry['offset']))
+    with chunk_cache_lock:
+        if cache_key in chunk_cache:
+            chunk_cache.move_to_end(cache_key)
+            return chunk_cache[cache_key][0]
+    start = int(entry['offset'])
+    end = start + int(entry['length']) - 1
+    response = s3.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=entry['s3_key'], Range=f"bytes={start}-{end}")
+    data = response['Body'].read()
+    # Compacted chunks are blocks of a segment file, the rest are gzip members of an hourly object
+    messages = decode_block(data) if entry.get('format') == 'segment' else decode_chunk(data)
+    with chunk_cache_lock:
+        if cache_key not in chunk_cache:
+            # Compressed size is a stable proxy for the chunk's weight
+            chunk_cache[cache_key] = (messages, len(data))
+            chunk_cache_bytes += len(data)
+        while chunk_cache_bytes > config.ARCHIVE_CACHE_BYTES and len(chunk_cache) > 1:
+            _, (_, size) = chunk_cache.popitem(last=False)
+            chunk_cache_bytes -= size
+    return messages
+
+def get_archived_messages(chat_id, limit, before=None):
+    # Up to `limit` archived messages of a conversation older than `before`, oldest first.
+    # Usually one manifest query and one ranged GET
+    messages = []
+    for entry in get_manifest_entries(chat_id, before):
+        chunk = [message for message in read_archive_chunk(entry) if not before or message['sort_key'] < before]
+        messages = chunk + messages
+        if len(messages) >= limit:
+            break
+    return messages[-limit:]
+
+metrics.instrument_functions(globals(), "archive", [
+    'save_to_s3', 'delete_archived_messages', 'backup_and_delete_old_messages', 'archive_messages_before',
+    'read_archive_chunk', 'get_archived_messages'
+])
@@ -1,37 +1,122 @@
+import startup
 import json
-import boto3
-import os
-from datetime import datetime, timedelta
-from crud import *
-from models import *
-
-s3 = boto3.client('s3')
-
-# Configurable parameters
-DB_RETENTION_HOURS = int(os.getenv('DB_RETENTION_HOURS', 24))
-S3_RETENTION_DAYS = int(os.getenv('S3_RETENTION_DAYS', 365))
-
-def save_to_s3(user_id, chat_id, messages):
-    now = datetime.now(timezone.utc)
-    year = now.year
-    day_of_year = now.timetuple().tm_yday
-    hour = now.hour
-    key = f"{user_id}/{year}/{day_of_year}/{hour}/{chat_id}.json"
-    s3.put_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=key, Body=json.dumps(messages))
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
+from config import config
+from crud import get_dirty_chats, mark_chat_backed_up, record_archived_messages
+from archive import iter_chat_pages, upload_pages, archive_messages_before
+from cache import get_archive_lock, acquire_lock, release_lock
+from sync import shift
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+startup.mark("imports")
+
+def get_backup_key(chat_id, now=None):
+    now = now or datetime.now(timezone.utc)
+    return f"backups/{chat_id}/{now.year}/{now.timetuple().tm_yday}/{now:%H%M%S%f}.ndjson.gz"
+
+def iter_dirty_chats():
+    for shard in range(config.BACKUP_DIRTY_SHARDS):
+        yield from get_dirty_chats(shard)
+
+def backup_chat(metadata):
+    # Exports the messages after the chat's watermark, the watermark is the checkpoint a timed
+    # out run resumes from. Chats with a bigger backlog stay dirty and continue next run. A message
+    # can land late with an older sort key (write-behind queues, concurrent senders), so like
+    # sync.get_updates the export re-reads BACKUP_OVERLAP_MS before the watermark and skips the
+    # sort keys it already exported there, up to BACKUP_MAX_SEEN
+    chat_id = metadata['chat_id']
+    watermark = metadata.get('backup_watermark')
+    seen = set(metadata.get('backup_seen', []))
+    start = shift(watermark.split('#', 1)[0], -config.BACKUP_OVERLAP_MS) if watermark else None
+    budget = config.BACKUP_MAX_MESSAGES_PER_CHAT + len(seen)
+    exported = []
+    read = 0
+
+    def iter_new_pages():
+        nonlocal read
+        for page in iter_chat_pages(chat_id, max_messages=budget, after=start):
+            read += len(page)
+            page = [message for message in page if message['sort_key'] not in seen]
+            if page:
+                exported.extend(message['sort_key'] for message in page)
+                yield page
+
+    backup = upload_pages(get_backup_key(chat_id), iter_new_pages())
+    delivered = sorted(seen.union(exported))
+    if delivered:
+        watermark = max(filter(None, [watermark, delivered[-1]]))
+    if watermark:
+        # Sort keys start with the timestamp
+        floor = shift(watermark.split('#', 1)[0], -config.BACKUP_OVERLAP_MS)
+        kept = [sort_key for sort_key in delivered if sort_key >= floor][-config.BACKUP_MAX_SEEN:]
+        # A backlog past the budget keeps the chat dirty
+        mark_chat_backed_up(chat_id, watermark, kept, metadata.get('message_count', 0) if read < budget else None)
+
+    # Backed up messages older than the retention window leave the DB through the archive
+    archived = 0
+    if config.DB_RETENTION_HOURS > 0 and watermark:
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=config.DB_RETENTION_HOURS)).isoformat()
+        # A send archiving the chat over DB_LIMIT holds the same lock and is already moving the
+        # oldest messages out, anything it leaves goes with the chat's next backup
+        lock = get_archive_lock(chat_id)
+        if acquire_lock(lock, config.ARCHIVE_LOCK_TTL):
+            try:
+                archived = archive_messages_before(chat_id, min(cutoff, watermark))
+                if archived:
+                    record_archived_messages(chat_id, archived)
+            finally:
+                release_lock(lock)
+        else:
+            logger.info("Chat %s is being archived, retention archive skipped", chat_id)
+    return backup['count'], archived
 
 def lambda_handler(event, context):
-    users = get_all_users()
+    try:
+        return run_backup(context)
+    finally:
+        if not startup.reported:
+            startup.mark("first_request")
+            startup.report()
+
+def run_backup(context):
+    stats = {"chats": 0, "messages": 0, "archived": 0, "failed": 0, "stopped_early": False}
+
+    def time_left():
+        if context and hasattr(context, 'get_remaining_time_in_millis'):
+            return context.get_remaining_time_in_millis() > config.BACKUP_TIME_MARGIN_MS
+        return True
 
-    for user in users:
-        user_id = user.id
-        chats = get_user_chats(user_id)
-        for chat_id, messages in chats.items():
-            save_to_s3(user_id, chat_id, messages)
+    def collect(done):
+        for future in done:
+            try:
+                exported, archived = future.result()
+                stats["chats"] += 1
+                stats["messages"] += exported
+                stats["archived"] += archived
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error("Backup of %s failed: %s", in_flight[future], e)
+            del in_flight[future]
 
-    # Delete old messages
-    delete_old_messages(DB_RETENTION_HOURS)
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=config.BACKUP_MAX_WORKERS) as pool:
+        for metadata in iter_dirty_chats():
+            if not time_left():
+                # Unvisited chats keep their dirty flag and are picked up by the next run
+                stats["stopped_early"] = True
+                break
+            if len(in_flight) >= config.BACKUP_MAX_WORKERS:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+            in_flight[pool.submit(backup_chat, metadata)] = metadata['chat_id']
+        done, _ = wait(in_flight)
+        collect(done)
 
+    logger.info("Backup finished: %s", stats)
     return {
         "statusCode": 200,
-        "body": json.dumps({"message": "Backup and cleanup completed."})
-    }
\ No newline at end of file
+        "body": json.dumps({"message": "Backup and cleanup completed.", "stats": stats})
+    }
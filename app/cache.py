@@ -0,0 +1,414 @@
+import json
+import logging
+import time
+from collections import Counter, OrderedDict, defaultdict
+from threading import Lock
+from config import config
+import clients
+from clients import LazyClient, get_redis
+from storage import get_existing_user_ids, get_group, get_group_members, get_block, get_blocked_ids, get_conversation_id, get_chat_messages, encode_cursor, decode_cursor, get_archived_messages
+import metrics
+
+logger = logging.getLogger()
+
+redis_client = LazyClient(get_redis)
+
+# Per-container chat cache counters:
+#   hit         - served from the recent-messages list
+#   miss_cold   - chat not cached, read from DB and repopulated
+#   miss_window - chat cached but the page is older than the cached window
+#   bypass      - page larger than CACHE_LAST_X_MESSAGES
+# A high miss_window share means CACHE_LAST_X_MESSAGES is too small for how far clients scroll.
+cache_stats = Counter()
+
+# Messages of write-behind sends not in the DB yet, by cache key. Seeding a recent-messages
+# list from the DB adds them back, so a reseed never drops a message the sender already saw
+pending_messages = defaultdict(dict)
+pending_lock = Lock()
+
+# User ids known to exist, shared across warm invocations and bounded by USER_CACHE_SIZE.
+# Only existing users are cached: users are never deleted, so an entry can't go stale, the
+# TTL just lets a container pick up out-of-band cleanups eventually
+known_users = OrderedDict()
+known_users_lock = Lock()
+
+# Redis set of every user id seen to exist, shared by all containers
+KNOWN_USERS_KEY = "users:known"
+
+# Marks a blocklist set as loaded, so users who block nobody still get a cache hit
+BLOCKLIST_LOADED = ""
+
+# Marks a group membership set as loaded, and so the group as existing
+GROUP_LOADED = ""
+
+# Member ids of recently used groups, shared across warm invocations. Kept only for
+# GROUP_LOCAL_CACHE_TTL seconds, since other containers' membership writes don't reach it
+group_members_cache = OrderedDict()
+group_members_lock = Lock()
+
+def get_cache_key(user_id, chat_id):
+    return f"chat:{get_conversation_id(user_id, chat_id)}"
+
+def append_recent_message(cache_key, message):
+    # One round trip: append, keep the last X, refresh the TTL. RPUSHX only appends to
+    # a list that is already cached, so a miss never leaves a partial window behind
+    pipe = redis_client.pipeline(transaction=True)
+    pipe.rpushx(cache_key, json.dumps(message, default=str))
+    pipe.ltrim(cache_key, -config.CACHE_LAST_X_MESSAGES, -1)
+    pipe.expire(cache_key, config.CHAT_CACHE_TTL)
+    length, _, _ = pipe.execute()
+    metrics.incr("recent_messages.hit" if length > 0 else "recent_messages.miss")
+    return length > 0
+
+def append_recent_messages(messages_by_key):
+    # append_recent_message for many conversations in one round trip, returns the keys that
+    # were not cached (and so got nothing appended)
+    pipe = redis_client.pipeline(transaction=False)
+    for cache_key, messages in messages_by_key.items():
+        pipe.rpushx(cache_key, *[json.dumps(message, default=str) for message in messages])
+        pipe.ltrim(cache_key, -config.CACHE_LAST_X_MESSAGES, -1)
+        pipe.expire(cache_key, config.CHAT_CACHE_TTL)
+    lengths = pipe.execute()[::3]
+    missed = [cache_key for cache_key, length in zip(messages_by_key, lengths) if not length]
+    metrics.incr("recent_messages.hit", len(messages_by_key) - len(missed))
+    metrics.incr("recent_messages.miss", len(missed))
+    return missed
+
+def seed_recent_messages(cache_key, messages):
+    # Merges into the list rather than replacing it: two first sends to an uncached chat both
+    # seed, each with its own message, and neither may drop the other's
+    with pending_lock:
+        pending = list(pending_messages.get(cache_key, {}).values())
+    seeded = [json.dumps(message, default=str) for message in messages + pending]
+
+    def merge(pipe):
+        # WATCH retries this when the list changed since it was read, a send appending included
+        merged = {}
+        for value in pipe.lrange(cache_key, 0, -1) + seeded:
+            message = json.loads(value)
+            merged.setdefault(message['message_id'], (message['sort_key'], value))
+        values = [value for _, value in sorted(merged.values())][-config.CACHE_LAST_X_MESSAGES:]
+        pipe.multi()
+        pipe.delete(cache_key)
+        if values:
+            pipe.rpush(cache_key, *values)
+            pipe.expire(cache_key, config.CHAT_CACHE_TTL)
+
+    redis_client.transaction(merge, cache_key)
+
+def add_pending_message(cache_key, message):
+    with pending_lock:
+        pending_messages[cache_key][message['message_id']] = message
+
+def discard_pending_messages(cache_key, messages):
+    with pending_lock:
+        pending = pending_messages.get(cache_key)
+        if pending is None:
+            return
+        for message in messages:
+            pending.pop(message['message_id'], None)
+        if not pending:
+            del pending_messages[cache_key]
+
+def get_recent_messages(cache_key, start=0, end=-1):
+    # Oldest first, same indexing as LRANGE (negative indexes count from the newest)
+    return [json.loads(message) for message in redis_client.lrange(cache_key, start, end)]
+
+def get_chat_history(user_id, chat_id, limit=None, cursor=None):
+    # Newest first, one page of a single conversation with a cursor for the next (older) page
+    limit = min(limit or config.MESSAGES_PAGE_SIZE, config.MESSAGES_MAX_PAGE_SIZE)
+    before = decode_cursor(cursor).get('before') if cursor else None
+    if cursor and not isinstance(before, str):
+        raise ValueError("Invalid cursor")
+    cache_key = get_cache_key(user_id, chat_id)
+    conversation_id = get_conversation_id(user_id, chat_id)
+
+    if limit > config.CACHE_LAST_X_MESSAGES:
+        outcome = "bypass"
+        messages = get_chat_messages(conversation_id, limit, before)
+    else:
+        cached = get_recent_messages(cache_key)
+        # A list shorter than X holds the whole conversation, older pages are simply empty
+        complete = 0 < len(cached) < config.CACHE_LAST_X_MESSAGES
+        window = [message for message in cached if not before or message['sort_key'] < before][-limit:]
+        if cached and (len(window) == limit or complete):
+            outcome = "hit"
+            messages = window
+        elif cached:
+            outcome = "miss_window"
+            messages = get_chat_messages(conversation_id, limit, before)
+        else:
+            outcome = "miss_cold"
+            recent_messages = get_chat_messages(conversation_id, config.CACHE_LAST_X_MESSAGES)
+            seed_recent_messages(cache_key, recent_messages)
+            if before:
+                messages = get_chat_messages(conversation_id, limit, before)
+            else:
+                messages = recent_messages[-limit:]
+
+    # Past the DB window, continue into the archived history
+    if len(messages) < limit:
+        oldest = messages[0]['sort_key'] if messages else before
+        messages = get_archived_messages(conversation_id, limit - len(messages), oldest) + messages
+
+    cache_stats[outcome] += 1
+    metrics.incr(f"chat_cache.{outcome}")
+    logger.info("Chat cache %s: %s", outcome, dict(cache_stats))
+    messages.reverse()
+    next_cursor = encode_cursor({'before': messages[-1]['sort_key']}) if len(messages) == limit else None
+    return messages, next_cursor
+
+def get_archive_lock(conversation_id):
+    # Held while a conversation is archived, by sends over DB_LIMIT and by the hourly retention archive
+    return f"archive:chat:{conversation_id}"
+
+def acquire_lock(name, ttl):
+    return bool(redis_client.set(f"lock:{name}", "1", nx=True, ex=ttl))
+
+def release_lock(name):
+    redis_client.delete(f"lock:{name}")
+
+def remember_users(user_ids, write_through=True):
+    expires = time.monotonic() + config.USER_CACHE_TTL
+    with known_users_lock:
+        for user_id in user_ids:
+            known_users[user_id] = expires
+            known_users.move_to_end(user_id)
+        while len(known_users) > config.USER_CACHE_SIZE:
+            known_users.popitem(last=False)
+    if write_through and user_ids:
+        try:
+            redis_client.sadd(KNOWN_USERS_KEY, *user_ids)
+        except clients.RedisError as e:
+            logger.warning("Failed to record known users: %s", e)
+
+def get_missing_users(user_ids):
+    # The ids in user_ids that are not users. Served from the container's LRU, then the Redis
+    # set, and only what neither knows goes to the DB, in one keys-only batch read
+    user_ids = list(dict.fromkeys(user_ids))
+    now = time.monotonic()
+    pending = []
+    with known_users_lock:
+        for user_id in user_ids:
+            if known_users.get(user_id, 0) > now:
+                known_users.move_to_end(user_id)
+            else:
+                pending.append(user_id)
+    metrics.incr("users.local_hit", len(user_ids) - len(pending))
+    if not pending:
+        return set()
+
+    try:
+        members = redis_client.smismember(KNOWN_USERS_KEY, pending)
+        known = [user_id for user_id, member in zip(pending, members) if member]
+        remember_users(known, write_through=False)
+        metrics.incr("users.redis_hit", len(known))
+        pending = [user_id for user_id, member in zip(pending, members) if not member]
+    except clients.RedisError as e:
+        logger.warning("Known users cache unavailable, reading users from DB: %s", e)
+    if not pending:
+        return set()
+
+    existing = get_existing_user_ids(pending)
+    metrics.incr("users.db", len(pending))
+    remember_users(list(existing))
+    return set(pending) - existing
+
+def get_blocklist_key(user_id):
+    return f"{user_id}:blocklist"
+
+def is_blocked(sender_id, receiver_id):
+    key = get_blocklist_key(receiver_id)
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.exists(key)
+        pipe.sismember(key, sender_id)
+        pipe.get(get_version_key(key))
+        loaded, blocked, version = pipe.execute()
+        if loaded:
+            metrics.incr("blocklist.hit")
+            return bool(blocked)
+        metrics.incr("blocklist.miss")
+
+        # Miss: load the receiver's whole blocklist once and serve later sends from Redis.
+        # A block written meanwhile bumps the version and the load is dropped
+        blocked_ids = get_blocked_ids(receiver_id)
+        load_sets({key: (version, [BLOCKLIST_LOADED, *blocked_ids])}, config.BLOCKLIST_CACHE_TTL)
+        return sender_id in blocked_ids
+    except clients.RedisError as e:
+        logger.warning("Blocklist cache unavailable, reading block from DB: %s", e)
+        return get_block(sender_id, receiver_id) is not None
+
+def get_blocked_pairs(pairs):
+    # The (sender_id, receiver_id) pairs where the receiver blocked the sender. One round trip
+    # for the loaded blocklists, then one DB read per receiver whose blocklist isn't cached
+    pairs = list(dict.fromkeys(pairs))
+    receivers = list(dict.fromkeys(receiver_id for _, receiver_id in pairs))
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for receiver_id in receivers:
+            pipe.exists(get_blocklist_key(receiver_id))
+        for receiver_id in receivers:
+            pipe.get(get_version_key(get_blocklist_key(receiver_id)))
+        for sender_id, receiver_id in pairs:
+            pipe.sismember(get_blocklist_key(receiver_id), sender_id)
+        results = pipe.execute()
+        loaded = {receiver_id for receiver_id, exists in zip(receivers, results) if exists}
+        versions = dict(zip(receivers, results[len(receivers):2 * len(receivers)]))
+        blocked = {pair for pair, member in zip(pairs, results[2 * len(receivers):]) if member and pair[1] in loaded}
+        metrics.incr("blocklist.hit", len(loaded))
+        metrics.incr("blocklist.miss", len(receivers) - len(loaded))
+
+        missing = [receiver_id for receiver_id in receivers if receiver_id not in loaded]
+        if missing:
+            blocked_ids = {receiver_id: get_blocked_ids(receiver_id) for receiver_id in missing}
+            load_sets({
+                get_blocklist_key(receiver_id): (versions[receiver_id], [BLOCKLIST_LOADED, *ids])
+                for receiver_id, ids in blocked_ids.items()
+            }, config.BLOCKLIST_CACHE_TTL)
+            blocked.update(pair for pair in pairs if pair[1] in blocked_ids and pair[0] in blocked_ids[pair[1]])
+        return blocked
+    except clients.RedisError as e:
+        logger.warning("Blocklist cache unavailable, reading blocks from DB: %s", e)
+        return {pair for pair in pairs if get_block(*pair) is not None}
+
+def invalidate_blocklist(blocker_id):
+    # After the block is written. Bumping the version makes a load that read the DB before it drop its set
+    key = get_blocklist_key(blocker_id)
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        bump_version(pipe, key, config.BLOCKLIST_CACHE_TTL)
+        pipe.delete(key)
+        pipe.execute()
+    except clients.RedisError as e:
+        logger.warning("Failed to invalidate blocklist of %s: %s", blocker_id, e)
+
+def get_version_key(key):
+    # Bumped by every DB write the cached set at key reflects
+    return f"{key}:version"
+
+def load_sets(snapshots, ttl):
+    # Cache-aside load of sets read from the DB, {key: (version read before the DB read, members)}.
+    # A writer bumping a version in between may be missing from its snapshot, so that set is
+    # dropped again and the next read loads it afresh; a writer bumping it later updates the
+    # loaded set itself
+    pipe = redis_client.pipeline(transaction=True)
+    for key, (_, members) in snapshots.items():
+        pipe.delete(key)
+        pipe.sadd(key, *members)
+        pipe.expire(key, ttl)
+        pipe.get(get_version_key(key))
+    results = pipe.execute()
+    raced = [key for key, version in zip(snapshots, results[3::4]) if version != snapshots[key][0]]
+    if raced:
+        redis_client.delete(*raced)
+        metrics.incr("cache.load_raced", len(raced))
+
+def bump_version(pipe, key, ttl):
+    # Queued in the writer's pipeline, after its DB write committed
+    pipe.incr(get_version_key(key))
+    pipe.expire(get_version_key(key), ttl)
+
+def get_group_members_key(group_id):
+    return f"group:{group_id}:members"
+
+def cache_group_members_locally(group_id, member_ids):
+    with group_members_lock:
+        group_members_cache[group_id] = (time.monotonic() + config.GROUP_LOCAL_CACHE_TTL, member_ids)
+        group_members_cache.move_to_end(group_id)
+        while len(group_members_cache) > config.GROUP_LOCAL_CACHE_SIZE:
+            group_members_cache.popitem(last=False)
+
+def get_group_member_ids(group_id):
+    # The member ids of a group, None when there is no such group. From the container's cache,
+    # else the Redis set read in GROUP_MEMBERS_SCAN_COUNT chunks (one round trip for most
+    # groups), else the DB, which then loads the set
+    with group_members_lock:
+        entry = group_members_cache.get(group_id)
+        if entry and entry[0] > time.monotonic():
+            group_members_cache.move_to_end(group_id)
+            metrics.incr("group_members.local_hit")
+            return entry[1]
+
+    key = get_group_members_key(group_id)
+    version = None
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.sismember(key, GROUP_LOADED)
+        pipe.sscan(key, 0, count=config.GROUP_MEMBERS_SCAN_COUNT)
+        pipe.get(get_version_key(key))
+        loaded, (cursor, chunk), version = pipe.execute()
+        if loaded:
+            member_ids = set(chunk)
+            while cursor:
+                cursor, chunk = redis_client.sscan(key, cursor, count=config.GROUP_MEMBERS_SCAN_COUNT)
+                member_ids.update(chunk)
+            member_ids.discard(GROUP_LOADED)
+            metrics.incr("group_members.hit")
+            member_ids = frozenset(member_ids)
+            cache_group_members_locally(group_id, member_ids)
+            return member_ids
+        metrics.incr("group_members.miss")
+    except clients.RedisError as e:
+        logger.warning("Group members cache unavailable, reading members from DB: %s", e)
+
+    if not get_group(group_id):
+        return None
+    member_ids = frozenset(member['user_id'] for member in get_group_members(group_id))
+    try:
+        load_sets({key: (version, [GROUP_LOADED, *member_ids])}, config.GROUP_CACHE_TTL)
+    except clients.RedisError as e:
+        logger.warning("Failed to cache members of group %s: %s", group_id, e)
+    cache_group_members_locally(group_id, member_ids)
+    return member_ids
+
+def group_exists(group_id):
+    # Without reading the members: the container's cache, the loaded marker, else the group item
+    with group_members_lock:
+        entry = group_members_cache.get(group_id)
+        if entry and entry[0] > time.monotonic():
+            return True
+    try:
+        if redis_client.sismember(get_group_members_key(group_id), GROUP_LOADED):
+            return True
+    except clients.RedisError as e:
+        logger.warning("Group members cache unavailable, reading group from DB: %s", e)
+    return get_group(group_id) is not None
+
+def set_group_members(group_id, member_ids):
+    # For a group created just now, nobody else writes its membership yet
+    key = get_group_members_key(group_id)
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        pipe.delete(key)
+        pipe.sadd(key, GROUP_LOADED, *member_ids)
+        pipe.expire(key, config.GROUP_CACHE_TTL)
+        pipe.execute()
+    except clients.RedisError as e:
+        logger.warning("Failed to cache members of group %s: %s", group_id, e)
+    cache_group_members_locally(group_id, frozenset(member_ids))
+
+def update_group_members(group_id, added=(), removed=()):
+    # Write-through after a membership write. A set that isn't loaded only gets a partial
+    # set without the loaded marker, which the next read replaces from the DB
+    key = get_group_members_key(group_id)
+    try:
+        pipe = redis_client.pipeline(transaction=True)
+        bump_version(pipe, key, config.GROUP_CACHE_TTL)
+        if added:
+            pipe.sadd(key, *added)
+        if removed:
+            pipe.srem(key, *removed)
+        pipe.expire(key, config.GROUP_CACHE_TTL)
+        pipe.execute()
+    except clients.RedisError as e:
+        # Stale until GROUP_CACHE_TTL, drop it so the next read goes to the DB
+        logger.warning("Failed to update members of group %s: %s", group_id, e)
+        try:
+            redis_client.delete(key)
+        except clients.RedisError:
+            pass
+    with group_members_lock:
+        entry = group_members_cache.get(group_id)
+        if entry:
+            group_members_cache[group_id] = (entry[0], entry[1].union(added).difference(removed))
@@ -0,0 +1,110 @@
+import time
+from threading import RLock
+from config import config
+import startup
+import metrics
+
+# Every AWS and Redis client is built on first use and then shared by the whole container.
+# Nothing here connects or loads botocore service models at import time.
+
+_clients = {}
+# Re-entrant, building a table builds the resource (and the session) inside the same lock
+_lock = RLock()
+
+def _get_or_create(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                start = time.perf_counter()
+                client = factory()
+                startup.record(f"client:{name}", time.perf_counter() - start)
+                _clients[name] = client
+    return client
+
+def get_boto_config():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=config.BOTO_MAX_POOL_CONNECTIONS,
+        connect_timeout=config.BOTO_CONNECT_TIMEOUT,
+        read_timeout=config.BOTO_READ_TIMEOUT,
+        retries={'max_attempts': config.BOTO_MAX_ATTEMPTS, 'mode': 'standard'},
+        tcp_keepalive=True
+    )
+
+def _get_session():
+    import boto3
+    return _get_or_create('session', boto3.session.Session)
+
+def get_dynamodb():
+    def create():
+        resource = _get_session().resource(
+            'dynamodb',
+            endpoint_url=config.DYNAMODB_ENDPOINT_URL,
+            region_name=config.DYNAMODB_REGION,
+            config=get_boto_config()
+        )
+        metrics.instrument_boto(resource.meta.client)
+        return resource
+    return _get_or_create('dynamodb', create)
+
+def get_s3():
+    return _get_or_create('s3', lambda: metrics.instrument_boto(_get_session().client(
+        's3',
+        endpoint_url=config.S3_ENDPOINT_URL,
+        config=get_boto_config()
+    )))
+
+def get_redis():
+    def create():
+        import redis
+        return metrics.redis_class(redis)(
+            host=config.REDIS_HOST,
+            port=config.REDIS_PORT,
+            decode_responses=True,
+            socket_connect_timeout=config.REDIS_CONNECT_TIMEOUT,
+            socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+            socket_keepalive=True,
+            health_check_interval=30
+        )
+    return _get_or_create('redis', create)
+
+def __getattr__(name):
+    # clients.RedisError for except clauses, redis is imported only once one is evaluated
+    if name == 'RedisError':
+        import redis
+        return redis.RedisError
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def Key(name):
+    # boto3.dynamodb.conditions.Key, boto3 is imported on first use rather than with the caller
+    from boto3.dynamodb.conditions import Key
+    return Key(name)
+
+def get_table(name):
+    return _get_or_create(f"table:{name}", lambda: get_dynamodb().Table(name))
+
+def install(name, client):
+    # Replaces a client for the rest of the process, the offline benchmarks put their fakes in this way
+    with _lock:
+        _clients[name] = client
+        if name == 'dynamodb':
+            # Tables are bound to the resource they were built from
+            for key in [key for key in _clients if key.startswith('table:')]:
+                del _clients[key]
+
+class LazyTable:
+    # Stands in for a boto3 Table at module level, the real one is built on first attribute access
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(get_table(self.name), attr)
+
+class LazyClient:
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, attr):
+        return getattr(self._factory(), attr)
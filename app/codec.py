@@ -0,0 +1,31 @@
+import json
+from datetime import datetime
+from decimal import Decimal
+
+# orjson is several times faster than the stdlib for the request and response bodies,
+# the stdlib codec is the fallback where it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def default(value):
+    # DynamoDB returns every number as Decimal
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+if orjson is not None:
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(value):
+        return orjson.dumps(value, default=default).decode()
+else:
+    def loads(data):
+        return json.loads(data)
+
+    def dumps(value):
+        return json.dumps(value, default=default)
@@ -0,0 +1,209 @@
+import argparse
+import json
+import logging
+import os
+import tempfile
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from config import config
+from crud import (
+    get_chat_manifest, create_manifest_entries, delete_manifest_entries, iter_archive_day_users,
+    delete_archive_day, get_conversation_id, get_group_conversation_id, make_sort_key
+)
+from archive import s3, decode_chunk
+from segments import SegmentWriter, SegmentReader, S3Source
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def get_segment_prefix(user_id, year, day):
+    # Outside the user/year/day/ prefix, so compacted output never shows up as archive input
+    return f"segments/{user_id}/{year}/{day}/"
+
+def get_segment_key(user_id, year, day, run, index):
+    # One set of keys per run, a re-run never overwrites segments the manifest points to
+    return f"{get_segment_prefix(user_id, year, day)}{run}-{index:04d}.seg"
+
+def list_objects(prefix):
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=os.environ['S3_BUCKET_NAME'], Prefix=prefix):
+        keys.extend(item['Key'] for item in page.get('Contents', []))
+    return keys
+
+def list_day_objects(user_id, year, day):
+    return list_objects(f"{user_id}/{year}/{day}/")
+
+def read_archive_object(key):
+    data = s3.get_object(Bucket=os.environ['S3_BUCKET_NAME'], Key=key)['Body'].read()
+    if key.endswith('.ndjson.gz'):
+        messages = decode_chunk(data)
+    else:
+        # Hourly objects written before the streaming archiver: one JSON list
+        messages = json.loads(data)
+    for message in messages:
+        if 'chat_id' not in message:
+            if message.get('group_id'):
+                message['chat_id'] = get_group_conversation_id(message['group_id'], message['receiver_id'])
+            else:
+                message['chat_id'] = get_conversation_id(message['sender_id'], message['receiver_id'])
+        if 'sort_key' not in message:
+            message['sort_key'] = make_sort_key(message['timestamp'], message['message_id'])
+    return messages
+
+def read_messages(keys):
+    # The messages of archive objects and segments, a message held by more than one of them once
+    bucket = os.environ['S3_BUCKET_NAME']
+    messages = {}
+    for key in keys:
+        if key.endswith('.seg'):
+            chunk = SegmentReader(S3Source(s3, bucket, key)).iter_messages()
+        else:
+            chunk = read_archive_object(key)
+        for message in chunk:
+            messages[(message['chat_id'], message['sort_key'])] = message
+    return list(messages.values())
+
+def write_segments(user_id, year, day, run, messages_by_chat):
+    # Yields (segment_key, path, blocks) for size bounded segment files in a temp dir
+    index = 0
+    handle = tempfile.NamedTemporaryFile(suffix='.seg', delete=False)
+    writer = SegmentWriter(handle)
+    for chat_id in sorted(messages_by_chat):
+        messages = sorted(messages_by_chat[chat_id], key=lambda message: message['sort_key'])
+        for start in range(0, len(messages), config.SEGMENT_BLOCK_ROWS):
+            writer.write_block(chat_id, messages[start:start + config.SEGMENT_BLOCK_ROWS])
+            if writer.offset >= config.SEGMENT_MAX_BYTES:
+                blocks = writer.close()
+                handle.close()
+                yield get_segment_key(user_id, year, day, run, index), handle.name, blocks
+                index += 1
+                handle = tempfile.NamedTemporaryFile(suffix='.seg', delete=False)
+                writer = SegmentWriter(handle)
+    if writer.blocks:
+        blocks = writer.close()
+        handle.close()
+        yield get_segment_key(user_id, year, day, run, index), handle.name, blocks
+    else:
+        handle.close()
+        os.remove(handle.name)
+
+def canonical(messages):
+    return Counter(json.dumps(message, sort_keys=True, default=str) for message in messages)
+
+def verify_segments(segment_keys, source_keys):
+    # Proves the segments hold exactly the messages of the sources (archive objects or earlier
+    # segments), no more and no fewer
+    bucket = os.environ['S3_BUCKET_NAME']
+    compacted = []
+    for segment_key in segment_keys:
+        compacted.extend(SegmentReader(S3Source(s3, bucket, segment_key)).iter_messages())
+    expected, actual = canonical(read_messages(source_keys)), canonical(compacted)
+    missing = expected - actual
+    unexpected = actual - expected
+    return {
+        "ok": not missing and not unexpected,
+        "messages": sum(expected.values()),
+        "missing": sum(missing.values()),
+        "unexpected": sum(unexpected.values())
+    }
+
+def compact_user_day(user_id, year, day):
+    archive_keys = list_day_objects(user_id, year, day)
+    if not archive_keys:
+        return None
+    # Segments of an earlier run that stopped before deleting all of its archive objects are
+    # merged again, some of their messages may no longer be anywhere else
+    source_keys = archive_keys + list_objects(get_segment_prefix(user_id, year, day))
+    bucket = os.environ['S3_BUCKET_NAME']
+    messages_by_chat = defaultdict(list)
+    for message in read_messages(source_keys):
+        messages_by_chat[message['chat_id']].append(message)
+
+    run = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%f")
+    new_entries = []
+    segment_keys = []
+    for segment_key, path, blocks in write_segments(user_id, year, day, run, messages_by_chat):
+        try:
+            s3.upload_file(path, bucket, segment_key)
+        finally:
+            os.remove(path)
+        segment_keys.append(segment_key)
+        new_entries.extend(dict(block, s3_key=segment_key, format='segment') for block in blocks)
+
+    verification = verify_segments(segment_keys, source_keys)
+    if not verification["ok"]:
+        raise RuntimeError(f"Compacted segments of {user_id}/{year}/{day} do not match the originals: {verification}")
+
+    # Point the manifest at the segments before the sources go away
+    create_manifest_entries(new_entries)
+    replaced = {(entry['chat_id'], entry['start_sort_key']) for entry in new_entries}
+    sources = set(source_keys)
+    stale = [
+        entry for chat_id in messages_by_chat for entry in get_chat_manifest(chat_id)
+        if entry['s3_key'] in sources and (entry['chat_id'], entry['start_sort_key']) not in replaced
+    ]
+    delete_manifest_entries(stale)
+    for start in range(0, len(source_keys), 1000):
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={'Objects': [{'Key': key} for key in source_keys[start:start + 1000]], 'Quiet': True}
+        )
+    stats = {"user_id": user_id, "sources": len(source_keys), "segments": len(segment_keys), **verification}
+    logger.info("Compacted %s", stats)
+    return stats
+
+def compact_day(year, day, user_ids=None, time_left=None):
+    # Driven by the archive_days records of the day rather than the users table. A user's record
+    # is deleted once the day is compacted, so a run stopped by time_left resumes where it ended
+    results = []
+    for user_id in user_ids or iter_archive_day_users(year, day):
+        if time_left and not time_left():
+            logger.info("Compaction of %s/%s stopped early, the remaining users are left for the next run", year, day)
+            break
+        try:
+            stats = compact_user_day(user_id, year, day)
+        except Exception:
+            # The record stays, the next run tries this user's day again
+            logger.exception("Failed to compact %s/%s/%s", user_id, year, day)
+            continue
+        if stats:
+            results.append(stats)
+        delete_archive_day(user_id, year, day)
+    return results
+
+def lambda_handler(event, context):
+    # Scheduled, compacts the days that are over. Days a previous run did not finish are picked
+    # up again, up to COMPACTION_LOOKBACK_DAYS back
+    def time_left():
+        if context and hasattr(context, 'get_remaining_time_in_millis'):
+            return context.get_remaining_time_in_millis() > config.COMPACTION_TIME_MARGIN_MS
+        return True
+
+    today = datetime.now(timezone.utc)
+    results = []
+    for days_ago in range(config.COMPACTION_LOOKBACK_DAYS, 0, -1):
+        date = today - timedelta(days=days_ago)
+        results += compact_day(date.year, date.timetuple().tm_yday, time_left=time_left)
+    return {
+        "statusCode": 200,
+        "body": json.dumps({"message": "Compaction completed.", "users": len(results), "stopped_early": not time_left()})
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact hourly archive objects into segments")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    compact_parser = subparsers.add_parser("compact", help="compact one day of archives")
+    compact_parser.add_argument("--year", type=int, required=True)
+    compact_parser.add_argument("--day", type=int, required=True, help="day of year")
+    compact_parser.add_argument("--user", action="append", help="only these users (repeatable)")
+    verify_parser = subparsers.add_parser("verify", help="check segments against the objects they were built from")
+    verify_parser.add_argument("--segment", action="append", required=True)
+    verify_parser.add_argument("--source", action="append", required=True)
+    args = parser.parse_args()
+    if args.command == "compact":
+        print(json.dumps(compact_day(args.year, args.day, args.user), indent=2))
+    else:
+        result = verify_segments(args.segment, args.source)
+        print(json.dumps(result, indent=2))
+        raise SystemExit(0 if result["ok"] else 1)
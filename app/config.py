@@ -9,6 +9,66 @@ class Config:
     DB_LAST_Y_MESSAGES = int(os.getenv('DB_LAST_Y_MESSAGES', 500))
     S3_RETENTION_DAYS = int(os.getenv('S3_RETENTION_DAYS', 365))
     DB_LIMIT = int(os.getenv('DB_LIMIT', 1000))
+    ARCHIVE_PAGE_SIZE = int(os.getenv('ARCHIVE_PAGE_SIZE', 500))
+    ARCHIVE_PART_SIZE = int(os.getenv('ARCHIVE_PART_SIZE', 8 * 1024 * 1024))
+    ARCHIVE_MANIFEST_PAGE_SIZE = int(os.getenv('ARCHIVE_MANIFEST_PAGE_SIZE', 10))
+    ARCHIVE_CACHE_BYTES = int(os.getenv('ARCHIVE_CACHE_BYTES', 32 * 1024 * 1024))
+    SEGMENT_BLOCK_ROWS = int(os.getenv('SEGMENT_BLOCK_ROWS', 500))
+    SEGMENT_MAX_BYTES = int(os.getenv('SEGMENT_MAX_BYTES', 128 * 1024 * 1024))
+    COMPACTION_LOOKBACK_DAYS = int(os.getenv('COMPACTION_LOOKBACK_DAYS', 7))
+    COMPACTION_TIME_MARGIN_MS = int(os.getenv('COMPACTION_TIME_MARGIN_MS', 60000))
+    ARCHIVE_LOCK_TTL = int(os.getenv('ARCHIVE_LOCK_TTL', 300))
+    CHAT_CACHE_TTL = int(os.getenv('CHAT_CACHE_TTL', 3600))
+    BLOCKLIST_CACHE_TTL = int(os.getenv('BLOCKLIST_CACHE_TTL', 3600))
+    FANOUT_MAX_WORKERS = int(os.getenv('FANOUT_MAX_WORKERS', 8))
+    FANOUT_MAX_RETRIES = int(os.getenv('FANOUT_MAX_RETRIES', 5))
+    FANOUT_BACKOFF_BASE_MS = int(os.getenv('FANOUT_BACKOFF_BASE_MS', 50))
+    GROUP_FANOUT_THRESHOLD = int(os.getenv('GROUP_FANOUT_THRESHOLD', 100))
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', 100000))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 600))
+    GROUP_CACHE_TTL = int(os.getenv('GROUP_CACHE_TTL', 3600))
+    GROUP_LOCAL_CACHE_TTL = int(os.getenv('GROUP_LOCAL_CACHE_TTL', 5))
+    GROUP_LOCAL_CACHE_SIZE = int(os.getenv('GROUP_LOCAL_CACHE_SIZE', 1000))
+    GROUP_MEMBERS_SCAN_COUNT = int(os.getenv('GROUP_MEMBERS_SCAN_COUNT', 1000))
+    ASYNC_MAX_WORKERS = int(os.getenv('ASYNC_MAX_WORKERS', 8))
+    BACKEND_CALL_TIMEOUT_MS = int(os.getenv('BACKEND_CALL_TIMEOUT_MS', 3000))
+    SEND_MODE = os.getenv('SEND_MODE', 'sync')
+    OUTBOX_BACKEND = os.getenv('OUTBOX_BACKEND', 'file')
+    OUTBOX_DIR = os.getenv('OUTBOX_DIR', '/tmp/outbox')
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 100))
+    OUTBOX_SEGMENT_BYTES = int(os.getenv('OUTBOX_SEGMENT_BYTES', 16 * 1024 * 1024))
+    OUTBOX_FSYNC = os.getenv('OUTBOX_FSYNC', 'true').lower() == 'true'
+    OUTBOX_POLL_MS = int(os.getenv('OUTBOX_POLL_MS', 1000))
+    INBOX_PAGE_SIZE = int(os.getenv('INBOX_PAGE_SIZE', 50))
+    INBOX_MAX_PAGE_SIZE = int(os.getenv('INBOX_MAX_PAGE_SIZE', 200))
+    INBOX_PREVIEW_CHARS = int(os.getenv('INBOX_PREVIEW_CHARS', 100))
+    INBOX_UNREAD_CAP = int(os.getenv('INBOX_UNREAD_CAP', 100))
+    SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', 100))
+    SYNC_MAX_PAGE_SIZE = int(os.getenv('SYNC_MAX_PAGE_SIZE', 500))
+    SYNC_OVERLAP_MS = int(os.getenv('SYNC_OVERLAP_MS', 5000))
+    SYNC_MAX_SEEN = int(os.getenv('SYNC_MAX_SEEN', 1000))
+    SYNC_MAX_WAIT_S = float(os.getenv('SYNC_MAX_WAIT_S', 20))
+    SEND_MESSAGES_MAX_BATCH = int(os.getenv('SEND_MESSAGES_MAX_BATCH', 500))
+    MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 50))
+    MESSAGES_MAX_PAGE_SIZE = int(os.getenv('MESSAGES_MAX_PAGE_SIZE', 200))
+    DB_RETENTION_HOURS = int(os.getenv('DB_RETENTION_HOURS', 24))
+    BACKUP_DIRTY_SHARDS = int(os.getenv('BACKUP_DIRTY_SHARDS', 16))
+    BACKUP_MAX_WORKERS = int(os.getenv('BACKUP_MAX_WORKERS', 8))
+    BACKUP_MAX_MESSAGES_PER_CHAT = int(os.getenv('BACKUP_MAX_MESSAGES_PER_CHAT', 5000))
+    BACKUP_TIME_MARGIN_MS = int(os.getenv('BACKUP_TIME_MARGIN_MS', 5000))
+    BACKUP_OVERLAP_MS = int(os.getenv('BACKUP_OVERLAP_MS', 300000))
+    BACKUP_MAX_SEEN = int(os.getenv('BACKUP_MAX_SEEN', 1000))
     DYNAMODB_REGION = os.getenv('DYNAMODB_REGION', 'us-east-1')
+    BOTO_MAX_POOL_CONNECTIONS = int(os.getenv('BOTO_MAX_POOL_CONNECTIONS', 32))
+    BOTO_CONNECT_TIMEOUT = float(os.getenv('BOTO_CONNECT_TIMEOUT', 2))
+    BOTO_READ_TIMEOUT = float(os.getenv('BOTO_READ_TIMEOUT', 5))
+    BOTO_MAX_ATTEMPTS = int(os.getenv('BOTO_MAX_ATTEMPTS', 3))
+    REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', 1))
+    REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', 1))
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'dynamodb')
+    SQLITE_PATH = os.getenv('SQLITE_PATH', 'chat.db')
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', 5000))
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+    METRICS_WINDOW = int(os.getenv('METRICS_WINDOW', 1000))
 
 config = Config()
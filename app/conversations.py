@@ -0,0 +1,123 @@
+import base64
+import json
+from datetime import datetime
+from config import config
+
+# Keys and cursors shared by every storage engine, so conversations are addressed the same
+# way in DynamoDB, SQLite, the Redis cache and the S3 archive
+
+def get_conversation_id(user_id, chat_id):
+    # Both directions of a direct chat share one partition
+    return "dm:" + "#".join(sorted((user_id, chat_id)))
+
+def get_conversation_participants(chat_id):
+    # The two users of a direct conversation, None for group conversations
+    if not chat_id.startswith("dm:"):
+        return None
+    return tuple(chat_id[len("dm:"):].split("#", 1))
+
+def get_group_conversation_id(group_id, user_id):
+    # Fanned-out group copies are partitioned per member
+    return f"group:{group_id}#{user_id}"
+
+def get_conversation_group(chat_id):
+    # The group of a group conversation id, None for direct conversations
+    if not chat_id.startswith("group:"):
+        return None
+    return chat_id[len("group:"):].rsplit("#", 1)[0]
+
+def get_timeline_conversation_id(group_id):
+    # The timeline of a large group, stored once per group in group_timeline
+    return f"timeline:{group_id}"
+
+def get_timeline_group(chat_id):
+    # The group of a timeline conversation id, None for any other conversation
+    if not chat_id.startswith("timeline:"):
+        return None
+    return chat_id[len("timeline:"):]
+
+def get_archive_owner(chat_id):
+    # (owner, name) a conversation is archived under in S3, compaction works per owner and day.
+    # Direct chats go under one of their users, group copies under their member and timelines
+    # under their group
+    participants = get_conversation_participants(chat_id)
+    if participants:
+        return participants
+    group_id = get_timeline_group(chat_id)
+    if group_id is not None:
+        return f"group-{group_id}", "timeline"
+    return chat_id.rsplit("#", 1)[1], f"group-{get_conversation_group(chat_id)}"
+
+def make_sort_key(timestamp, message_id):
+    return f"{timestamp}#{message_id}"
+
+def make_block_id(blocker_id, blocked_id):
+    return f"{blocker_id}#{blocked_id}"
+
+def prepare_message(message):
+    # Fills in the storage keys, so cached copies and DB items look the same
+    if isinstance(message['timestamp'], datetime):
+        message['timestamp'] = message['timestamp'].isoformat()
+    message.setdefault('chat_id', get_conversation_id(message['sender_id'], message['receiver_id']))
+    message['sort_key'] = make_sort_key(message['timestamp'], message['message_id'])
+    return message
+
+def make_group_copies(message, group_id, member_ids):
+    # The fanned-out copies of a group message, one per member in the member's group conversation
+    copies = []
+    for member_id in member_ids:
+        message_copy = message.copy()
+        # Deterministic per-recipient id keeps copies distinct and retries idempotent
+        message_copy['message_id'] = f"{message['message_id']}#{member_id}"
+        message_copy['group_message_id'] = message['message_id']
+        message_copy['group_id'] = group_id
+        message_copy['receiver_id'] = member_id
+        message_copy['chat_id'] = get_group_conversation_id(group_id, member_id)
+        message_copy['sort_key'] = make_sort_key(message_copy['timestamp'], message_copy['message_id'])
+        copies.append(message_copy)
+    return copies
+
+def get_inbox_updates(messages):
+    # One inbox summary update per (user, conversation) for a set of stored messages: the newest
+    # message and how many of them the user didn't send. A direct
+    # message updates both users' entries, a fanned-out group copy only its receiver's
+    updates = {}
+    for message in sorted(messages, key=lambda message: message['sort_key']):
+        user_ids = [message['receiver_id']] if message.get('group_id') else [message['sender_id'], message['receiver_id']]
+        for user_id in user_ids:
+            update = updates.get((user_id, message['chat_id']))
+            if update is None:
+                update = updates[(user_id, message['chat_id'])] = {'user_id': user_id, 'unread': 0}
+            update['message'] = message
+            update['unread'] += message['sender_id'] != user_id
+    return list(updates.values())
+
+def make_inbox_item(user_id, message):
+    # An inbox entry summarizing a conversation by its newest message
+    item = {
+        'user_id': user_id,
+        'chat_id': message['chat_id'],
+        'last_message_id': message.get('group_message_id', message['message_id']),
+        'last_sender_id': message['sender_id'],
+        'last_sort_key': message['sort_key'],
+        'last_timestamp': message['timestamp'],
+        'preview': message['content'][:config.INBOX_PREVIEW_CHARS]
+    }
+    if message.get('group_id'):
+        item['group_id'] = message['group_id']
+    else:
+        item['peer_id'] = message['receiver_id'] if message['sender_id'] == user_id else message['sender_id']
+    return item
+
+def encode_cursor(state):
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor):
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    # Every cursor this module encodes is an object, anything else was made up by the client
+    if not isinstance(state, dict):
+        raise ValueError("Invalid cursor")
+    return state
@@ -1,20 +1,34 @@
-from sqlalchemy.orm import Session
-from uuid import uuid4
 from datetime import *
-from models import User, Message, Block, Group, GroupMember, ChatMetadata
-from schemas import UserCreate, MessageCreate, BlockCreate, GroupCreate, GroupMemberCreate, ChatMetadataCreate
-from boto3.dynamodb.conditions import Key, Attr
+from botocore.exceptions import ClientError
 from config import config
-import boto3
+from clients import Key, LazyTable, get_dynamodb
+from fanout import executor, fan_out, put_items, chunked
+import metrics
+from conversations import *
+from functools import partial
+from heapq import merge
+from itertools import islice
+import random
+import time
+import zlib
+import logging
 
-dynamodb = boto3.resource('dynamodb', endpoint_url=config.DYNAMODB_ENDPOINT_URL, region_name=config.DYNAMODB_REGION)
+users_table = LazyTable('users')
+messages_table = LazyTable('chat_messages')
+chat_metadata_table = LazyTable('chat_metadata')
+blocks_table = LazyTable('user_blocks')
+groups_table = LazyTable('groups')
+group_members_table = LazyTable('group_members')
+group_timeline_table = LazyTable('group_timeline')
+user_emails_table = LazyTable('user_emails')
+archive_manifest_table = LazyTable('archive_manifest')
+archive_days_table = LazyTable('archive_days')
+inbox_table = LazyTable('user_inbox')
 
-users_table = dynamodb.Table('users')
-messages_table = dynamodb.Table('messages')
-chat_metadata_table = dynamodb.Table('chat_metadata')
-blocks_table = dynamodb.Table('blocks')
-groups_table = dynamodb.Table('groups')
-group_members_table = dynamodb.Table('group_members')
+logger = logging.getLogger()
+
+# BatchGetItem accepts at most 100 keys per call
+BATCH_GET_SIZE = 100
 
 # Users tables interfaces
 def create_user(user):
@@ -25,78 +39,324 @@ def get_user(user_id):
     response = users_table.get_item(Key={'user_id': user_id})
     return response.get('Item')
 
+def get_existing_user_ids(user_ids):
+    # Keys only batch read, returns the ids that exist. Ids left unprocessed count as missing,
+    # the caller answers 404 rather than guessing
+    return {item['user_id'] for item in batch_get(users_table, [{'user_id': user_id} for user_id in user_ids], 'user_id')}
+
+def batch_get(table, keys, projection, names=None):
+    # BatchGetItem in parallel calls of up to 100 keys, keys still unprocessed after all retries are left out
+    get_chunk = partial(batch_get_chunk, table.name, projection, names)
+    return [item for items in executor.map(get_chunk, chunked(list(keys), BATCH_GET_SIZE)) for item in items]
+
+def batch_get_chunk(table_name, projection, names, keys):
+    client = get_dynamodb().meta.client
+    found = []
+    request = {table_name: {'Keys': keys, 'ProjectionExpression': projection}}
+    if names:
+        request[table_name]['ExpressionAttributeNames'] = names
+    for attempt in range(config.FANOUT_MAX_RETRIES + 1):
+        response = client.batch_get_item(RequestItems=request)
+        found.extend(response['Responses'].get(table_name, []))
+        request = response.get('UnprocessedKeys')
+        if not request:
+            return found
+        if attempt < config.FANOUT_MAX_RETRIES:
+            backoff = min(config.FANOUT_BACKOFF_BASE_MS * (2 ** attempt), 1000) / 1000
+            time.sleep(random.uniform(0, backoff))
+    logger.error("Batch get from %s left %d keys unprocessed", table_name, len(request[table_name]['Keys']))
+    return found
+
 def get_all_users():
-    response = users_table.table.scan()
-    return response
+    users = []
+    scan_kwargs = {}
+    while True:
+        response = users_table.scan(**scan_kwargs)
+        users.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return users
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
 
 def get_user_by_email(email):
-    response = users_table.scan(
-        FilterExpression=Key('email').eq(email)
-    )
-    items = response.get('Items', [])
-    return items[0] if items else None
+    reservation = get_email_reservation(email)
+    return get_user(reservation['user_id']) if reservation else None
+
+# User emails table interfaces
+def reserve_email(email, user_id):
+    # Conditional put, so concurrent registrations of one email can't both win
+    try:
+        user_emails_table.put_item(
+            Item={'email': email, 'user_id': user_id},
+            ConditionExpression='attribute_not_exists(email)'
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+def release_email(email):
+    response = user_emails_table.delete_item(Key={'email': email})
+    return response
+
+def get_email_reservation(email):
+    response = user_emails_table.get_item(Key={'email': email})
+    return response.get('Item')
 
 # Messages tables interfaces
 def create_message(message):
-    message['timestamp'] = message['timestamp'].isoformat()
-    response = messages_table.put_item(Item=message)
+    response = messages_table.put_item(Item=prepare_message(message))
     return response
 
-def get_user_chats(user_id):
-    response = messages_table.query(
-        IndexName='sender_id-index',
-        KeyConditionExpression=Key('sender_id').eq(user_id)
-    )
-    return response['Items']
+def create_messages(messages):
+    # Batched writes, returns the messages that could not be written
+    return put_items(messages_table.name, [prepare_message(message) for message in messages])
 
-def delete_old_messages(retention_hours):
-    response = messages_table.scan()
-    items = response['Items']
-    retention_time = datetime.now(timezone.utc) - timedelta(hours=retention_hours)
-    old_messages = [item for item in items if int(item['timestamp']) < retention_time.timestamp()]
+# Items per TransactWriteItems request
+TRANSACTION_MAX_ITEMS = 100
 
-    for message in old_messages:
-        messages_table.delete_item(Key={'message_id': message['message_id']})
+def create_messages_once(messages):
+    # Write-behind persistence, safe to replay. Each message is put together with its chat's
+    # message_count and its receiver's unread_count in one transaction, on condition that the
+    # message isn't stored yet, so a message_id is counted once however often the outbox hands
+    # it over. Returns {chat_id: message_count} of the chats that got new messages
+    by_chat = {}
+    for message in sorted((prepare_message(message) for message in messages), key=lambda message: message['sort_key']):
+        by_chat.setdefault(message['chat_id'], []).append(message)
+    counts = {}
+    for chat_id, items in by_chat.items():
+        # Room for the chat metadata and both users' inbox entries
+        stored = [message for chunk in chunked(items, TRANSACTION_MAX_ITEMS - 3) for message in store_new_messages(chat_id, chunk)]
+        if not stored:
+            continue
+        counts[chat_id] = record_latest_message(chat_id, stored[-1])
+        # Only the summaries, the unread counts went in with the messages
+        record_inbox_messages([dict(update, unread=0) for update in get_inbox_updates(stored)])
+    return counts
 
-# Chat Metadata table interfaces
-def create_chat_metadata(metadata):
-    metadata['latest_timestamp'] = metadata['latest_timestamp'].isoformat()
-    response = chat_metadata_table.put_item(Item=metadata)
-    return response
+def store_new_messages(chat_id, messages):
+    # One transaction per attempt, messages found already stored are dropped and the rest retried.
+    # Returns the messages this call stored
+    while messages:
+        transact_items = [
+            {'Put': {'TableName': messages_table.name, 'Item': message, 'ConditionExpression': 'attribute_not_exists(sort_key)'}}
+            for message in messages
+        ]
+        transact_items.append({'Update': {
+            'TableName': chat_metadata_table.name,
+            'Key': {'chat_id': chat_id},
+            'UpdateExpression': "SET start_index=if_not_exists(start_index, :f), dirty_shard=:s ADD message_count :n",
+            'ExpressionAttributeValues': {':f': messages[0]['message_id'], ':s': get_dirty_shard(chat_id), ':n': len(messages)}
+        }})
+        for update in get_inbox_updates(messages):
+            if update['unread']:
+                transact_items.append({'Update': {
+                    'TableName': inbox_table.name,
+                    'Key': {'user_id': update['user_id'], 'chat_id': chat_id},
+                    'UpdateExpression': "ADD unread_count :u",
+                    'ExpressionAttributeValues': {':u': update['unread']}
+                }})
+        try:
+            get_dynamodb().meta.client.transact_write_items(TransactItems=transact_items)
+            return messages
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = e.response.get('CancellationReasons', [])
+            stored = {index for index, reason in enumerate(reasons[:len(messages)]) if reason.get('Code') == 'ConditionalCheckFailed'}
+            if not stored:
+                # Conflicts with a concurrent transaction, the outbox retries the batch
+                raise
+            messages = [message for index, message in enumerate(messages) if index not in stored]
+    return []
+
+def get_chat_messages(chat_id, limit=None, before=None):
+    # Last `limit` messages of a conversation (all of them without a limit), oldest first
+    key_condition = Key('chat_id').eq(chat_id)
+    if before:
+        key_condition = key_condition & Key('sort_key').lt(before)
+    query_kwargs = {'KeyConditionExpression': key_condition, 'ScanIndexForward': False}
+    items = []
+    while limit is None or len(items) < limit:
+        if limit:
+            query_kwargs['Limit'] = limit - len(items)
+        response = messages_table.query(**query_kwargs)
+        items.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    items.reverse()
+    return items
 
+def get_user_chats(user_id, chat_id, limit=None):
+    return get_chat_messages(get_conversation_id(user_id, chat_id), limit)
+
+# Chat Metadata table interfaces
 def get_chat_metadata(chat_id):
     response = chat_metadata_table.get_item(Key={'chat_id': chat_id})
     return response.get('Item')
 
-def update_chat_metadata(chat_id, metadata):
-    metadata['latest_timestamp'] = metadata['latest_timestamp'].isoformat()
+def get_dirty_shard(chat_id):
+    return zlib.crc32(chat_id.encode()) % config.BACKUP_DIRTY_SHARDS
+
+def record_chat_message(chat_id, message_id, timestamp, count=1, first_message_id=None):
+    # Single upsert with an atomic ADD, returns the chat's message count after these `count`
+    # messages, message_id being the newest. dirty_shard puts the chat in the sparse index the
+    # hourly backup reads from
     response = chat_metadata_table.update_item(
         Key={'chat_id': chat_id},
-        UpdateExpression="set message_count=:m, end_index=:e, latest_timestamp=:l",
+        UpdateExpression="SET start_index=if_not_exists(start_index, :f), end_index=:e, latest_timestamp=:l, latest_sort_key=:k, dirty_shard=:s ADD message_count :n",
         ExpressionAttributeValues={
-            ':m': metadata['message_count'],
-            ':e': metadata['end_index'],
-            ':l': metadata['latest_timestamp']
+            ':f': first_message_id or message_id,
+            ':e': message_id,
+            ':l': timestamp,
+            ':k': make_sort_key(timestamp, message_id),
+            ':s': get_dirty_shard(chat_id),
+            ':n': count
         },
         ReturnValues="UPDATED_NEW"
     )
-    return response
+    return int(response['Attributes']['message_count'])
+
+def record_latest_message(chat_id, message):
+    # Moves the chat's latest message forward, never back, returns the chat's message count
+    try:
+        response = chat_metadata_table.update_item(
+            Key={'chat_id': chat_id},
+            UpdateExpression="SET end_index=:e, latest_timestamp=:l, latest_sort_key=:k",
+            ConditionExpression='attribute_not_exists(latest_sort_key) OR latest_sort_key < :k',
+            ExpressionAttributeValues={':e': message['message_id'], ':l': message['timestamp'], ':k': message['sort_key']},
+            ReturnValues="ALL_NEW"
+        )
+        return int(response['Attributes']['message_count'])
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    response = chat_metadata_table.get_item(Key={'chat_id': chat_id}, ConsistentRead=True)
+    return int(response['Item']['message_count'])
+
+def get_dirty_chats(shard):
+    query_kwargs = {
+        'IndexName': 'dirty_shard-index',
+        'KeyConditionExpression': Key('dirty_shard').eq(shard)
+    }
+    while True:
+        response = chat_metadata_table.query(**query_kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def mark_chat_backed_up(chat_id, watermark, seen, message_count=None):
+    # Leaves the dirty index only if no message was counted since the backup read the metadata
+    # (message_count), without it the chat stays dirty. seen are the sort keys already exported
+    # from the overlap before the watermark
+    if message_count is not None:
+        try:
+            chat_metadata_table.update_item(
+                Key={'chat_id': chat_id},
+                UpdateExpression="SET backup_watermark=:w, backup_seen=:s REMOVE dirty_shard",
+                ConditionExpression='message_count = :c',
+                ExpressionAttributeValues={':w': watermark, ':s': seen, ':c': message_count}
+            )
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+    chat_metadata_table.update_item(
+        Key={'chat_id': chat_id},
+        UpdateExpression="SET backup_watermark=:w, backup_seen=:s",
+        ExpressionAttributeValues={':w': watermark, ':s': seen}
+    )
+    return False
+
+def record_archived_messages(chat_id, archived_count):
+    response = chat_metadata_table.update_item(
+        Key={'chat_id': chat_id},
+        UpdateExpression="ADD message_count :d, archived_count :a",
+        ExpressionAttributeValues={':d': -archived_count, ':a': archived_count},
+        ReturnValues="UPDATED_NEW"
+    )
+    return int(response['Attributes']['message_count'])
+
+# Archive manifest table interfaces
+def create_manifest_entries(entries):
+    with archive_manifest_table.batch_writer() as batch:
+        for entry in entries:
+            batch.put_item(Item=entry)
+
+def get_manifest_entries(chat_id, before=None, limit=None):
+    # Archived chunks that start before `before`, newest first. The first one may straddle it
+    key_condition = Key('chat_id').eq(chat_id)
+    if before:
+        key_condition = key_condition & Key('start_sort_key').lt(before)
+    query_kwargs = {
+        'KeyConditionExpression': key_condition,
+        'ScanIndexForward': False,
+        'Limit': limit or config.ARCHIVE_MANIFEST_PAGE_SIZE
+    }
+    response = archive_manifest_table.query(**query_kwargs)
+    return response['Items']
+
+def get_chat_manifest(chat_id):
+    entries = []
+    query_kwargs = {'KeyConditionExpression': Key('chat_id').eq(chat_id)}
+    while True:
+        response = archive_manifest_table.query(**query_kwargs)
+        entries.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return entries
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def delete_manifest_entries(entries):
+    with archive_manifest_table.batch_writer() as batch:
+        for entry in entries:
+            batch.delete_item(Key={'chat_id': entry['chat_id'], 'start_sort_key': entry['start_sort_key']})
+
+# Archive days table interfaces, the user/day prefixes holding archive objects not compacted yet
+def get_archive_day(year, day):
+    return f"{year}/{day}"
+
+def record_archive_day(user_id, year, day):
+    archive_days_table.put_item(Item={'day': get_archive_day(year, day), 'user_id': user_id})
+
+def iter_archive_day_users(year, day):
+    # One page at a time, compaction deletes the records behind it as it goes
+    query_kwargs = {'KeyConditionExpression': Key('day').eq(get_archive_day(year, day))}
+    while True:
+        response = archive_days_table.query(**query_kwargs)
+        for item in response['Items']:
+            yield item['user_id']
+        if 'LastEvaluatedKey' not in response:
+            return
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def delete_archive_day(user_id, year, day):
+    archive_days_table.delete_item(Key={'day': get_archive_day(year, day), 'user_id': user_id})
 
 # Block table interfaces
 def create_block(block):
     response = blocks_table.put_item(Item=block)
     return response
 
-def get_block(block_id):
-    response = blocks_table.get_item(Key={'block_id': block_id})
-    return response.get('Item')
-
 def get_block(sender_id, receiver_id):
-    response = blocks_table.scan(
-        FilterExpression=Attr('blocked_id').eq(sender_id) & Attr('blocker_id').eq(receiver_id)
-    )
+    # A message is blocked when the receiver has blocked the sender
+    response = blocks_table.get_item(Key={'blocker_id': receiver_id, 'blocked_id': sender_id})
     return response.get('Item')
 
+def get_blocked_ids(blocker_id):
+    blocked_ids = []
+    query_kwargs = {
+        'KeyConditionExpression': Key('blocker_id').eq(blocker_id),
+        'ProjectionExpression': 'blocked_id'
+    }
+    while True:
+        response = blocks_table.query(**query_kwargs)
+        blocked_ids.extend(item['blocked_id'] for item in response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return blocked_ids
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
 # Group table interfaces
 def create_group(group):
     response = groups_table.put_item(Item=group)
@@ -107,43 +367,385 @@ def get_group(group_id):
     return response.get('Item')
 
 def add_user_to_group(group_member):
-    if (get_group(group_member['group_id']) and get_user(group_member['user_id'])):
-        response = group_members_table.put_item(Item=group_member)
-        return response
-    else:
-        return None
-        
+    # Callers check that the group and the user exist. {} when the user already is a member
+    group_member.setdefault('joined_at', datetime.now(timezone.utc).isoformat())
+    try:
+        response = group_members_table.put_item(
+            Item=group_member,
+            ConditionExpression='attribute_not_exists(user_id)'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return {}
+        raise
+    update_group_member_count(group_member['group_id'], 1)
+    return response
+
 def remove_user_from_group(group_id, user_id):
-    if (get_group(group_id)):
-        response = group_members_table.delete_item(
-            Key={
-                'group_id': group_id,
-                'user_id': user_id
+    # Callers check that the group exists
+    response = group_members_table.delete_item(
+        Key={
+            'group_id': group_id,
+            'user_id': user_id
+        },
+        ReturnValues='ALL_OLD'
+    )
+    if response.get('Attributes'):
+        update_group_member_count(group_id, -1)
+    return response
+
+def update_group_member_count(group_id, delta):
+    response = groups_table.update_item(
+        Key={'group_id': group_id},
+        UpdateExpression="ADD member_count :d",
+        ExpressionAttributeValues={':d': delta},
+        ReturnValues="UPDATED_NEW"
+    )
+    return response['Attributes']['member_count']
+
+def get_group_size(group):
+    if 'member_count' in group:
+        return int(group['member_count'])
+    # Groups created before member_count existed: count the members once
+    count = 0
+    query_kwargs = {
+        'KeyConditionExpression': Key('group_id').eq(group['group_id']),
+        'Select': 'COUNT'
+    }
+    while True:
+        response = group_members_table.query(**query_kwargs)
+        count += response['Count']
+        if 'LastEvaluatedKey' not in response:
+            return count
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_group_members(group_id):
+    members = []
+    query_kwargs = {'KeyConditionExpression': Key('group_id').eq(group_id)}
+    while True:
+        response = group_members_table.query(**query_kwargs)
+        members.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return members
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def get_user_groups(user_id):
+    memberships = []
+    query_kwargs = {
+        'IndexName': 'user_id-index',
+        'KeyConditionExpression': Key('user_id').eq(user_id)
+    }
+    while True:
+        response = group_members_table.query(**query_kwargs)
+        memberships.extend(response['Items'])
+        if 'LastEvaluatedKey' not in response:
+            return memberships
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+def update_read_cursor(group_id, user_id, read_cursor):
+    # Cursors only move forward, concurrent readers can't rewind each other
+    try:
+        group_members_table.update_item(
+            Key={'group_id': group_id, 'user_id': user_id},
+            UpdateExpression="set read_cursor=:c",
+            ConditionExpression='attribute_exists(user_id) AND (attribute_not_exists(read_cursor) OR read_cursor < :c)',
+            ExpressionAttributeValues={':c': read_cursor}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+def update_group_summary(group_id, message):
+    # Newest timeline message on the group item, the inbox entry of large groups. Only moves forward
+    try:
+        groups_table.update_item(
+            Key={'group_id': group_id},
+            UpdateExpression="SET last_message_id=:m, last_sender_id=:s, last_sort_key=:k, last_timestamp=:t, preview=:p",
+            ConditionExpression='attribute_exists(group_id) AND (attribute_not_exists(last_sort_key) OR last_sort_key < :k)',
+            ExpressionAttributeValues={
+                ':m': message['message_id'],
+                ':s': message['sender_id'],
+                ':k': message['sort_key'],
+                ':t': message['timestamp'],
+                ':p': message['content'][:config.INBOX_PREVIEW_CHARS]
             }
         )
-        return response
-    else:
-        return None
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
 
-def get_group_members(group_id):
-    response = group_members_table.query(
-        KeyConditionExpression=Key('group_id').eq(group_id)
+# Group timeline table interfaces
+def create_group_timeline_message(message, group_id):
+    item = dict(message)
+    item['group_id'] = group_id
+    item['sort_key'] = make_sort_key(message['timestamp'], message['message_id'])
+    response = group_timeline_table.put_item(Item=item)
+    return response
+
+# Inbox table interfaces
+def record_inbox_messages(updates):
+    # Applies conversations.get_inbox_updates, one upsert per entry, in parallel
+    list(executor.map(record_inbox_message, updates))
+
+def record_inbox_message(update):
+    # The summary only moves forward, a message older than the entry's newest just adds to unread_count
+    item = make_inbox_item(update['user_id'], update['message'])
+    fields = [field for field in item if field not in ('user_id', 'chat_id')]
+    values = {f':{field}': item[field] for field in fields}
+    key = {'user_id': item['user_id'], 'chat_id': item['chat_id']}
+    try:
+        inbox_table.update_item(
+            Key=key,
+            UpdateExpression="SET " + ", ".join(f"{field}=:{field}" for field in fields) + " ADD unread_count :u",
+            ConditionExpression='attribute_not_exists(last_sort_key) OR last_sort_key < :last_sort_key',
+            ExpressionAttributeValues=dict(values, **{':u': update['unread']})
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+        if update['unread']:
+            inbox_table.update_item(
+                Key=key,
+                UpdateExpression="ADD unread_count :u",
+                ExpressionAttributeValues={':u': update['unread']}
+            )
+
+def get_inbox(user_id, limit=None):
+    # The user's conversations, newest first: one query of the inbox index, and for the large
+    # groups the user is in (which have no inbox entries) the summary on the group item
+    limit = min(limit or config.INBOX_PAGE_SIZE, config.INBOX_MAX_PAGE_SIZE)
+    response = inbox_table.query(
+        IndexName='user_id-last_sort_key-index',
+        KeyConditionExpression=Key('user_id').eq(user_id),
+        ScanIndexForward=False,
+        Limit=limit
     )
-    return response['Items']
+    entries = {item['chat_id']: item for item in response['Items']}
+    for item in get_timeline_inbox_entries(user_id):
+        # A group that grew past the fan-out threshold can have both, the newer one wins
+        current = entries.get(item['chat_id'])
+        if current is None or current['last_sort_key'] < item['last_sort_key']:
+            entries[item['chat_id']] = item
+    return sorted(entries.values(), key=lambda item: item['last_sort_key'], reverse=True)[:limit]
+
+def get_timeline_memberships(user_id):
+    # The user's memberships of groups stored as a timeline, with their group items. Only these
+    # have a timeline to read, fanned-out groups' copies are in the messages table
+    memberships = get_user_groups(user_id)
+    if not memberships:
+        return []
+    groups = {group['group_id']: group for group in batch_get(
+        groups_table,
+        [{'group_id': membership['group_id']} for membership in memberships],
+        'group_id, #n, last_message_id, last_sender_id, last_sort_key, last_timestamp, preview',
+        {'#n': 'name'}
+    )}
+    return [
+        (membership, groups[membership['group_id']]) for membership in memberships
+        if 'last_sort_key' in groups.get(membership['group_id'], {})
+    ]
 
-def get_messages_for_user(user_id):
-    response = messages_table.query(
-        IndexName='receiver_id-index',
-        KeyConditionExpression=Key('receiver_id').eq(user_id)
+def get_timeline_inbox_entries(user_id):
+    entries = []
+    for membership, group in get_timeline_memberships(user_id):
+        entry = dict(group, user_id=user_id, chat_id=get_group_conversation_id(group['group_id'], user_id), unread_count=0)
+        # Unread are the timeline messages past the member's read cursor, not counting their own
+        entry['read_from'] = max(filter(None, [membership.get('read_cursor'), membership.get('joined_at')]), default='')
+        entries.append(entry)
+    for entry, count in zip(entries, executor.map(count_unread_timeline_messages, entries)):
+        entry['unread_count'] = count
+        del entry['read_from']
+    return entries
+
+def count_unread_timeline_messages(entry):
+    if entry['last_sort_key'] <= entry['read_from']:
+        return 0
+    response = group_timeline_table.query(
+        KeyConditionExpression=Key('group_id').eq(entry['group_id']) & Key('sort_key').gt(entry['read_from']),
+        FilterExpression='sender_id <> :u',
+        ExpressionAttributeValues={':u': entry['user_id']},
+        Select='COUNT',
+        Limit=config.INBOX_UNREAD_CAP
     )
-    items = response['Items']
-    for item in items:
-        item['timestamp'] = datetime.fromisoformat(item['timestamp'])
-    return items
+    return response['Count']
+
+def mark_inbox_read(user_id, chat_id):
+    # Resets a conversation's unread count, False when the user has no such conversation
+    try:
+        inbox_table.update_item(
+            Key={'user_id': user_id, 'chat_id': chat_id},
+            UpdateExpression="SET unread_count=:z",
+            ConditionExpression='attribute_exists(chat_id)',
+            ExpressionAttributeValues={':z': 0}
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+    # Large groups count unread messages from the member's read cursor instead
+    group_id = get_conversation_group(chat_id)
+    group = get_group(group_id) if group_id else None
+    if group is None or 'last_sort_key' not in group:
+        return False
+    update_read_cursor(group_id, user_id, group['last_sort_key'])
+    return True
+
+# Message pagination
+INBOX_KEY_FIELDS = ('chat_id', 'sort_key', 'receiver_id', 'timestamp')
+TIMELINE_KEY_FIELDS = ('group_id', 'sort_key')
+
+def time_range_condition(partition_condition, range_key, since=None, before=None):
+    # since is inclusive, before is exclusive (filtered after the query when both are set)
+    if since and before:
+        return partition_condition & range_key.between(since, before)
+    if since:
+        return partition_condition & range_key.gte(since)
+    if before:
+        return partition_condition & range_key.lt(before)
+    return partition_condition
+
+def query_page(source, limit, start_key=None, forward=False):
+    query_kwargs = {
+        'KeyConditionExpression': source['key_condition'],
+        'ScanIndexForward': forward,
+        'Limit': limit
+    }
+    if source.get('index_name'):
+        query_kwargs['IndexName'] = source['index_name']
+    if start_key:
+        query_kwargs['ExclusiveStartKey'] = start_key
+    response = source['table'].query(**query_kwargs)
+    return response['Items'], response.get('LastEvaluatedKey')
+
+def get_timeline_source(membership, group, since=None, before=None):
+    # A member only sees timeline messages posted after they joined. None when that leaves an
+    # empty range (a BETWEEN with its bounds reversed is a ValidationException) or the group's
+    # newest message is older than it
+    lower = max(filter(None, [since, membership.get('joined_at')]), default=None)
+    if lower and ((before and lower >= before) or group['last_sort_key'] < lower):
+        return None
+    return {
+        'table': group_timeline_table,
+        'key_condition': time_range_condition(Key('group_id').eq(membership['group_id']), Key('sort_key'), lower, before),
+        'key_fields': TIMELINE_KEY_FIELDS
+    }
+
+def get_messages_for_user(user_id, limit=None, before=None, since=None, cursor=None):
+    # Newest first. Returns one page and an opaque cursor for the next one (None when done)
+    limit = min(limit or config.MESSAGES_PAGE_SIZE, config.MESSAGES_MAX_PAGE_SIZE)
+    state = decode_cursor(cursor) if cursor else None
+    if state is not None and not isinstance(state.get('positions'), dict):
+        raise ValueError("Invalid cursor")
+    sources = {
+        'inbox': {
+            'table': messages_table,
+            'index_name': 'receiver_id-index',
+            'key_condition': time_range_condition(Key('receiver_id').eq(user_id), Key('timestamp'), since, before),
+            'key_fields': INBOX_KEY_FIELDS
+        }
+    }
+    # Large groups are stored once per group, merge their timelines into the inbox
+    memberships = {}
+    for membership, group in get_timeline_memberships(user_id):
+        memberships[group['group_id']] = membership
+        source = get_timeline_source(membership, group, since, before)
+        if source:
+            sources[f"group:{group['group_id']}"] = source
+
+    # A cursor pins the set of sources to the ones seen on the first page
+    positions = state['positions'] if state else dict.fromkeys(sources)
+    active = [name for name in positions if name in sources]
+
+    def fetch(name):
+        items, last_key = query_page(sources[name], limit, positions[name])
+        return [item for item in items if not before or item['timestamp'] < before], last_key
+
+    results = dict(zip(active, executor.map(fetch, active)))
+    tagged = [[(item['timestamp'], name, item) for item in results[name][0]] for name in active]
+    page = list(islice(merge(*tagged, key=lambda entry: entry[0], reverse=True), limit))
+
+    last_consumed = {}
+    for _, name, item in page:
+        last_consumed[name] = item
+    next_positions = {}
+    for name in active:
+        items, last_key = results[name]
+        item = last_consumed.get(name)
+        if not items or (item is not None and item is items[-1]):
+            # Everything fetched was used, resume where DynamoDB stopped
+            if last_key is not None:
+                next_positions[name] = last_key
+        elif item is not None:
+            next_positions[name] = {field: item[field] for field in sources[name]['key_fields']}
+        else:
+            next_positions[name] = positions[name]
+
+    messages = []
+    newest_per_group = {}
+    for _, name, item in page:
+        if name != 'inbox':
+            item['receiver_id'] = user_id
+            newest_per_group.setdefault(item['group_id'], item['sort_key'])
+        messages.append(item)
+
+    # The first page holds the newest messages, so it advances each group's read cursor
+    if not cursor and not before:
+        for group_id, sort_key in newest_per_group.items():
+            if sort_key > memberships[group_id].get('read_cursor', ''):
+                update_read_cursor(group_id, user_id, sort_key)
+
+    next_cursor = encode_cursor({'positions': next_positions}) if next_positions else None
+    return messages, next_cursor
+
+def get_messages_since(user_id, since, limit):
+    # Oldest first, up to limit messages the user received at or after since (inclusive),
+    # large group timelines included. Delta sync keeps its own position, so no cursor here
+    sources = [{
+        'table': messages_table,
+        'index_name': 'receiver_id-index',
+        'key_condition': time_range_condition(Key('receiver_id').eq(user_id), Key('timestamp'), since)
+    }]
+    for membership, group in get_timeline_memberships(user_id):
+        source = get_timeline_source(membership, group, since)
+        if source:
+            sources.append(source)
+    results = executor.map(lambda source: query_page(source, limit, forward=True)[0], sources)
+    messages = list(islice(merge(*results, key=lambda item: item['timestamp']), limit))
+    for message in messages:
+        message.setdefault('receiver_id', user_id)
+    return messages
+
+def create_message_for_group(message, group_id, member_ids=None):
+    # Callers that already hold the member ids (cache.get_group_member_ids) pass them in and
+    # save reading the group and its members here
+    if isinstance(message['timestamp'], datetime):
+        message['timestamp'] = message['timestamp'].isoformat()
+    if member_ids is None:
+        group = get_group(group_id)
+        size = get_group_size(group) if group else 0
+    else:
+        size = len(member_ids)
+    if size > config.GROUP_FANOUT_THRESHOLD:
+        # Fan-out-on-read: one timeline write, members merge it in when they read
+        create_group_timeline_message(message, group_id)
+        update_group_summary(group_id, dict(message, sort_key=make_sort_key(message['timestamp'], message['message_id'])))
+        # The timeline is a conversation of its own for the hourly backup and the retention archive
+        record_chat_message(get_timeline_conversation_id(group_id), message['message_id'], message['timestamp'])
+        stats = {"mode": "timeline", "items": 1, "failed": 0, "group_id": group_id}
+        logger.info("Group fan-out: %s", stats)
+        return stats
+    if member_ids is None:
+        member_ids = [member['user_id'] for member in get_group_members(group_id)]
+    copies = make_group_copies(message, group_id, member_ids)
+    stats = fan_out(messages_table.name, copies)
+    record_inbox_messages(get_inbox_updates(copies))
+    # So is every member's copy of the group
+    list(executor.map(lambda copy: record_chat_message(copy['chat_id'], copy['message_id'], copy['timestamp']), copies))
+    stats['mode'] = "fanout"
+    stats['group_id'] = group_id
+    logger.info("Group fan-out: %s", stats)
+    return stats
 
-def create_message_for_group(message, group_id):
-    members = get_group_members(group_id)
-    for member in members:
-        message_copy = message.copy()
-        message_copy['receiver_id'] = member['user_id']
-        create_message(message_copy)
\ No newline at end of file
+metrics.instrument_functions(globals(), "crud")
@@ -1,94 +1,382 @@
-from sqlalchemy.orm import Session
-from uuid import uuid4
-from datetime import *
-from models import User, Message, Block, Group, GroupMember, ChatMetadata
-from schemas import UserCreate, MessageCreate, BlockCreate, GroupCreate, GroupMemberCreate, ChatMetadataCreate
-from boto3.dynamodb.conditions import Key
+import logging
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock, local
 from config import config
-import boto3
+from conversations import *
+from models_sqlite import SCHEMA, MESSAGE_COLUMNS, INBOX_COLUMNS, to_item, message_row, inbox_row
+import metrics
 
-dynamodb = boto3.resource('dynamodb', endpoint_url=config.DYNAMODB_ENDPOINT_URL, region_name=config.DYNAMODB_REGION)
+# SQLite storage engine, the same functions as crud.py for single node and edge deployments.
+# One connection per thread in WAL mode, so readers never wait for the writer. Statements are
+# constant strings, the connection's statement cache keeps them prepared
 
-users_table = dynamodb.Table('users')
-messages_table = dynamodb.Table('messages')
-chat_metadata_table = dynamodb.Table('chat_metadata')
+logger = logging.getLogger()
 
-def get_user(db: Session, user_id: str):
-    return db.query(User).filter(User.id == user_id).first()
+_local = local()
+_schema_lock = Lock()
+_schema_ready = False
+# Bumped by close(), connections of other threads from an older generation reopen on their next call
+_generation = 0
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(User).filter(User.email == email).first()
+# UPSERT ... RETURNING saves a SELECT per send, it needs SQLite 3.35
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
 
+MESSAGE_SELECT = f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages"
+INSERT_MESSAGE = f"INSERT OR REPLACE INTO messages ({', '.join(MESSAGE_COLUMNS)}) VALUES ({', '.join('?' * len(MESSAGE_COLUMNS))})"
+# Leaves a stored message alone, the primary key (chat_id, sort_key) tells a replay apart
+INSERT_NEW_MESSAGE = INSERT_MESSAGE.replace("INSERT OR REPLACE", "INSERT OR IGNORE", 1)
+
+def _connect():
+    connection = sqlite3.connect(
+        config.SQLITE_PATH,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=256
+    )
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    # With WAL, NORMAL only syncs at checkpoints: a power loss can drop the last commits, never corrupt
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    return connection
+
+def _get_connection():
+    global _schema_ready
+    connection = getattr(_local, 'connection', None)
+    if connection is None or _local.generation != _generation:
+        if connection is not None:
+            connection.close()
+        connection = _local.connection = _connect()
+        _local.generation = _generation
+        if not _schema_ready:
+            with _schema_lock:
+                if not _schema_ready:
+                    connection.executescript(SCHEMA)
+                    _schema_ready = True
+    return connection
+
+def close():
+    # Closes this thread's connection, the next call reconnects (and recreates a deleted database).
+    # Other threads' connections are reopened on their next call
+    global _schema_ready, _generation
+    _generation += 1
+    connection = getattr(_local, 'connection', None)
+    if connection is not None:
+        connection.close()
+        _local.connection = None
+    _schema_ready = False
+
+@contextmanager
+def _transaction():
+    # BEGIN IMMEDIATE takes the write lock up front, so a transaction never fails half way on SQLITE_BUSY
+    connection = _get_connection()
+    connection.execute("BEGIN IMMEDIATE")
+    try:
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK")
+        raise
+    connection.execute("COMMIT")
+
+def init_db():
+    _get_connection()
+
+# Users tables interfaces
 def create_user(user):
-    response = users_table.put_item(Item=user)
-    return response
-
-def create_user(db: Session, user: UserCreate):
-    db_user = User(id=str(uuid4()), email=user.email)
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    return db_user
-
-def create_message(db: Session, message: MessageCreate):
-    db_message = Message(id=str(uuid4()), **message.dict())
-    db.add(db_message)
-    db.commit()
-    db.refresh(db_message)
-    return db_message
-
-def create_block(db: Session, block: BlockCreate):
-    db_block = Block(id=str(uuid4()), **block.dict())
-    db.add(db_block)
-    db.commit()
-    db.refresh(db_block)
-    return db_block
-
-def create_group(db: Session, group: GroupCreate):
-    db_group = Group(id=str(uuid4()), name=group.name)
-    db.add(db_group)
-    db.commit()
-    db.refresh(db_group)
-    return db_group
-
-def add_user_to_group(db: Session, group_member: GroupMemberCreate):
-    db_group_member = GroupMember(**group_member.dict())
-    db.add(db_group_member)
-    db.commit()
-    return db_group_member
-
-def remove_user_from_group(db: Session, group_id: str, user_id: str):
-    db.query(GroupMember).filter(GroupMember.group_id == group_id, GroupMember.user_id == user_id).delete()
-    db.commit()
-
-def get_user_chats(db: Session, user_id: str):
-    user = get_user(db, user_id)
-    if not user:
-        return {}
-    chats = {}
-    messages = db.query(Message).filter(Message.sender_id == user_id).all()
-    for message in messages:
-        if message.receiver_id not in chats:
-            chats[message.receiver_id] = []
-        chats[message.receiver_id].append(message.dict())
-    return chats
-
-def delete_old_messages(db: Session, retention_hours: int):
-    retention_time = datetime.utcnow() - timedelta(hours=retention_hours)
-    db.query(Message).filter(Message.timestamp < retention_time.timestamp()).delete()
-    db.commit()
-
-def get_chat_metadata(db: Session, chat_id: str):
-    return db.query(ChatMetadata).filter(ChatMetadata.chat_id == chat_id).first()
-
-def create_chat_metadata(db: Session, metadata: ChatMetadataCreate):
-    db_metadata = ChatMetadata(**metadata.dict())
-    db.add(db_metadata)
-    db.commit()
-    db.refresh(db_metadata)
-    return db_metadata
-
-def update_chat_metadata(db: Session, chat_id: str, metadata: dict):
-    db.query(ChatMetadata).filter(ChatMetadata.chat_id == chat_id).update(metadata)
-    db.commit()
-    
\ No newline at end of file
+    _get_connection().execute(
+        "INSERT OR REPLACE INTO users (user_id, email, password) VALUES (?, ?, ?)",
+        (user['user_id'], user['email'], user.get('password'))
+    )
+    return user
+
+def get_user(user_id):
+    row = _get_connection().execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+    return to_item(row) if row else None
+
+def get_existing_user_ids(user_ids):
+    # Chunked to stay under SQLite's bound parameter limit
+    connection = _get_connection()
+    existing = set()
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        existing.update(row['user_id'] for row in connection.execute(
+            f"SELECT user_id FROM users WHERE user_id IN ({placeholders})", chunk
+        ))
+    return existing
+
+def get_all_users():
+    return [to_item(row) for row in _get_connection().execute("SELECT * FROM users")]
+
+def get_user_by_email(email):
+    row = _get_connection().execute(
+        "SELECT users.* FROM user_emails JOIN users USING (user_id) WHERE user_emails.email = ?", (email,)
+    ).fetchone()
+    return to_item(row) if row else None
+
+# User emails table interfaces
+def reserve_email(email, user_id):
+    # The primary key makes the insert the reservation, concurrent registrations can't both win
+    cursor = _get_connection().execute("INSERT OR IGNORE INTO user_emails (email, user_id) VALUES (?, ?)", (email, user_id))
+    return cursor.rowcount == 1
+
+def release_email(email):
+    _get_connection().execute("DELETE FROM user_emails WHERE email = ?", (email,))
+
+def get_email_reservation(email):
+    row = _get_connection().execute("SELECT * FROM user_emails WHERE email = ?", (email,)).fetchone()
+    return to_item(row) if row else None
+
+# Messages tables interfaces
+def create_message(message):
+    message = prepare_message(message)
+    _get_connection().execute(INSERT_MESSAGE, message_row(message))
+    return message
+
+def create_messages(messages):
+    # One transaction and one prepared statement for the whole batch. All or nothing, so
+    # unlike DynamoDB there are never unwritten messages to return
+    with _transaction() as connection:
+        connection.executemany(INSERT_MESSAGE, [message_row(prepare_message(message)) for message in messages])
+    return []
+
+def create_messages_once(messages):
+    # Write-behind persistence, safe to replay. Messages, chat metadata and inbox entries are
+    # written in one transaction and only the messages not stored yet are counted, so a
+    # message_id is counted once however often the outbox hands it over. Returns
+    # {chat_id: message_count} of the chats that got new messages
+    messages = sorted((prepare_message(message) for message in messages), key=lambda message: message['sort_key'])
+    counts = {}
+    with _transaction() as connection:
+        stored = [message for message in messages if connection.execute(INSERT_NEW_MESSAGE, message_row(message)).rowcount]
+        by_chat = {}
+        for message in stored:
+            by_chat.setdefault(message['chat_id'], []).append(message)
+        for chat_id, items in by_chat.items():
+            first, last = items[0], items[-1]
+            counts[chat_id] = _record_chat_message(
+                connection, (chat_id, len(items), first['message_id'], last['message_id'], last['timestamp'], last['sort_key'])
+            )
+        connection.executemany(RECORD_INBOX_MESSAGE, _inbox_rows(get_inbox_updates(stored)))
+    return counts
+
+def get_chat_messages(chat_id, limit=None, before=None):
+    # Last `limit` messages of a conversation (all of them without a limit), oldest first
+    if before:
+        rows = _get_connection().execute(
+            f"{MESSAGE_SELECT} WHERE chat_id = ? AND sort_key < ? ORDER BY sort_key DESC LIMIT ?",
+            (chat_id, before, limit or -1)
+        )
+    else:
+        rows = _get_connection().execute(
+            f"{MESSAGE_SELECT} WHERE chat_id = ? ORDER BY sort_key DESC LIMIT ?",
+            (chat_id, limit or -1)
+        )
+    items = [to_item(row) for row in rows]
+    items.reverse()
+    return items
+
+def get_user_chats(user_id, chat_id, limit=None):
+    return get_chat_messages(get_conversation_id(user_id, chat_id), limit)
+
+def get_messages_for_user(user_id, limit=None, before=None, since=None, cursor=None):
+    # Newest first, one index range scan. The cursor is the (timestamp, chat_id, sort_key)
+    # of the last message returned, the index already orders by exactly that
+    limit = min(limit or config.MESSAGES_PAGE_SIZE, config.MESSAGES_MAX_PAGE_SIZE)
+    conditions, params = ["receiver_id = ?"], [user_id]
+    if since:
+        conditions.append("timestamp >= ?")
+        params.append(since)
+    if before:
+        conditions.append("timestamp < ?")
+        params.append(before)
+    if cursor:
+        state = decode_cursor(cursor)
+        if not isinstance(state.get('after'), list) or len(state['after']) != 3:
+            raise ValueError("Invalid cursor")
+        conditions.append("(timestamp, chat_id, sort_key) < (?, ?, ?)")
+        params.extend(state['after'])
+    params.append(limit)
+    rows = _get_connection().execute(
+        f"{MESSAGE_SELECT} WHERE {' AND '.join(conditions)} ORDER BY timestamp DESC, chat_id DESC, sort_key DESC LIMIT ?",
+        params
+    )
+    messages = [to_item(row) for row in rows]
+    next_cursor = None
+    if len(messages) == limit:
+        last = messages[-1]
+        next_cursor = encode_cursor({'after': [last['timestamp'], last['chat_id'], last['sort_key']]})
+    return messages, next_cursor
+
+def get_messages_since(user_id, since, limit):
+    # Oldest first, up to limit messages the user received at or after since (inclusive)
+    rows = _get_connection().execute(
+        f"{MESSAGE_SELECT} WHERE receiver_id = ? AND timestamp >= ? ORDER BY timestamp, chat_id, sort_key LIMIT ?",
+        (user_id, since, limit)
+    )
+    return [to_item(row) for row in rows]
+
+# Chat Metadata table interfaces
+def get_chat_metadata(chat_id):
+    row = _get_connection().execute("SELECT * FROM chat_metadata WHERE chat_id = ?", (chat_id,)).fetchone()
+    return to_item(row) if row else None
+
+RECORD_CHAT_MESSAGE = """
+INSERT INTO chat_metadata (chat_id, message_count, start_index, end_index, latest_timestamp, latest_sort_key)
+VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (chat_id) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    end_index = CASE WHEN excluded.latest_sort_key > latest_sort_key THEN excluded.end_index ELSE end_index END,
+    latest_timestamp = CASE WHEN excluded.latest_sort_key > latest_sort_key THEN excluded.latest_timestamp ELSE latest_timestamp END,
+    latest_sort_key = MAX(latest_sort_key, excluded.latest_sort_key)
+"""
+
+def record_chat_message(chat_id, message_id, timestamp, count=1, first_message_id=None):
+    # Single upsert, returns the chat's message count after these `count` messages, message_id being the newest
+    params = (chat_id, count, first_message_id or message_id, message_id, timestamp, make_sort_key(timestamp, message_id))
+    if HAS_RETURNING:
+        return _record_chat_message(_get_connection(), params)
+    with _transaction() as connection:
+        return _record_chat_message(connection, params)
+
+def _record_chat_message(connection, params):
+    # The latest message only moves forward, so batches applied out of order leave the newest
+    if HAS_RETURNING:
+        return connection.execute(RECORD_CHAT_MESSAGE + " RETURNING message_count", params).fetchone()[0]
+    connection.execute(RECORD_CHAT_MESSAGE, params)
+    return connection.execute("SELECT message_count FROM chat_metadata WHERE chat_id = ?", (params[0],)).fetchone()[0]
+
+def record_archived_messages(chat_id, archived_count):
+    with _transaction() as connection:
+        connection.execute(
+            "UPDATE chat_metadata SET message_count = message_count - ?, archived_count = archived_count + ? WHERE chat_id = ?",
+            (archived_count, archived_count, chat_id)
+        )
+        row = connection.execute("SELECT message_count FROM chat_metadata WHERE chat_id = ?", (chat_id,)).fetchone()
+    return row[0] if row else 0
+
+# Archive interfaces. SQLite keeps the whole history, nothing moves to S3
+def backup_and_delete_old_messages(user_id, chat_id, message_count):
+    return 0
+
+def get_archived_messages(chat_id, limit, before=None):
+    return []
+
+# Block table interfaces
+def create_block(block):
+    _get_connection().execute(
+        "INSERT OR REPLACE INTO user_blocks (blocker_id, blocked_id, block_id) VALUES (?, ?, ?)",
+        (block['blocker_id'], block['blocked_id'], block['block_id'])
+    )
+    return block
+
+def get_block(sender_id, receiver_id):
+    # A message is blocked when the receiver has blocked the sender
+    row = _get_connection().execute(
+        "SELECT * FROM user_blocks WHERE blocker_id = ? AND blocked_id = ?", (receiver_id, sender_id)
+    ).fetchone()
+    return to_item(row) if row else None
+
+def get_blocked_ids(blocker_id):
+    rows = _get_connection().execute("SELECT blocked_id FROM user_blocks WHERE blocker_id = ?", (blocker_id,))
+    return [row[0] for row in rows]
+
+# Group table interfaces
+def create_group(group):
+    _get_connection().execute(
+        "INSERT OR REPLACE INTO chat_groups (group_id, name) VALUES (?, ?)", (group['group_id'], group.get('name'))
+    )
+    return group
+
+def get_group(group_id):
+    row = _get_connection().execute("SELECT * FROM chat_groups WHERE group_id = ?", (group_id,)).fetchone()
+    return to_item(row) if row else None
+
+def add_user_to_group(group_member):
+    # Callers check that the group and the user exist. {} when the user already is a member
+    group_member.setdefault('joined_at', datetime.now(timezone.utc).isoformat())
+    with _transaction() as connection:
+        cursor = connection.execute(
+            "INSERT OR IGNORE INTO group_members (group_id, user_id, joined_at) VALUES (?, ?, ?)",
+            (group_member['group_id'], group_member['user_id'], group_member['joined_at'])
+        )
+        if cursor.rowcount == 0:
+            return {}
+        connection.execute(
+            "UPDATE chat_groups SET member_count = member_count + 1 WHERE group_id = ?", (group_member['group_id'],)
+        )
+    return group_member
+
+def remove_user_from_group(group_id, user_id):
+    # Callers check that the group exists
+    with _transaction() as connection:
+        cursor = connection.execute("DELETE FROM group_members WHERE group_id = ? AND user_id = ?", (group_id, user_id))
+        if cursor.rowcount:
+            connection.execute("UPDATE chat_groups SET member_count = member_count - 1 WHERE group_id = ?", (group_id,))
+    return {"removed": cursor.rowcount > 0}
+
+def get_group_members(group_id):
+    return [to_item(row) for row in _get_connection().execute("SELECT * FROM group_members WHERE group_id = ?", (group_id,))]
+
+def get_user_groups(user_id):
+    return [to_item(row) for row in _get_connection().execute("SELECT * FROM group_members WHERE user_id = ?", (user_id,))]
+
+# Inbox interfaces. The summary columns only move forward, a late older message just adds to unread_count
+INBOX_SUMMARY = [column for column in INBOX_COLUMNS if column not in ('user_id', 'chat_id')]
+INSERT_INBOX = f"""
+INSERT INTO inbox ({', '.join(INBOX_COLUMNS)}, unread_count) VALUES ({', '.join('?' * (len(INBOX_COLUMNS) + 1))})
+ON CONFLICT (user_id, chat_id) DO UPDATE SET
+"""
+RECORD_INBOX_MESSAGE = INSERT_INBOX + ",\n".join(
+    [f"    {column} = CASE WHEN excluded.last_sort_key > last_sort_key THEN excluded.{column} ELSE {column} END" for column in INBOX_SUMMARY]
+    + ["    unread_count = unread_count + excluded.unread_count"]
+)
+def _inbox_rows(updates):
+    return [inbox_row(make_inbox_item(update['user_id'], update['message'])) + (update['unread'],) for update in updates]
+
+def record_inbox_messages(updates):
+    with _transaction() as connection:
+        connection.executemany(RECORD_INBOX_MESSAGE, _inbox_rows(updates))
+
+def get_inbox(user_id, limit=None):
+    # Newest first, one range of the (user_id, last_sort_key) index
+    limit = min(limit or config.INBOX_PAGE_SIZE, config.INBOX_MAX_PAGE_SIZE)
+    rows = _get_connection().execute(
+        "SELECT * FROM inbox WHERE user_id = ? ORDER BY last_sort_key DESC LIMIT ?", (user_id, limit)
+    )
+    return [to_item(row) for row in rows]
+
+def mark_inbox_read(user_id, chat_id):
+    cursor = _get_connection().execute("UPDATE inbox SET unread_count = 0 WHERE user_id = ? AND chat_id = ?", (user_id, chat_id))
+    return cursor.rowcount > 0
+
+def create_message_for_group(message, group_id, member_ids=None):
+    # Always fan-out-on-write: a copy per member is one executemany in one local transaction,
+    # cheap enough that SQLite needs no timeline mode
+    start = time.perf_counter()
+    if isinstance(message['timestamp'], datetime):
+        message['timestamp'] = message['timestamp'].isoformat()
+    if member_ids is None:
+        member_ids = [member['user_id'] for member in get_group_members(group_id)]
+    copies = make_group_copies(message, group_id, member_ids)
+    create_messages(copies)
+    record_inbox_messages(get_inbox_updates(copies))
+    elapsed = time.perf_counter() - start
+    stats = {
+        "items": len(copies),
+        "batches": 1,
+        "failed": 0,
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "items_per_second": round(len(copies) / elapsed, 2) if elapsed > 0 else None,
+        "mode": "fanout",
+        "group_id": group_id
+    }
+    logger.info("Group fan-out: %s", stats)
+    return stats
+
+metrics.instrument_functions(globals(), "sqlite")
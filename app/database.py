@@ -1,12 +1,7 @@
-import boto3
 from botocore.exceptions import ClientError
-from config import config
+from clients import get_dynamodb
 
-dynamodb = boto3.resource(
-    'dynamodb',
-    endpoint_url=config.DYNAMODB_ENDPOINT_URL,
-    region_name=config.DYNAMODB_REGION
-)
+# Schema provisioning, run explicitly with `python database.py` (never on Lambda cold start)
 
 def create_table(table_name, key_schema, attribute_definitions, provisioned_throughput, global_secondary_indexes=None):
     try:
@@ -18,7 +13,7 @@ def create_table(table_name, key_schema, attribute_definitions, provisioned_thro
         }
         if global_secondary_indexes:
             params['GlobalSecondaryIndexes'] = global_secondary_indexes
-        table = dynamodb.create_table(**params)
+        table = get_dynamodb().create_table(**params)
         table.meta.client.get_waiter('table_exists').wait(TableName=table_name)
         print(f"Table {table_name} created successfully.")
     except ClientError as e:
@@ -48,23 +43,39 @@ def init_db():
                 'WriteCapacityUnits': 5
             }
         )
-    #Create messages table
+    #Create chat messages table, partitioned by conversation and sorted by time
     create_table(
-        table_name='messages',
+        table_name='chat_messages',
         key_schema=[
             {
-                'AttributeName': 'message_id',
+                'AttributeName': 'chat_id',
                 'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'sort_key',
+                'KeyType': 'RANGE'
             }
         ],
         attribute_definitions=[
             {
-                'AttributeName': 'message_id',
+                'AttributeName': 'chat_id',
                 'AttributeType': 'S'
-            }, 
+            },
+            {
+                'AttributeName': 'sort_key',
+                'AttributeType': 'S'
+            },
             {
                 'AttributeName': 'sender_id',
                 'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'receiver_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'timestamp',
+                'AttributeType': 'S'
             }
         ],
         provisioned_throughput={
@@ -72,12 +83,36 @@ def init_db():
             'WriteCapacityUnits': 5
         }, 
         global_secondary_indexes=[
+            {
+                'IndexName': 'receiver_id-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'receiver_id',
+                        'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'timestamp',
+                        'KeyType': 'RANGE'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            },
             {
                 'IndexName': 'sender_id-index',
                 'KeySchema': [
                     {
                         'AttributeName': 'sender_id',
                         'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'timestamp',
+                        'KeyType': 'RANGE'
                     }
                 ],
                 'Projection': {
@@ -103,12 +138,34 @@ def init_db():
             {
                 'AttributeName': 'chat_id',
                 'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'dirty_shard',
+                'AttributeType': 'N'
             }
         ],
         provisioned_throughput={
             'ReadCapacityUnits': 5,
             'WriteCapacityUnits': 5
-        }
+        },
+        global_secondary_indexes=[
+            {
+                'IndexName': 'dirty_shard-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'dirty_shard',
+                        'KeyType': 'HASH'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ]
     )
     #Create group members table
     create_table(
@@ -133,6 +190,52 @@ def init_db():
                 'AttributeType': 'S'
             }
         ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        },
+        global_secondary_indexes=[
+            {
+                'IndexName': 'user_id-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'user_id',
+                        'KeyType': 'HASH'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ]
+    )
+    #Create group timeline table for groups above the fan-out threshold
+    create_table(
+        table_name='group_timeline',
+        key_schema=[
+            {
+                'AttributeName': 'group_id',
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'sort_key',
+                'KeyType': 'RANGE'
+            }
+        ],
+        attribute_definitions=[
+            {
+                'AttributeName': 'group_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'sort_key',
+                'AttributeType': 'S'
+            }
+        ],
         provisioned_throughput={
             'ReadCapacityUnits': 5,
             'WriteCapacityUnits': 5
@@ -158,18 +261,26 @@ def init_db():
             'WriteCapacityUnits': 5
         }
     )
-    #Create blocks members table
+    #Create user blocks table, one item collection per blocker
     create_table(
-        table_name='blocks',
+        table_name='user_blocks',
         key_schema=[
             {
-                'AttributeName': 'block_id',
+                'AttributeName': 'blocker_id',
                 'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'blocked_id',
+                'KeyType': 'RANGE'
             }
         ],
         attribute_definitions=[
             {
-                'AttributeName': 'block_id',
+                'AttributeName': 'blocker_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'blocked_id',
                 'AttributeType': 'S'
             }
         ],
@@ -178,3 +289,136 @@ def init_db():
             'WriteCapacityUnits': 5
         }
     )
+    #Create user emails table
+    create_table(
+        table_name='user_emails',
+        key_schema=[
+            {
+                'AttributeName': 'email',
+                'KeyType': 'HASH'
+            }
+        ],
+        attribute_definitions=[
+            {
+                'AttributeName': 'email',
+                'AttributeType': 'S'
+            }
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+    #Create inbox table, one summary per user and conversation, listed newest first by the index
+    create_table(
+        table_name='user_inbox',
+        key_schema=[
+            {
+                'AttributeName': 'user_id',
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'chat_id',
+                'KeyType': 'RANGE'
+            }
+        ],
+        attribute_definitions=[
+            {
+                'AttributeName': 'user_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'chat_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'last_sort_key',
+                'AttributeType': 'S'
+            }
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        },
+        global_secondary_indexes=[
+            {
+                'IndexName': 'user_id-last_sort_key-index',
+                'KeySchema': [
+                    {
+                        'AttributeName': 'user_id',
+                        'KeyType': 'HASH'
+                    },
+                    {
+                        'AttributeName': 'last_sort_key',
+                        'KeyType': 'RANGE'
+                    }
+                ],
+                'Projection': {
+                    'ProjectionType': 'ALL'
+                },
+                'ProvisionedThroughput': {
+                    'ReadCapacityUnits': 5,
+                    'WriteCapacityUnits': 5
+                }
+            }
+        ]
+    )
+    #Create archive manifest table, maps archived time ranges to S3 byte ranges
+    create_table(
+        table_name='archive_manifest',
+        key_schema=[
+            {
+                'AttributeName': 'chat_id',
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'start_sort_key',
+                'KeyType': 'RANGE'
+            }
+        ],
+        attribute_definitions=[
+            {
+                'AttributeName': 'chat_id',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'start_sort_key',
+                'AttributeType': 'S'
+            }
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+    #Create archive days table, the user/day prefixes of archive objects waiting for compaction
+    create_table(
+        table_name='archive_days',
+        key_schema=[
+            {
+                'AttributeName': 'day',
+                'KeyType': 'HASH'
+            },
+            {
+                'AttributeName': 'user_id',
+                'KeyType': 'RANGE'
+            }
+        ],
+        attribute_definitions=[
+            {
+                'AttributeName': 'day',
+                'AttributeType': 'S'
+            },
+            {
+                'AttributeName': 'user_id',
+                'AttributeType': 'S'
+            }
+        ],
+        provisioned_throughput={
+            'ReadCapacityUnits': 5,
+            'WriteCapacityUnits': 5
+        }
+    )
+
+if __name__ == "__main__":
+    init_db()
@@ -0,0 +1,57 @@
+import logging
+import random
+import time
+from functools import partial
+from config import config
+import metrics
+from clients import get_dynamodb
+
+logger = logging.getLogger()
+
+# BatchWriteItem accepts at most 25 put/delete requests per call
+BATCH_WRITE_SIZE = 25
+
+# Shared across warm invocations so the pool is bounded per container, not per request
+executor = metrics.Executor(max_workers=config.FANOUT_MAX_WORKERS)
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def batch_write(table_name, requests):
+    # Returns the requests still unprocessed after all retries
+    pending = requests
+    for attempt in range(config.FANOUT_MAX_RETRIES + 1):
+        response = get_dynamodb().meta.client.batch_write_item(RequestItems={table_name: pending})
+        pending = response.get('UnprocessedItems', {}).get(table_name, [])
+        if not pending:
+            return []
+        if attempt < config.FANOUT_MAX_RETRIES:
+            backoff = min(config.FANOUT_BACKOFF_BASE_MS * (2 ** attempt), 1000) / 1000
+            time.sleep(random.uniform(0, backoff))
+    logger.error("Batch write to %s left %d requests unprocessed", table_name, len(pending))
+    return pending
+
+def put_items(table_name, items):
+    # Puts the items in parallel batches, returns the ones still unprocessed after all retries
+    batches = [
+        [{'PutRequest': {'Item': item}} for item in chunk]
+        for chunk in chunked(items, BATCH_WRITE_SIZE)
+    ]
+    return [
+        request['PutRequest']['Item']
+        for unprocessed in executor.map(partial(batch_write, table_name), batches)
+        for request in unprocessed
+    ]
+
+def fan_out(table_name, items):
+    start = time.perf_counter()
+    failed = len(put_items(table_name, items))
+    elapsed = time.perf_counter() - start
+    return {
+        "items": len(items),
+        "batches": -(-len(items) // BATCH_WRITE_SIZE),
+        "failed": failed,
+        "elapsed_ms": round(elapsed * 1000, 2),
+        "items_per_second": round(len(items) / elapsed, 2) if elapsed > 0 else None
+    }
@@ -0,0 +1,314 @@
+import logging
+from datetime import datetime, timezone
+from uuid import uuid4
+from config import config
+from schemas import MessageCreate, GroupMessageCreate, UserCreate, BlockCreate, GroupCreate, GroupMemberCreate
+from storage import *
+from cache import *
+from router import route, respond, HTTPError
+import aio
+import outbox
+import sync
+
+logger = logging.getLogger()
+
+# Configurable parameters
+X = config.CACHE_LAST_X_MESSAGES
+Y = config.DB_LAST_Y_MESSAGES
+Z = config.S3_RETENTION_DAYS
+DB_LIMIT = config.DB_LIMIT
+
+def get_limit(params):
+    # The page size of the read routes, absent means the route's default
+    if not params.get('limit'):
+        return None
+    try:
+        limit = int(params['limit'])
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise HTTPError(400, "Invalid request: limit must be a positive integer")
+    return limit
+
+# Each handler takes a router.Request and returns the response payload (sent with status 200),
+# a router.respond(...) response, or raises router.HTTPError
+
+@route("POST", "/register")
+def register(request):
+    body = request.body
+    body['user_id'] = str(uuid4())
+    user = UserCreate(**body)
+    if not reserve_email(user.email, user.user_id):
+        raise HTTPError(400, "Email already registered")
+    try:
+        new_user = create_user(user.dict())
+    except Exception:
+        release_email(user.email)
+        raise
+    remember_users([user.user_id])
+    return respond(new_user, user_id=user.user_id)
+
+@route("POST", "/send_message")
+def send_message(request):
+    body = request.body
+    body['message_id'] = str(uuid4())
+    body['timestamp'] = datetime.now(timezone.utc).isoformat()
+    message = MessageCreate(**body)
+    return aio.run(send_message_async(message))
+
+async def send_message_async(message):
+    # The checks run concurrently, then the cache, message and metadata writes do
+    await check_send(message)
+    cache_key = get_cache_key(message.sender_id, message.receiver_id)
+    message_item = prepare_message(message.dict())
+    if config.SEND_MODE == 'write_behind':
+        # Acknowledged once queued and cached, the outbox worker writes it to the DB. Cached only
+        # after the queue took it, a failed enqueue must not leave a message readers see
+        add_pending_message(cache_key, message_item)
+        await aio.call(enqueue_message, cache_key, message_item)
+        await aio.call(cache_recent_message, cache_key, message_item)
+        return respond(message_item, 202)
+
+    # Save to cache and DB
+    _, new_message, message_count, _ = await aio.gather(
+        (cache_recent_message, cache_key, message_item),
+        (create_message, dict(message_item)),
+        (record_chat_message, message_item['chat_id'], message.message_id, message_item['timestamp']),
+        (record_inbox_messages, get_inbox_updates([message_item]))
+    )
+    # Only once stored, a woken sync reads the DB
+    sync.notify([message.receiver_id])
+    archive_if_full(message.sender_id, message.receiver_id, message_item['chat_id'], message_count)
+    return new_message
+
+async def check_send(message):
+    missing_users, blocked = await aio.gather(
+        (get_missing_users, [message.sender_id, message.receiver_id]),
+        (is_blocked, message.sender_id, message.receiver_id)
+    )
+    #Validate that users exists
+    if missing_users:
+        raise HTTPError(404, "One of the users not exists")
+    #Validate that sender is not blocked
+    if blocked:
+        raise HTTPError(403, "Message been blocked by user")
+
+def cache_recent_message(cache_key, message_item):
+    if not append_recent_message(cache_key, message_item):
+        # Not cached, seed the list with the last X messages of the conversation from DB. The
+        # message is written concurrently, so the DB may or may not return it already, the seed
+        # drops duplicates by message_id
+        recent_messages = get_user_chats(message_item['sender_id'], message_item['receiver_id'], limit=X)
+        seed_recent_messages(cache_key, recent_messages + [message_item])
+
+def enqueue_message(cache_key, message_item):
+    try:
+        outbox.get_outbox().put(message_item)
+    except Exception:
+        discard_pending_messages(cache_key, [message_item])
+        raise
+    outbox.start_worker(persist_queued_messages)
+
+def persist_queued_messages(messages):
+    # Outbox worker side of write-behind sends, safe to replay: create_messages_once counts
+    # every message_id once, however often a batch is handed over
+    message_counts = create_messages_once([dict(message) for message in messages])
+    sync.notify([message['receiver_id'] for message in messages])
+    by_conversation = {}
+    for message in messages:
+        by_conversation.setdefault(message['chat_id'], []).append(message)
+    for chat_id, items in by_conversation.items():
+        first = items[0]
+        if chat_id in message_counts:
+            archive_if_full(first['sender_id'], first['receiver_id'], chat_id, message_counts[chat_id])
+        discard_pending_messages(get_cache_key(first['sender_id'], first['receiver_id']), items)
+
+def archive_if_full(sender_id, receiver_id, chat_id, message_count):
+    # Only one send per chat archives at a time, the rest carry on while it runs
+    lock = get_archive_lock(chat_id)
+    if ARCHIVES_HISTORY and message_count >= DB_LIMIT and acquire_lock(lock, config.ARCHIVE_LOCK_TTL):
+        try:
+            archived_count = backup_and_delete_old_messages(sender_id, receiver_id, message_count)
+            record_archived_messages(chat_id, archived_count)
+        finally:
+            release_lock(lock)
+
+@route("POST", "/send_messages")
+def send_messages(request):
+    # Bulk send for bridges and bots. Every entry gets its own result, a bad entry never fails
+    # the others. Users, blocks, cache updates and metadata are handled once per distinct
+    # user, pair or conversation rather than once per message
+    entries = request.body['messages']
+    if not isinstance(entries, list) or not entries:
+        raise ValueError("messages must be a non-empty list")
+    if len(entries) > config.SEND_MESSAGES_MAX_BATCH:
+        raise HTTPError(413, f"At most {config.SEND_MESSAGES_MAX_BATCH} messages per request")
+
+    results = [None] * len(entries)
+    accepted = []
+    for index, entry in enumerate(entries):
+        try:
+            entry = dict(entry, message_id=str(uuid4()), timestamp=datetime.now(timezone.utc).isoformat())
+            accepted.append((index, prepare_message(MessageCreate(**entry).dict())))
+        except (TypeError, ValueError) as e:
+            results[index] = {"index": index, "status": 400, "detail": f"Invalid message: {e}"}
+
+    user_ids = {user_id for _, item in accepted for user_id in (item['sender_id'], item['receiver_id'])}
+    missing_users = get_missing_users(user_ids)
+    blocked = get_blocked_pairs([
+        (item['sender_id'], item['receiver_id']) for _, item in accepted
+        if item['sender_id'] not in missing_users and item['receiver_id'] not in missing_users
+    ])
+    valid = []
+    for index, item in accepted:
+        if item['sender_id'] in missing_users or item['receiver_id'] in missing_users:
+            results[index] = {"index": index, "status": 404, "detail": "One of the users not exists"}
+        elif (item['sender_id'], item['receiver_id']) in blocked:
+            results[index] = {"index": index, "status": 403, "detail": "Message been blocked by user"}
+        else:
+            valid.append((index, item))
+
+    failed = {message['message_id'] for message in create_messages([dict(item) for _, item in valid])}
+    by_conversation = {}
+    for index, item in valid:
+        if item['message_id'] in failed:
+            results[index] = {"index": index, "status": 500, "detail": "Message not stored"}
+            continue
+        results[index] = {"index": index, "status": 200, "message_id": item['message_id'], "timestamp": item['timestamp']}
+        by_conversation.setdefault(item['chat_id'], []).append(item)
+
+    stored_items = [item for items in by_conversation.values() for item in items]
+    record_inbox_messages(get_inbox_updates(stored_items))
+    sync.notify([item['receiver_id'] for item in stored_items])
+    # Conversations not in the cache are seeded from DB, which already holds this batch
+    cache_keys = {get_cache_key(items[0]['sender_id'], items[0]['receiver_id']): items for items in by_conversation.values()}
+    for cache_key in append_recent_messages(cache_keys):
+        items = cache_keys[cache_key]
+        seed_recent_messages(cache_key, get_user_chats(items[0]['sender_id'], items[0]['receiver_id'], limit=X))
+
+    for chat_id, items in by_conversation.items():
+        first, last = items[0], items[-1]
+        message_count = record_chat_message(
+            chat_id, last['message_id'], last['timestamp'], count=len(items), first_message_id=first['message_id']
+        )
+        archive_if_full(last['sender_id'], last['receiver_id'], chat_id, message_count)
+
+    stored = sum(1 for result in results if result["status"] == 200)
+    return {"stored": stored, "rejected": len(results) - stored, "results": results}
+
+@route("POST", "/block_user")
+def block_user(request):
+    body = request.body
+    if 'blocked_id' not in body or 'blocker_id' not in body:
+        raise HTTPError(404, "One of the users is not exist")
+    if get_missing_users([body['blocked_id'], body['blocker_id']]):
+        raise HTTPError(404, "One of the users not exists")
+    body['block_id'] = make_block_id(body['blocker_id'], body['blocked_id'])
+    block = BlockCreate(**body)
+    new_block = create_block(block.dict())
+    invalidate_blocklist(block.blocker_id)
+    return new_block
+
+@route("POST", "/create_group")
+def create_group_route(request):
+    body = request.body
+    body['group_id'] = str(uuid4())
+    group = GroupCreate(**body)
+    creator_id = body.get("creator_id")
+    if creator_id is not None and get_missing_users([creator_id]):
+        raise HTTPError(404, "User not found.")
+    new_group = create_group(group.dict())
+    if creator_id is None:
+        set_group_members(group.group_id, [])
+        return respond(new_group, group_id=group.group_id)
+    #Add the creator to the group.
+    group_member = GroupMemberCreate(group_id=group.group_id, user_id=creator_id)
+    add_user_to_group(group_member.dict())
+    set_group_members(group.group_id, [creator_id])
+    return respond(new_group, group_id=group.group_id, creator_id=creator_id)
+
+@route("POST", "/add_user_to_group")
+def add_user_to_group_route(request):
+    group_member = GroupMemberCreate(**request.body)
+    if get_missing_users([group_member.user_id]):
+        raise HTTPError(404, "User not found.")
+    if not group_exists(group_member.group_id):
+        raise HTTPError(404, "Group ID not found.")
+    if add_user_to_group(group_member.dict()):
+        update_group_members(group_member.group_id, added=[group_member.user_id])
+    return {"detail": "User added to group"}
+
+@route("POST", "/remove_user_from_group")
+def remove_user_from_group_route(request):
+    body = request.body
+    group_id, user_id = body['group_id'], body['user_id']
+    if not group_exists(group_id):
+        raise HTTPError(404, "Group ID not found.")
+    remove_user_from_group(group_id, user_id)
+    update_group_members(group_id, removed=[user_id])
+    return {"detail": "User removed from group"}
+
+@route("POST", "/send_message_to_group")
+def send_message_to_group(request):
+    body = request.body
+    body['message_id'] = str(uuid4())
+    body['timestamp'] = datetime.now(timezone.utc).isoformat()
+    # Validated before the fan-out, so a bad body never leaves some members' copies written
+    message_data = GroupMessageCreate(**body).dict()
+    group_id = message_data.pop('group_id')
+    member_ids = get_group_member_ids(group_id)
+    if member_ids is None:
+        raise HTTPError(404, "Group ID not found.")
+    logger.info("Creating message for group %s", group_id)
+    fanout_stats = create_message_for_group(message_data, group_id, member_ids)
+    sync.notify(group_ids=[group_id])
+    if fanout_stats['failed']:
+        return respond({"detail": "Message not delivered to all group members", "fanout": fanout_stats}, 500)
+    return {"detail": "Message sent to group", "fanout": fanout_stats}
+
+@route("GET", "/get_messages")
+def get_messages(request):
+    params = request.params
+    user_id = params['user_id']
+    limit = get_limit(params)
+    if params.get('chat_id'):
+        messages, next_cursor = get_chat_history(
+            user_id,
+            params['chat_id'],
+            limit=limit,
+            cursor=params.get('cursor')
+        )
+    else:
+        messages, next_cursor = get_messages_for_user(
+            user_id,
+            limit=limit,
+            before=params.get('before'),
+            since=params.get('since'),
+            cursor=params.get('cursor')
+        )
+    return {"messages": messages, "next_cursor": next_cursor}
+
+@route("GET", "/sync")
+def sync_route(request):
+    # Only the messages received after the cursor, optionally long-polling for them
+    params = request.params
+    return sync.sync(
+        params['user_id'],
+        cursor=params.get('cursor'),
+        since=params.get('since'),
+        limit=get_limit(params),
+        wait=float(params['wait']) if params.get('wait') else 0
+    )
+
+@route("GET", "/get_inbox")
+def get_inbox_route(request):
+    # The conversation list: newest message preview, its time and the unread count per conversation
+    params = request.params
+    return {"conversations": get_inbox(params['user_id'], limit=get_limit(params))}
+
+@route("POST", "/mark_read")
+def mark_read(request):
+    body = request.body
+    if not mark_inbox_read(body['user_id'], body['chat_id']):
+        raise HTTPError(404, "Conversation not found.")
+    return {"detail": "Conversation marked as read"}
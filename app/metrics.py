@@ -0,0 +1,199 @@
+import json
+import logging
+import time
+from collections import defaultdict, deque
+from functools import wraps
+from inspect import isfunction, isgeneratorfunction
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+from config import config
+
+# Per-request backend call counts and latencies, emitted as one "Metrics:" log line per request.
+# When METRICS_ENABLED is off nothing is wrapped or hooked and every entry point returns right
+# after one attribute check.
+
+logger = logging.getLogger()
+
+enabled = config.METRICS_ENABLED
+
+# DynamoDB operations that accept ReturnConsumedCapacity
+CAPACITY_OPERATIONS = {
+    'GetItem', 'PutItem', 'UpdateItem', 'DeleteItem', 'Query', 'Scan',
+    'BatchGetItem', 'BatchWriteItem', 'TransactGetItems', 'TransactWriteItems'
+}
+
+# Recent request latencies per route, for the p50/p99 of this container
+latencies = defaultdict(lambda: deque(maxlen=config.METRICS_WINDOW))
+
+# The request being recorded by each thread. Tasks of an Executor record into the request of
+# the thread that submitted them, other threads (the outbox worker) record nothing
+_local = local()
+
+# Called with every finished request's record, e.g. by the benchmarks
+listeners = []
+
+class Recorder:
+    def __init__(self, route):
+        self.route = route
+        self.start = time.perf_counter()
+        self.lock = Lock()
+        self.calls = defaultdict(lambda: [0, 0.0])
+        self.counters = defaultdict(int)
+        self.capacity = defaultdict(float)
+
+    def add_call(self, name, seconds):
+        with self.lock:
+            call = self.calls[name]
+            call[0] += 1
+            call[1] += seconds
+
+    def add_capacity(self, consumed):
+        # ConsumedCapacity is a dict for single table calls and a list for batch calls
+        for entry in consumed if isinstance(consumed, list) else [consumed]:
+            with self.lock:
+                self.capacity[entry.get('TableName', '?')] += entry.get('CapacityUnits', 0)
+
+    def finish(self, status):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        window = latencies[self.route]
+        window.append(elapsed_ms)
+        ordered = sorted(window)
+        return {
+            "route": self.route,
+            "status": status,
+            "duration_ms": round(elapsed_ms, 2),
+            "calls": {name: {"count": count, "ms": round(seconds * 1000, 2)} for name, (count, seconds) in self.calls.items()},
+            "counters": dict(self.counters),
+            "consumed_capacity": dict(self.capacity),
+            "p50_ms": round(percentile(ordered, 50), 2),
+            "p99_ms": round(percentile(ordered, 99), 2),
+            "window": len(ordered)
+        }
+
+class Executor(ThreadPoolExecutor):
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(_run_for, get_current(), fn, *args, **kwargs)
+
+def _run_for(recorder, fn, *args, **kwargs):
+    previous = get_current()
+    _local.recorder = recorder
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _local.recorder = previous
+
+def get_current():
+    return getattr(_local, 'recorder', None)
+
+def percentile(ordered, p):
+    # Nearest-rank percentile of an already sorted list
+    if not ordered:
+        return 0.0
+    return ordered[max(0, -(-len(ordered) * p // 100) - 1)]
+
+def begin(route):
+    _local.recorder = Recorder(route)
+    return _local.recorder
+
+def end(recorder, status):
+    _local.recorder = None
+    record = recorder.finish(status)
+    logger.info("Metrics: %s", json.dumps(record))
+    for listener in listeners:
+        listener(record)
+    return record
+
+def record_call(name, seconds):
+    recorder = get_current()
+    if recorder is not None:
+        recorder.add_call(name, seconds)
+
+def incr(counter, value=1):
+    recorder = get_current()
+    if recorder is not None:
+        with recorder.lock:
+            recorder.counters[counter] += value
+
+def timed(name, function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        if get_current() is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record_call(name, time.perf_counter() - start)
+    return wrapper
+
+def instrument_functions(namespace, prefix, names=None):
+    # Wraps the public functions defined in a module (or just `names`) in place. Callers that
+    # imported them with `from module import *` afterwards get the wrapped versions
+    if not enabled:
+        return
+    module = namespace['__name__']
+    for name in names or list(namespace):
+        function = namespace[name]
+        if (name.startswith('_') or not isfunction(function) or function.__module__ != module
+                or isgeneratorfunction(function)):
+            continue
+        namespace[name] = timed(f"{prefix}.{name}", function)
+
+# botocore hooks, registered on every client built by clients.py
+
+def _add_consumed_capacity(params, model, **kwargs):
+    if get_current() is not None and model.name in CAPACITY_OPERATIONS:
+        params.setdefault('ReturnConsumedCapacity', 'TOTAL')
+
+def _before_call(context, **kwargs):
+    context['metrics_start'] = time.perf_counter()
+
+def _after_call(parsed, model, context, **kwargs):
+    start = context.get('metrics_start')
+    recorder = get_current()
+    if start is None or recorder is None:
+        return
+    recorder.add_call(f"{model.service_model.service_name}.{model.name}", time.perf_counter() - start)
+    if 'ConsumedCapacity' in parsed:
+        recorder.add_capacity(parsed['ConsumedCapacity'])
+
+def instrument_boto(client):
+    if not enabled:
+        return client
+    events = client.meta.events
+    service = client.meta.service_model.service_name
+    if service == 'dynamodb':
+        events.register('provide-client-params.dynamodb.*', _add_consumed_capacity)
+    events.register(f'before-call.{service}.*', _before_call)
+    events.register(f'after-call.{service}.*', _after_call)
+    return client
+
+def redis_class(redis):
+    # StrictRedis subclass timing every command, pipelines count as one round trip
+    if not enabled:
+        return redis.StrictRedis
+
+    class InstrumentedPipeline(redis.client.Pipeline):
+        def execute(self, *args, **kwargs):
+            if get_current() is None:
+                return super().execute(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return super().execute(*args, **kwargs)
+            finally:
+                record_call("redis.PIPELINE", time.perf_counter() - start)
+
+    class InstrumentedRedis(redis.StrictRedis):
+        def execute_command(self, *args, **options):
+            if get_current() is None:
+                return super().execute_command(*args, **options)
+            start = time.perf_counter()
+            try:
+                return super().execute_command(*args, **options)
+            finally:
+                record_call(f"redis.{args[0]}", time.perf_counter() - start)
+
+        def pipeline(self, transaction=True, shard_hint=None):
+            return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    return InstrumentedRedis
@@ -0,0 +1,173 @@
+import argparse
+import logging
+from clients import Key, get_dynamodb
+from crud import (
+    users_table, user_emails_table, blocks_table, messages_table, chat_metadata_table, make_block_id,
+    get_conversation_id, get_group_conversation_id, get_conversation_participants, make_sort_key,
+    get_chat_messages, get_inbox_updates, record_inbox_messages, record_archive_day, get_dirty_shard
+)
+from compaction import list_objects
+from botocore.exceptions import ClientError
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+def backfill_user_emails():
+    # Walk every page of the users table and reserve each email for its owner
+    stats = {"scanned": 0, "reserved": 0, "conflicts": 0}
+    scan_kwargs = {'ProjectionExpression': 'user_id, email'}
+    while True:
+        response = users_table.scan(**scan_kwargs)
+        for user in response['Items']:
+            stats["scanned"] += 1
+            if 'email' not in user:
+                continue
+            try:
+                user_emails_table.put_item(
+                    Item={'email': user['email'], 'user_id': user['user_id']},
+                    ConditionExpression='attribute_not_exists(email) OR user_id = :u',
+                    ExpressionAttributeValues={':u': user['user_id']}
+                )
+                stats["reserved"] += 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                # Duplicate registrations that slipped through the old scan check
+                stats["conflicts"] += 1
+                logger.warning("Email %s already reserved by another user, skipping %s", user['email'], user['user_id'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info("Email backfill finished: %s", stats)
+    return stats
+
+def migrate_blocks(source_table_name='blocks'):
+    # Copy blocks keyed by a random block_id into the per-blocker user_blocks collection
+    source_table = get_dynamodb().Table(source_table_name)
+    stats = {"scanned": 0, "copied": 0}
+    scan_kwargs = {}
+    with blocks_table.batch_writer(overwrite_by_pkeys=['blocker_id', 'blocked_id']) as batch:
+        while True:
+            response = source_table.scan(**scan_kwargs)
+            for block in response['Items']:
+                stats["scanned"] += 1
+                if 'blocker_id' not in block or 'blocked_id' not in block:
+                    continue
+                block['block_id'] = make_block_id(block['blocker_id'], block['blocked_id'])
+                batch.put_item(Item=block)
+                stats["copied"] += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info("Blocks migration finished: %s", stats)
+    return stats
+
+def migrate_messages(source_table_name='messages'):
+    # Copy messages keyed by message_id into the conversation partitioned chat_messages table
+    source_table = get_dynamodb().Table(source_table_name)
+    stats = {"scanned": 0, "copied": 0, "chats": 0}
+    scan_kwargs = {}
+    chat_ids = set()
+    with messages_table.batch_writer(overwrite_by_pkeys=['chat_id', 'sort_key']) as batch:
+        while True:
+            response = source_table.scan(**scan_kwargs)
+            for message in response['Items']:
+                stats["scanned"] += 1
+                if message.get('group_id'):
+                    message['chat_id'] = get_group_conversation_id(message['group_id'], message['receiver_id'])
+                else:
+                    message['chat_id'] = get_conversation_id(message['sender_id'], message['receiver_id'])
+                message['sort_key'] = make_sort_key(message['timestamp'], message['message_id'])
+                batch.put_item(Item=message)
+                chat_ids.add(message['chat_id'])
+                stats["copied"] += 1
+            if 'LastEvaluatedKey' not in response:
+                break
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    # The new conversation ids have no metadata yet, without it backfill_inbox, the backup and
+    # the archive never see them
+    for chat_id in sorted(chat_ids):
+        rebuild_chat_metadata(chat_id)
+        stats["chats"] += 1
+    logger.info("Messages migration finished: %s", stats)
+    return stats
+
+def rebuild_chat_metadata(chat_id):
+    # Recounts the conversation from chat_messages and marks it dirty for the backup. Read from
+    # the table rather than the scan, so a rerun or messages sent since don't skew the count
+    query_kwargs = {'KeyConditionExpression': Key('chat_id').eq(chat_id), 'Select': 'COUNT'}
+    count = 0
+    while True:
+        response = messages_table.query(**query_kwargs)
+        count += response['Count']
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    oldest = messages_table.query(KeyConditionExpression=Key('chat_id').eq(chat_id), Limit=1)['Items']
+    newest = get_chat_messages(chat_id, 1)
+    if not count or not oldest or not newest:
+        return
+    chat_metadata_table.update_item(
+        Key={'chat_id': chat_id},
+        UpdateExpression="SET message_count=:n, start_index=:f, end_index=:e, latest_timestamp=:l, latest_sort_key=:k, dirty_shard=:s",
+        ExpressionAttributeValues={
+            ':n': count,
+            ':f': oldest[0]['message_id'],
+            ':e': newest[0]['message_id'],
+            ':l': newest[0]['timestamp'],
+            ':k': newest[0]['sort_key'],
+            ':s': get_dirty_shard(chat_id)
+        }
+    )
+
+def backfill_inbox():
+    # Inbox entries for direct chats from before the inbox table, nothing unread. Safe to rerun,
+    # entries that already hold the chat's newest message are left alone
+    stats = {"scanned": 0, "recorded": 0}
+    scan_kwargs = {'ProjectionExpression': 'chat_id'}
+    while True:
+        response = chat_metadata_table.scan(**scan_kwargs)
+        for metadata in response['Items']:
+            stats["scanned"] += 1
+            if get_conversation_participants(metadata['chat_id']) is None:
+                continue
+            latest = get_chat_messages(metadata['chat_id'], 1)
+            if not latest:
+                continue
+            updates = get_inbox_updates(latest)
+            for update in updates:
+                update['unread'] = 0
+            record_inbox_messages(updates)
+            stats["recorded"] += 1
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.info("Inbox backfill finished: %s", stats)
+    return stats
+
+def backfill_archive_days():
+    # Record the user/day prefixes of archive objects written before compaction read archive_days
+    days = set()
+    for key in list_objects(""):
+        parts = key.split("/")
+        if parts[0] != "segments" and len(parts) > 3:
+            days.add((parts[0], parts[1], parts[2]))
+    for user_id, year, day in sorted(days):
+        record_archive_day(user_id, int(year), int(day))
+    stats = {"recorded": len(days)}
+    logger.info("Archive days backfill finished: %s", stats)
+    return stats
+
+MIGRATIONS = {
+    "backfill_archive_days": backfill_archive_days,
+    "backfill_inbox": backfill_inbox,
+    "backfill_user_emails": backfill_user_emails,
+    "migrate_blocks": migrate_blocks,
+    "migrate_messages": migrate_messages,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a data migration")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    args = parser.parse_args()
+    MIGRATIONS[args.migration]()
@@ -1,42 +1,101 @@
-from sqlalchemy import Column, String, Integer, ForeignKey
-from sqlalchemy.orm import relationship
-from database import Base
-
-class User(Base):
-    __tablename__ = "users"
-    id = Column(String, primary_key=True, index=True)
-    email = Column(String, unique=True, index=True)
-    blocked_users = relationship("Block", back_populates="blocker")
-
-class Message(Base):
-    __tablename__ = "messages"
-    id = Column(String, primary_key=True, index=True)
-    sender_id = Column(String, ForeignKey("users.id"))
-    receiver_id = Column(String, ForeignKey("users.id"))
-    content = Column(String)
-    timestamp = Column(Integer)
-
-class Block(Base):
-    __tablename__ = "blocks"
-    id = Column(String, primary_key=True, index=True)
-    blocker_id = Column(String, ForeignKey("users.id"))
-    blocked_id = Column(String)
-    blocker = relationship("User", back_populates="blocked_users")
-
-class Group(Base):
-    __tablename__ = "groups"
-    id = Column(String, primary_key=True, index=True)
-    name = Column(String, index=True)
-
-class GroupMember(Base):
-    __tablename__ = "group_members"
-    group_id = Column(String, ForeignKey("groups.id"), primary_key=True)
-    user_id = Column(String, ForeignKey("users.id"), primary_key=True)
-
-class ChatMetadata(Base):
-    __tablename__ = "chat_metadata"
-    chat_id = Column(String, primary_key=True, index=True)
-    message_count = Column(Integer, default=0)
-    start_index = Column(String)
-    end_index = Column(String)
-    latest_timestamp = Column(Integer)
\ No newline at end of file
+# Tables of the SQLite storage engine. They mirror the DynamoDB tables created in database.py,
+# with the GSIs as secondary indexes. WITHOUT ROWID keeps every row clustered on its primary key,
+# and secondary index entries carry the primary key, so (receiver_id, timestamp) also orders by
+# (chat_id, sort_key) for free
+
+MESSAGE_COLUMNS = (
+    'chat_id', 'sort_key', 'message_id', 'sender_id', 'receiver_id', 'content', 'timestamp',
+    'group_id', 'group_message_id'
+)
+
+INBOX_COLUMNS = (
+    'user_id', 'chat_id', 'peer_id', 'group_id', 'last_message_id', 'last_sender_id', 'last_sort_key',
+    'last_timestamp', 'preview'
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    email TEXT NOT NULL,
+    password TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS user_emails (
+    email TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    sort_key TEXT NOT NULL,
+    message_id TEXT NOT NULL,
+    sender_id TEXT NOT NULL,
+    receiver_id TEXT NOT NULL,
+    content TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    group_id TEXT,
+    group_message_id TEXT,
+    PRIMARY KEY (chat_id, sort_key)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS messages_receiver_timestamp ON messages (receiver_id, timestamp);
+CREATE INDEX IF NOT EXISTS messages_sender_receiver_timestamp ON messages (sender_id, receiver_id, timestamp);
+
+CREATE TABLE IF NOT EXISTS chat_metadata (
+    chat_id TEXT PRIMARY KEY,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    archived_count INTEGER NOT NULL DEFAULT 0,
+    start_index TEXT,
+    end_index TEXT,
+    latest_timestamp TEXT,
+    latest_sort_key TEXT
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS user_blocks (
+    blocker_id TEXT NOT NULL,
+    blocked_id TEXT NOT NULL,
+    block_id TEXT NOT NULL,
+    PRIMARY KEY (blocker_id, blocked_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS chat_groups (
+    group_id TEXT PRIMARY KEY,
+    name TEXT,
+    member_count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    joined_at TEXT,
+    PRIMARY KEY (group_id, user_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS group_members_user ON group_members (user_id);
+
+CREATE TABLE IF NOT EXISTS inbox (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    peer_id TEXT,
+    group_id TEXT,
+    last_message_id TEXT NOT NULL,
+    last_sender_id TEXT NOT NULL,
+    last_sort_key TEXT NOT NULL,
+    last_timestamp TEXT NOT NULL,
+    preview TEXT NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, chat_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS inbox_user_last ON inbox (user_id, last_sort_key);
+"""
+
+def to_item(row):
+    # Rows come back shaped like DynamoDB items: missing attributes are absent, not None
+    return {key: row[key] for key in row.keys() if row[key] is not None}
+
+def message_row(message):
+    return tuple(message.get(column) for column in MESSAGE_COLUMNS)
+
+def inbox_row(item):
+    return tuple(item.get(column) for column in INBOX_COLUMNS)
@@ -0,0 +1,220 @@
+import logging
+import os
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from threading import Event, Lock, Thread
+from config import config
+import codec
+
+# Write-behind queue for sends (SEND_MODE=write_behind). A send is acknowledged once its record
+# is in the outbox, a worker thread drains it in batches into the storage engine. Delivery is
+# at least once: a batch is only acknowledged after its handler returned, so a crash or a failed
+# batch hands the same records to the handler again, which must write idempotently.
+#
+# FileOutbox is an append-only log of JSON lines in OUTBOX_DIR, split into segment files, with
+# the consumer position kept next to it. It survives process restarts on the same disk, so it
+# fits single node deployments; a Lambda container's /tmp goes away with the container.
+# MemoryOutbox keeps the records in process only, for development and the benchmarks.
+
+logger = logging.getLogger()
+
+class Outbox(ABC):
+    def __init__(self):
+        self.ready = Event()
+        # One consumer at a time, the worker and an explicit drain() never get the same batch
+        self.consuming = Lock()
+
+    @abstractmethod
+    def put(self, record):
+        # Returns once the record is durable
+        pass
+
+    @abstractmethod
+    def take(self, limit):
+        # The oldest records not yet acknowledged, and the token that acknowledges them
+        pass
+
+    @abstractmethod
+    def ack(self, token):
+        pass
+
+class MemoryOutbox(Outbox):
+    def __init__(self):
+        super().__init__()
+        self.records = deque()
+        self.lock = Lock()
+
+    def put(self, record):
+        with self.lock:
+            self.records.append(record)
+        self.ready.set()
+
+    def take(self, limit):
+        with self.lock:
+            records = [self.records[index] for index in range(min(limit, len(self.records)))]
+        return records, len(records)
+
+    def ack(self, token):
+        with self.lock:
+            for _ in range(token):
+                self.records.popleft()
+
+class FileOutbox(Outbox):
+    # One writer process per directory. Segments are named by their sequence number, the
+    # position file holds "<segment> <byte offset>" of the first unacknowledged record
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+        segments = self.segments()
+        self.position = self.read_position(segments[0] if segments else 0)
+        self.segment = segments[-1] if segments else self.position[0]
+        self.repair(self.segment)
+        self.handle = open(self.segment_path(self.segment), 'ab')
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:012d}.log")
+
+    def segments(self):
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.log'))
+
+    def read_position(self, default_segment):
+        try:
+            with open(os.path.join(self.directory, 'position')) as handle:
+                segment, offset = handle.read().split()
+                return int(segment), int(offset)
+        except FileNotFoundError:
+            return default_segment, 0
+
+    def repair(self, segment):
+        # A crash mid-append leaves a torn last line, cut it so the next append starts clean
+        path = self.segment_path(segment)
+        if not os.path.exists(path):
+            return
+        with open(path, 'rb+') as handle:
+            data = handle.read()
+            if data and not data.endswith(b"\n"):
+                handle.truncate(data.rfind(b"\n") + 1)
+
+    def put(self, record):
+        line = codec.dumps(record).encode() + b"\n"
+        with self.lock:
+            if self.handle.tell() + len(line) > config.OUTBOX_SEGMENT_BYTES and self.handle.tell():
+                self.handle.close()
+                self.segment += 1
+                self.handle = open(self.segment_path(self.segment), 'ab')
+            self.handle.write(line)
+            self.handle.flush()
+            if config.OUTBOX_FSYNC:
+                os.fsync(self.handle.fileno())
+        self.ready.set()
+
+    def take(self, limit):
+        records = []
+        segment, offset = self.position
+        while len(records) < limit and segment <= self.segment:
+            try:
+                with open(self.segment_path(segment), 'rb') as handle:
+                    handle.seek(offset)
+                    for line in handle:
+                        if not line.endswith(b"\n"):
+                            # Still being written
+                            break
+                        offset += len(line)
+                        try:
+                            records.append(codec.loads(line))
+                        except ValueError:
+                            logger.error("Skipping unreadable outbox record in segment %d", segment)
+                        if len(records) == limit:
+                            break
+            except FileNotFoundError:
+                pass
+            if len(records) == limit or segment == self.segment:
+                break
+            segment, offset = segment + 1, 0
+        return records, (segment, offset)
+
+    def ack(self, token):
+        path = os.path.join(self.directory, 'position')
+        with open(path + '.tmp', 'w') as handle:
+            handle.write(f"{token[0]} {token[1]}")
+            handle.flush()
+            os.fsync(handle.fileno())
+        os.replace(path + '.tmp', path)
+        previous, self.position = self.position[0], token
+        # Segments before the position are fully consumed
+        for segment in range(previous, token[0]):
+            try:
+                os.remove(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+
+def drain_once(outbox, handler):
+    # Hands one batch to the handler and acknowledges it, returns the number of records
+    with outbox.consuming:
+        records, token = outbox.take(config.OUTBOX_BATCH_SIZE)
+        if records:
+            handler(records)
+            outbox.ack(token)
+        return len(records)
+
+def drain(outbox, handler):
+    # Everything queued so far, in the calling thread. For shutdown, scripts and the benchmarks
+    total = 0
+    while True:
+        count = drain_once(outbox, handler)
+        if not count:
+            return total
+        total += count
+
+class Worker(Thread):
+    def __init__(self, outbox, handler):
+        super().__init__(name="outbox-worker", daemon=True)
+        self.outbox = outbox
+        self.handler = handler
+
+    def run(self):
+        failures = 0
+        while True:
+            self.outbox.ready.clear()
+            try:
+                count = drain_once(self.outbox, self.handler)
+                failures = 0
+            except Exception:
+                # Not acknowledged, the same batch is retried after a backoff
+                logger.exception("Outbox batch failed")
+                failures += 1
+                time.sleep(random.uniform(0, min(config.FANOUT_BACKOFF_BASE_MS * (2 ** failures), 5000) / 1000))
+                continue
+            if not count:
+                self.outbox.ready.wait(config.OUTBOX_POLL_MS / 1000)
+
+_outbox = None
+_worker = None
+_lock = Lock()
+
+def get_outbox():
+    global _outbox
+    if _outbox is None:
+        with _lock:
+            if _outbox is None:
+                if config.OUTBOX_BACKEND == 'file':
+                    _outbox = FileOutbox(config.OUTBOX_DIR)
+                elif config.OUTBOX_BACKEND == 'memory':
+                    _outbox = MemoryOutbox()
+                else:
+                    raise ValueError(f"Unknown OUTBOX_BACKEND {config.OUTBOX_BACKEND!r}, expected 'file' or 'memory'")
+    return _outbox
+
+def start_worker(handler):
+    # Started by the first enqueue, so containers that never queue anything run no thread
+    global _worker
+    if _worker is None:
+        with _lock:
+            if _worker is None:
+                _worker = Worker(get_outbox(), handler)
+                _worker.start()
+    return _worker
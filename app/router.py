@@ -0,0 +1,95 @@
+import base64
+import logging
+import codec
+import metrics
+
+logger = logging.getLogger()
+
+# (method, path) -> handler, filled in by the @route decorators of handlers.py
+routes = {}
+paths = set()
+
+class HTTPError(Exception):
+    def __init__(self, status, detail):
+        super().__init__(detail)
+        self.status = status
+        self.detail = detail
+
+class Response(dict):
+    # A complete Lambda response, returned by handlers that need a status or fields of their own
+    pass
+
+class Fields(dict):
+    # The request body and query parameters, a missing one is the client's error. Any other
+    # KeyError is a bug and answers 500
+    def __missing__(self, key):
+        raise HTTPError(400, f"Invalid request: missing {key!r}")
+
+class Request:
+    __slots__ = ('event', 'context', 'body', 'params')
+
+    def __init__(self, event, context):
+        self.event = event
+        self.context = context
+        self.body = decode_body(event)
+        self.params = Fields(event.get('queryStringParameters') or {})
+
+def route(method, path):
+    def register(handler):
+        routes[(method, path)] = handler
+        paths.add(path)
+        return handler
+    return register
+
+def decode_body(event):
+    body = event.get('body')
+    if not body:
+        return Fields()
+    if event.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+    body = codec.loads(body)
+    if not isinstance(body, dict):
+        raise ValueError("request body must be a JSON object")
+    return Fields(body)
+
+def respond(payload, status=200, **fields):
+    # Extra fields go next to statusCode and body in the Lambda response
+    return Response(statusCode=status, body=codec.dumps(payload), **fields)
+
+def error(status, detail):
+    return respond({"detail": detail}, status)
+
+def dispatch(event, context):
+    if not metrics.enabled:
+        return handle(event, context)
+    # Keyed by the matched route, the raw method and path are the client's and unbounded, so
+    # every 404 and 405 shares one bucket
+    method, path = event.get('httpMethod'), event.get('path')
+    recorder = metrics.begin(f"{method} {path}" if (method, path) in routes else "unmatched")
+    response = None
+    try:
+        response = handle(event, context)
+        return response
+    finally:
+        metrics.end(recorder, response['statusCode'] if response else 500)
+
+def handle(event, context):
+    method, path = event.get('httpMethod'), event.get('path')
+    handler = routes.get((method, path))
+    if handler is None:
+        if path in paths:
+            return error(405, "Method Not Allowed")
+        return error(404, "Not Found")
+    try:
+        result = handler(Request(event, context))
+    except HTTPError as e:
+        return error(e.status, e.detail)
+    except ValueError as e:
+        # Malformed JSON and failed schema validation (pydantic errors are ValueErrors)
+        return error(400, f"Invalid request: {e}")
+    except Exception:
+        logger.exception("Error handling %s %s", method, path)
+        return error(500, "Internal server error")
+    if isinstance(result, Response):
+        return result
+    return respond(result)
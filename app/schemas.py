@@ -29,6 +29,15 @@ class Message(MessageBase):
     class Config:
         orm_mode = True
 
+class GroupMessageBase(BaseModel):
+    sender_id: str
+    group_id: str
+    content: str
+    timestamp: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class GroupMessageCreate(GroupMessageBase):
+    message_id: str
+
 class ChatMetadataBase(BaseModel):
     chat_id: str
     message_count: int
@@ -0,0 +1,135 @@
+import json
+import mmap
+import struct
+import zlib
+
+# Archive segment format
+#
+#   [block][block]...[footer][footer length: 8 bytes, big endian][MAGIC]
+#
+# A block holds the messages of one conversation, sorted by sort_key, as zlib compressed lines:
+# the first line is the JSON list of column names, every other line is one message as
+# [presence bitmask, value, value, ...] with values only for the columns it has, so absent
+# fields stay absent on decode. The footer is zlib compressed JSON indexing every block by
+# conversation, sort key range, byte offset and length, so a reader needs the trailer, the
+# footer and then one ranged read per block.
+
+MAGIC = b"MSGSEG01"
+TRAILER = struct.Struct(">Q")
+TRAILER_SIZE = TRAILER.size + len(MAGIC)
+
+def encode_block(messages):
+    columns = sorted({column for message in messages for column in message})
+    lines = [json.dumps(columns, separators=(',', ':'))]
+    for message in messages:
+        mask = 0
+        values = []
+        for index, column in enumerate(columns):
+            if column in message:
+                mask |= 1 << index
+                values.append(message[column])
+        lines.append(json.dumps([mask] + values, default=str, separators=(',', ':')))
+    return zlib.compress("\n".join(lines).encode(), 9)
+
+def decode_block(data):
+    lines = zlib.decompress(data).decode().split("\n")
+    columns = json.loads(lines[0])
+    messages = []
+    for line in lines[1:]:
+        row = json.loads(line)
+        mask, values = row[0], iter(row[1:])
+        messages.append({column: next(values) for index, column in enumerate(columns) if mask >> index & 1})
+    return messages
+
+class SegmentWriter:
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.offset = 0
+        self.blocks = []
+
+    def write_block(self, chat_id, messages):
+        data = encode_block(messages)
+        self.fileobj.write(data)
+        self.blocks.append({
+            'chat_id': chat_id,
+            'start_sort_key': messages[0]['sort_key'],
+            'end_sort_key': messages[-1]['sort_key'],
+            'offset': self.offset,
+            'length': len(data),
+            'count': len(messages)
+        })
+        self.offset += len(data)
+
+    def close(self):
+        footer = zlib.compress(json.dumps({'version': 1, 'blocks': self.blocks}).encode(), 9)
+        self.fileobj.write(footer)
+        self.fileobj.write(TRAILER.pack(len(footer)) + MAGIC)
+        self.offset += len(footer) + TRAILER_SIZE
+        return self.blocks
+
+# Sources give the reader ranged access to a segment wherever it lives
+class BytesSource:
+    def __init__(self, data):
+        self.data = data
+
+    def read_tail(self, length):
+        return bytes(self.data[-length:])
+
+    def read_range(self, offset, length):
+        return bytes(self.data[offset:offset + length])
+
+class FileSource(BytesSource):
+    # Memory maps the segment, only the pages that are actually read get loaded
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        super().__init__(mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+class S3Source:
+    def __init__(self, s3, bucket, key):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+
+    def read_tail(self, length):
+        return self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes=-{length}")['Body'].read()
+
+    def read_range(self, offset, length):
+        end = offset + length - 1
+        return self.s3.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={offset}-{end}")['Body'].read()
+
+class SegmentReader:
+    def __init__(self, source):
+        self.source = source
+        self._blocks = None
+
+    @property
+    def blocks(self):
+        if self._blocks is None:
+            trailer = self.source.read_tail(TRAILER_SIZE)
+            if trailer[TRAILER.size:] != MAGIC:
+                raise ValueError("Not an archive segment")
+            (footer_length,) = TRAILER.unpack(trailer[:TRAILER.size])
+            footer = self.source.read_tail(TRAILER_SIZE + footer_length)[:footer_length]
+            self._blocks = json.loads(zlib.decompress(footer))['blocks']
+        return self._blocks
+
+    def find_blocks(self, chat_id=None, since=None, before=None):
+        return [
+            block for block in self.blocks
+            if (chat_id is None or block['chat_id'] == chat_id)
+            and (since is None or block['end_sort_key'] >= since)
+            and (before is None or block['start_sort_key'] < before)
+        ]
+
+    def read_block(self, block):
+        return decode_block(self.source.read_range(block['offset'], block['length']))
+
+    def iter_messages(self, chat_id=None, since=None, before=None):
+        for block in self.find_blocks(chat_id, since, before):
+            for message in self.read_block(block):
+                if (since is None or message['sort_key'] >= since) and (before is None or message['sort_key'] < before):
+                    yield message
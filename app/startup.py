@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import time
+
+# Imported first by the Lambda entry points, so this approximates the start of the init phase
+PROCESS_START = time.perf_counter()
+
+logger = logging.getLogger()
+
+phases = {}
+reported = False
+_last_mark = PROCESS_START
+
+def mark(phase):
+    # Attributes the time since the previous mark to `phase`
+    global _last_mark
+    now = time.perf_counter()
+    record(phase, now - _last_mark)
+    _last_mark = now
+
+def record(phase, seconds):
+    phases[phase] = phases.get(phase, 0) + seconds
+
+def get_report():
+    return {
+        "phases_ms": {phase: round(seconds * 1000, 2) for phase, seconds in phases.items()},
+        "total_ms": round((time.perf_counter() - PROCESS_START) * 1000, 2)
+    }
+
+def report():
+    # One structured line per cold start. client:* phases are nested inside first_request
+    global reported
+    reported = True
+    logger.info("Cold start: %s", json.dumps(get_report()))
+
+def import_time_report(module, top=15):
+    # Imports `module` in a fresh interpreter and returns its startup report plus the slowest imports
+    import subprocess
+    import sys
+    code = f"import startup, {module}; startup.mark('imports'); import json; print(json.dumps(startup.get_report()))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+    # -X importtime lists a module after everything it imported, indented two spaces per level
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        entries.append(((len(name) - len(name.lstrip()) - 1) // 2, name.strip(), int(cumulative) / 1000))
+    # Everything the entry module pulled in, with its depth below it. Modules already imported
+    # by startup itself are not part of the entry point's cost
+    index = max(i for i, (depth, name, _) in enumerate(entries) if name == module and depth == 0)
+    imports = []
+    for depth, name, ms in reversed(entries[:index]):
+        if depth == 0:
+            break
+        imports.append((name, depth, ms))
+    imports.sort(key=lambda entry: entry[2], reverse=True)
+    return {
+        "startup": json.loads(result.stdout.strip().splitlines()[-1]),
+        "slowest_imports_ms": [{"module": name, "depth": depth, "ms": round(ms, 2)} for name, depth, ms in imports[:top]]
+    }
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Report the import-time cost of a Lambda entry point")
+    parser.add_argument("module", nargs="?", default="lambda_function")
+    args = parser.parse_args()
+    print(json.dumps(import_time_report(args.module), indent=2))
@@ -0,0 +1,40 @@
+from config import config
+from conversations import *
+
+# The storage engine the API runs on, chosen by STORAGE_BACKEND. Every engine is a module
+# providing the functions below with the same arguments and return values; handlers and the
+# cache import them from here and never from an engine directly
+
+INTERFACE = (
+    # users
+    'create_user', 'get_user', 'get_existing_user_ids', 'get_all_users', 'get_user_by_email',
+    'reserve_email', 'release_email', 'get_email_reservation',
+    # messages
+    'create_message', 'create_messages', 'create_messages_once', 'get_chat_messages', 'get_user_chats', 'get_messages_for_user',
+    'get_messages_since', 'create_message_for_group',
+    # chat metadata
+    'get_chat_metadata', 'record_chat_message', 'record_archived_messages',
+    # inbox summaries
+    'record_inbox_messages', 'get_inbox', 'mark_inbox_read',
+    # archive
+    'backup_and_delete_old_messages', 'get_archived_messages',
+    # blocks
+    'create_block', 'get_block', 'get_blocked_ids',
+    # groups
+    'create_group', 'get_group', 'add_user_to_group', 'remove_user_from_group', 'get_group_members', 'get_user_groups'
+)
+
+if config.STORAGE_BACKEND == 'dynamodb':
+    from crud import *
+    from archive import backup_and_delete_old_messages, get_archived_messages
+    # Chats over DB_LIMIT move their older messages to S3
+    ARCHIVES_HISTORY = True
+elif config.STORAGE_BACKEND == 'sqlite':
+    from crud_sqlite import *
+    ARCHIVES_HISTORY = False
+else:
+    raise ImportError(f"Unknown STORAGE_BACKEND {config.STORAGE_BACKEND!r}, expected 'dynamodb' or 'sqlite'")
+
+_missing = [name for name in INTERFACE if name not in globals()]
+if _missing:
+    raise ImportError(f"Storage backend {config.STORAGE_BACKEND!r} is missing {', '.join(_missing)}")
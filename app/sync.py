@@ -0,0 +1,130 @@
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from config import config
+import clients
+from clients import LazyClient, get_redis
+from storage import get_messages_since, get_user_groups, encode_cursor, decode_cursor
+import metrics
+
+# Delta sync: a client keeps an opaque per-user cursor and gets only the messages it received
+# after it. The position is a timestamp, and send timestamps come from the sending container,
+# so a message can become readable after newer ones were already synced (clock skew, GSI lag,
+# write-behind queues). The cursor therefore re-reads the last SYNC_OVERLAP_MS and carries the
+# sort keys it already delivered there, up to SYNC_MAX_SEEN. Delivery is at least once, clients
+# drop duplicates by message_id.
+#
+# Long-poll: sends publish on the receiver's Redis channel (a group's channel for group
+# messages) once the message is stored, and a waiting request subscribes before it reads, so
+# a send landing in between still wakes it.
+
+logger = logging.getLogger()
+
+redis_client = LazyClient(get_redis)
+
+def get_user_channel(user_id):
+    return f"sync:user:{user_id}"
+
+def get_group_channel(group_id):
+    return f"sync:group:{group_id}"
+
+def notify(user_ids=(), group_ids=()):
+    # Best effort, a lost notification only delays a waiting client until its wait runs out
+    channels = [get_user_channel(user_id) for user_id in set(user_ids)]
+    channels += [get_group_channel(group_id) for group_id in set(group_ids)]
+    if not channels:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for channel in channels:
+            pipe.publish(channel, "1")
+        pipe.execute()
+    except clients.RedisError as e:
+        logger.warning("Failed to notify sync channels: %s", e)
+
+def shift(timestamp, ms):
+    return (datetime.fromisoformat(timestamp) + timedelta(milliseconds=ms)).isoformat()
+
+def get_updates(user_id, cursor=None, since=None, limit=None):
+    # One page of messages after the cursor, oldest first, the next cursor and whether more are
+    # waiting. Without a cursor the sync starts at since, or a SYNC_OVERLAP_MS before now
+    limit = min(limit or config.SYNC_PAGE_SIZE, config.SYNC_MAX_PAGE_SIZE)
+    if cursor:
+        state = decode_cursor(cursor)
+        if not isinstance(state.get('from'), str) or not isinstance(state.get('seen'), list):
+            raise ValueError("Invalid cursor")
+        start, seen = state['from'], state['seen']
+    else:
+        start, seen = since or shift(datetime.now(timezone.utc).isoformat(), -config.SYNC_OVERLAP_MS), []
+
+    # Enough to get past every message already delivered from the overlap
+    seen_keys = set(seen)
+    messages = [
+        message for message in get_messages_since(user_id, start, limit + len(seen))
+        if message['sort_key'] not in seen_keys
+    ][:limit]
+
+    delivered = sorted(seen + [message['sort_key'] for message in messages])
+    floor = start
+    if delivered:
+        # Sort keys start with the timestamp
+        floor = max(start, shift(delivered[-1].split('#', 1)[0], -config.SYNC_OVERLAP_MS))
+    kept = [sort_key for sort_key in delivered if sort_key >= floor]
+    if len(kept) > config.SYNC_MAX_SEEN:
+        # A burst, narrow the overlap rather than grow the cursor
+        kept = kept[-config.SYNC_MAX_SEEN:]
+        floor = kept[0].split('#', 1)[0]
+    metrics.incr("sync.messages", len(messages))
+    return messages, encode_cursor({'from': floor, 'seen': kept}), len(messages) == limit
+
+class Subscription:
+    def __init__(self, channels):
+        self.pubsub = redis_client.pubsub()
+        self.pubsub.subscribe(*channels)
+        # Wait for the confirmations, only then is a publish from another connection guaranteed to reach us
+        for _ in channels:
+            self.pubsub.get_message(timeout=config.REDIS_SOCKET_TIMEOUT)
+
+    def wait(self, timeout):
+        # True once a notification arrived, False when the timeout ran out first
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            message = self.pubsub.get_message(timeout=remaining)
+            if message and message['type'] == 'message':
+                return True
+
+    def close(self):
+        self.pubsub.close()
+
+def subscribe(user_id):
+    # None when Redis is unavailable, the request then answers right away like a plain poll
+    channels = [get_user_channel(user_id)] + [get_group_channel(group['group_id']) for group in get_user_groups(user_id)]
+    try:
+        return Subscription(channels)
+    except clients.RedisError as e:
+        logger.warning("Sync long-poll unavailable, answering immediately: %s", e)
+        return None
+
+def sync(user_id, cursor=None, since=None, limit=None, wait=0):
+    # With wait (seconds, at most SYNC_MAX_WAIT_S) an empty result is held until a notification
+    # or the timeout, whichever comes first
+    wait = min(wait, config.SYNC_MAX_WAIT_S)
+    subscription = subscribe(user_id) if wait > 0 else None
+    try:
+        deadline = time.monotonic() + wait
+        while True:
+            messages, cursor, has_more = get_updates(user_id, cursor, since, limit)
+            if messages or subscription is None:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not subscription.wait(remaining):
+                break
+            # Woken up, but the message may not be readable yet (GSI lag), read again and keep waiting if not
+            metrics.incr("sync.wakeup")
+    finally:
+        if subscription is not None:
+            subscription.close()
+    return {"messages": messages, "cursor": cursor, "has_more": has_more}
@@ -0,0 +1,911 @@
+import copy
+import queue
+import re
+import time
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from decimal import Decimal
+from io import BytesIO
+from threading import RLock
+from botocore.exceptions import ClientError
+from redis import WatchError
+import metrics
+
+# In-process stand-ins for the DynamoDB resource, the S3 client and the Redis client, covering
+# the calls the app makes. Every call is recorded in the request metrics like the real clients
+# are, and can be slowed down by a fixed latency to approximate network round trips.
+
+def to_dynamo(value):
+    # DynamoDB hands numbers back as Decimal, so the fake stores them that way too
+    if isinstance(value, bool) or value is None:
+        return value
+    if isinstance(value, (int, float)):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: to_dynamo(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [to_dynamo(v) for v in value]
+    if isinstance(value, set):
+        return {to_dynamo(v) for v in value}
+    return value
+
+def client_error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+class Backend:
+    service = None
+
+    def __init__(self, latency_ms=0):
+        self.latency = latency_ms / 1000
+        self.lock = RLock()
+        self.calls = defaultdict(int)
+
+    def call(self, operation, function, *args, **kwargs):
+        start = time.perf_counter()
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            with self.lock:
+                return function(*args, **kwargs)
+        finally:
+            self.calls[operation] += 1
+            metrics.record_call(f"{self.service}.{operation}", time.perf_counter() - start)
+
+# Expressions
+
+TOKEN = re.compile(r"\s*(<>|<=|>=|[=<>(),+\-]|:[A-Za-z0-9_]+|#[A-Za-z0-9_]+|[A-Za-z_][A-Za-z0-9_.]*)")
+
+def tokenize(expression):
+    tokens, position = [], 0
+    expression = expression.strip()
+    while position < len(expression):
+        match = TOKEN.match(expression, position)
+        if not match:
+            raise ValueError(f"Cannot parse expression at: {expression[position:]}")
+        tokens.append(match.group(1))
+        position = match.end()
+    return tokens
+
+class ConditionParser:
+    # condition := or ; or := and (OR and)* ; and := not (AND not)* ; not := NOT not | primary
+    def __init__(self, expression, names, values):
+        self.tokens = tokenize(expression)
+        self.position = 0
+        self.names = names or {}
+        self.values = values or {}
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def take(self, expected=None):
+        token = self.peek()
+        if expected is not None and (token or '').upper() != expected:
+            raise ValueError(f"Expected {expected}, got {token}")
+        self.position += 1
+        return token
+
+    def name(self, token):
+        return self.names.get(token, token)
+
+    def parse(self):
+        result = self.parse_or()
+        if self.peek() is not None:
+            raise ValueError(f"Unexpected token {self.peek()}")
+        return result
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while (self.peek() or '').upper() == 'OR':
+            self.take()
+            terms.append(self.parse_and())
+        return lambda item: any(term(item) for term in terms)
+
+    def parse_and(self):
+        terms = [self.parse_not()]
+        while (self.peek() or '').upper() == 'AND':
+            self.take()
+            terms.append(self.parse_not())
+        return lambda item: all(term(item) for term in terms)
+
+    def parse_not(self):
+        if (self.peek() or '').upper() == 'NOT':
+            self.take()
+            term = self.parse_not()
+            return lambda item: not term(item)
+        return self.parse_primary()
+
+    def parse_primary(self):
+        token = self.take()
+        if token == '(':
+            term = self.parse_or()
+            self.take(')')
+            return term
+        function = token.lower()
+        if function in ('attribute_exists', 'attribute_not_exists', 'begins_with', 'contains') and self.peek() == '(':
+            self.take('(')
+            path = self.name(self.take())
+            argument = None
+            if self.peek() == ',':
+                self.take(',')
+                argument = self.operand(self.take())
+            self.take(')')
+            if function == 'attribute_exists':
+                return lambda item: path in item
+            if function == 'attribute_not_exists':
+                return lambda item: path not in item
+            if function == 'begins_with':
+                return lambda item: isinstance(item.get(path), str) and item[path].startswith(argument(item))
+            return lambda item: path in item and argument(item) in item[path]
+        left = self.operand(token)
+        operator = self.take()
+        if operator.upper() == 'BETWEEN':
+            low = self.operand(self.take())
+            self.take('AND')
+            high = self.operand(self.take())
+            return lambda item: compare(left(item), '>=', low(item)) and compare(left(item), '<=', high(item))
+        right = self.operand(self.take())
+        return lambda item: compare(left(item), operator, right(item))
+
+    def operand(self, token):
+        if token.startswith(':'):
+            value = to_dynamo(self.values[token])
+            return lambda item: value
+        path = self.name(token)
+        return lambda item: item.get(path)
+
+def compare(left, operator, right):
+    if left is None or right is None:
+        return operator == '<>' and left != right
+    if operator == '=':
+        return left == right
+    if operator == '<>':
+        return left != right
+    if type(left) != type(right):
+        return False
+    return {'<': left < right, '<=': left <= right, '>': left > right, '>=': left >= right}[operator]
+
+def evaluate_condition(expression, names, values, item):
+    return ConditionParser(expression, names, values).parse()(item)
+
+def key_condition_terms(condition):
+    # Flattens a boto3.dynamodb.conditions key condition into (attribute, operator, values)
+    expression = condition.get_expression()
+    if expression['operator'] == 'AND':
+        terms = []
+        for part in expression['values']:
+            terms.extend(key_condition_terms(part))
+        return terms
+    attribute, *values = expression['values']
+    return [(attribute.name, expression['operator'], [to_dynamo(value) for value in values])]
+
+def split_top_level(text):
+    parts, depth, current = [], 0, ''
+    for char in text:
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+UPDATE_CLAUSE = re.compile(r"\b(SET|REMOVE|ADD|DELETE)\b", re.IGNORECASE)
+
+def apply_update(item, expression, names, values):
+    # Applies SET/REMOVE/ADD/DELETE clauses in place, returns the attributes they touched
+    names, values = names or {}, values or {}
+    updated = set()
+    pieces = UPDATE_CLAUSE.split(expression)
+    for clause, body in zip(pieces[1::2], pieces[2::2]):
+        clause = clause.upper()
+        for action in split_top_level(body):
+            if clause == 'SET':
+                path, value = action.split('=', 1)
+                path = names.get(path.strip(), path.strip())
+                item[path] = set_value(item, value.strip(), names, values)
+            elif clause == 'REMOVE':
+                path = names.get(action, action)
+                item.pop(path, None)
+            else:
+                path, placeholder = action.split()
+                path = names.get(path, path)
+                value = to_dynamo(values[placeholder])
+                if clause == 'ADD':
+                    if isinstance(value, set):
+                        item[path] = set(item.get(path, set())) | value
+                    else:
+                        item[path] = item.get(path, Decimal(0)) + value
+                else:
+                    item[path] = set(item.get(path, set())) - value
+                    if not item[path]:
+                        del item[path]
+            updated.add(path)
+    return updated
+
+def set_value(item, expression, names, values):
+    match = re.match(r"if_not_exists\s*\(\s*([^,]+?)\s*,\s*(.+)\)$", expression)
+    if match:
+        path = names.get(match.group(1), match.group(1))
+        return item[path] if path in item else set_value(item, match.group(2).strip(), names, values)
+    match = re.match(r"list_append\s*\(\s*(.+?)\s*,\s*(.+)\)$", expression)
+    if match:
+        return set_value(item, match.group(1), names, values) + set_value(item, match.group(2), names, values)
+    for operator in ('+', '-'):
+        if operator in expression:
+            left, right = expression.split(operator, 1)
+            left, right = set_value(item, left.strip(), names, values), set_value(item, right.strip(), names, values)
+            return left + right if operator == '+' else left - right
+    if expression.startswith(':'):
+        return to_dynamo(values[expression])
+    return item.get(names.get(expression, expression))
+
+# DynamoDB
+
+class Index:
+    # hash value -> sorted [(range value, primary key)], items without the index keys are left out
+    def __init__(self, hash_key, range_key):
+        self.hash_key = hash_key
+        self.range_key = range_key
+        self.partitions = defaultdict(list)
+
+    def entry(self, item, primary_key):
+        if self.hash_key not in item or (self.range_key and self.range_key not in item):
+            return None
+        return item[self.hash_key], (item[self.range_key] if self.range_key else '', primary_key)
+
+    def add(self, item, primary_key):
+        entry = self.entry(item, primary_key)
+        if entry:
+            insort(self.partitions[entry[0]], entry[1])
+
+    def remove(self, item, primary_key):
+        entry = self.entry(item, primary_key)
+        if entry:
+            partition = self.partitions[entry[0]]
+            position = bisect_left(partition, entry[1])
+            if position < len(partition) and partition[position] == entry[1]:
+                del partition[position]
+
+def key_schema_names(key_schema):
+    hash_key = next(key['AttributeName'] for key in key_schema if key['KeyType'] == 'HASH')
+    range_key = next((key['AttributeName'] for key in key_schema if key['KeyType'] == 'RANGE'), None)
+    return hash_key, range_key
+
+class FakeWaiter:
+    def wait(self, **kwargs):
+        pass
+
+class FakeTable:
+    # Unpaginated queries and scans stop after this many items, so callers still see LastEvaluatedKey
+    PAGE_ITEMS = 1000
+
+    def __init__(self, resource, name, key_schema, global_secondary_indexes=()):
+        self.resource = resource
+        self.name = name
+        self.meta = resource.meta
+        self.hash_key, self.range_key = key_schema_names(key_schema)
+        self.items = {}
+        self.indexes = {None: Index(self.hash_key, self.range_key)}
+        for index in global_secondary_indexes or ():
+            self.indexes[index['IndexName']] = Index(*key_schema_names(index['KeySchema']))
+
+    def primary_key(self, key):
+        return (key[self.hash_key], key[self.range_key]) if self.range_key else (key[self.hash_key],)
+
+    def key_of(self, item):
+        return {name: item[name] for name in (self.hash_key, self.range_key) if name}
+
+    def store(self, primary_key, item):
+        old = self.items.pop(primary_key, None)
+        if old is not None:
+            for index in self.indexes.values():
+                index.remove(old, primary_key)
+        if item is not None:
+            self.items[primary_key] = item
+            for index in self.indexes.values():
+                index.add(item, primary_key)
+        return old
+
+    def check(self, operation, current, kwargs):
+        condition = kwargs.get('ConditionExpression')
+        if condition is None:
+            return
+        if not isinstance(condition, str):
+            raise NotImplementedError("Fake tables only support string condition expressions")
+        if not evaluate_condition(condition, kwargs.get('ExpressionAttributeNames'), kwargs.get('ExpressionAttributeValues'), current or {}):
+            raise client_error('ConditionalCheckFailedException', operation)
+
+    # Operations, all recorded under the DynamoDB operation name
+
+    def put_item(self, **kwargs):
+        return self.resource.call('PutItem', self._put_item, **kwargs)
+
+    def _put_item(self, Item, ReturnValues='NONE', **kwargs):
+        item = to_dynamo(copy.deepcopy(Item))
+        primary_key = self.primary_key(item)
+        current = self.items.get(primary_key)
+        self.check('PutItem', current, kwargs)
+        old = self.store(primary_key, item)
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if ReturnValues == 'ALL_OLD' and old is not None:
+            response['Attributes'] = copy.deepcopy(old)
+        return response
+
+    def get_item(self, **kwargs):
+        return self.resource.call('GetItem', self._get_item, **kwargs)
+
+    def _get_item(self, Key, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        item = self.items.get(self.primary_key(to_dynamo(Key)))
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if item is not None:
+            response['Item'] = project(item, ProjectionExpression, ExpressionAttributeNames)
+        return response
+
+    def delete_item(self, **kwargs):
+        return self.resource.call('DeleteItem', self._delete_item, **kwargs)
+
+    def _delete_item(self, Key, ReturnValues='NONE', **kwargs):
+        primary_key = self.primary_key(to_dynamo(Key))
+        self.check('DeleteItem', self.items.get(primary_key), kwargs)
+        old = self.store(primary_key, None)
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if ReturnValues == 'ALL_OLD' and old is not None:
+            response['Attributes'] = old
+        return response
+
+    def update_item(self, **kwargs):
+        return self.resource.call('UpdateItem', self._update_item, **kwargs)
+
+    def _update_item(self, Key, UpdateExpression, ReturnValues='NONE', ExpressionAttributeNames=None,
+                     ExpressionAttributeValues=None, **kwargs):
+        key = to_dynamo(Key)
+        primary_key = self.primary_key(key)
+        current = self.items.get(primary_key)
+        kwargs.update(ExpressionAttributeNames=ExpressionAttributeNames, ExpressionAttributeValues=ExpressionAttributeValues)
+        self.check('UpdateItem', current, kwargs)
+        item = copy.deepcopy(current) if current is not None else dict(key)
+        updated = apply_update(item, UpdateExpression, ExpressionAttributeNames, ExpressionAttributeValues)
+        self.store(primary_key, item)
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if ReturnValues == 'ALL_NEW':
+            response['Attributes'] = copy.deepcopy(item)
+        elif ReturnValues == 'ALL_OLD' and current is not None:
+            response['Attributes'] = current
+        elif ReturnValues == 'UPDATED_NEW':
+            response['Attributes'] = {name: copy.deepcopy(item[name]) for name in updated if name in item}
+        elif ReturnValues == 'UPDATED_OLD' and current is not None:
+            response['Attributes'] = {name: current[name] for name in updated if name in current}
+        return response
+
+    def query(self, **kwargs):
+        return self.resource.call('Query', self._query, **kwargs)
+
+    def _query(self, KeyConditionExpression, IndexName=None, ScanIndexForward=True, Limit=None,
+               ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None,
+               Select=None, FilterExpression=None, ExpressionAttributeValues=None, **kwargs):
+        index = self.indexes[IndexName]
+        hash_value, low, high, prefix = None, None, None, None
+        low_inclusive = high_inclusive = True
+        for attribute, operator, values in key_condition_terms(KeyConditionExpression):
+            if attribute == index.hash_key:
+                hash_value = values[0]
+            elif operator in ('>', '>='):
+                low, low_inclusive = values[0], operator == '>='
+            elif operator in ('<', '<='):
+                high, high_inclusive = values[0], operator == '<='
+            elif operator == '=':
+                low = high = values[0]
+            elif operator == 'BETWEEN':
+                low, high = values
+                if low > high:
+                    # Like DynamoDB, reversed bounds are an invalid key condition
+                    raise client_error('ValidationException', 'Query')
+            elif operator == 'begins_with':
+                prefix = values[0]
+        partition = index.partitions.get(hash_value, [])
+        start = 0 if low is None else (bisect_left if low_inclusive else bisect_right)(partition, (low,))
+        if low is not None and not low_inclusive:
+            # Skip every primary key sharing the excluded range value
+            while start < len(partition) and partition[start][0] == low:
+                start += 1
+        end = len(partition)
+        if high is not None:
+            end = bisect_left(partition, (high,))
+            if high_inclusive:
+                while end < len(partition) and partition[end][0] == high:
+                    end += 1
+        entries = partition[start:end]
+        if prefix is not None:
+            entries = [entry for entry in entries if entry[0].startswith(prefix)]
+        if not ScanIndexForward:
+            entries = entries[::-1]
+        if ExclusiveStartKey:
+            start_key = to_dynamo(ExclusiveStartKey)
+            marker = (start_key[index.range_key] if index.range_key else '', self.primary_key(start_key))
+            position = next((i for i, entry in enumerate(entries) if entry == marker), None)
+            if position is None:
+                # The start item is gone, resume from where it would have been
+                position = sum(1 for entry in entries if (entry < marker if ScanIndexForward else entry > marker)) - 1
+            entries = entries[position + 1:]
+        limit = Limit or self.PAGE_ITEMS
+        page = entries[:limit]
+        items = [self.items[primary_key] for _, primary_key in page]
+        if FilterExpression is not None:
+            items = [item for item in items if evaluate_condition(FilterExpression, ExpressionAttributeNames, ExpressionAttributeValues, item)]
+        response = {'Count': len(items), 'ScannedCount': len(page), 'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if Select != 'COUNT':
+            response['Items'] = [project(item, ProjectionExpression, ExpressionAttributeNames) for item in items]
+        if len(entries) > limit:
+            last = self.items[page[-1][1]]
+            last_key = self.key_of(last)
+            if IndexName:
+                last_key[index.hash_key] = last[index.hash_key]
+                if index.range_key:
+                    last_key[index.range_key] = last[index.range_key]
+            response['LastEvaluatedKey'] = last_key
+        return response
+
+    def scan(self, **kwargs):
+        return self.resource.call('Scan', self._scan, **kwargs)
+
+    def _scan(self, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        keys = sorted(self.items)
+        if ExclusiveStartKey:
+            keys = keys[bisect_right(keys, self.primary_key(to_dynamo(ExclusiveStartKey))):]
+        limit = Limit or self.PAGE_ITEMS
+        page = keys[:limit]
+        response = {
+            'Items': [project(self.items[key], ProjectionExpression, ExpressionAttributeNames) for key in page],
+            'Count': len(page),
+            'ResponseMetadata': {'HTTPStatusCode': 200}
+        }
+        if len(keys) > limit:
+            response['LastEvaluatedKey'] = self.key_of(self.items[page[-1]])
+        return response
+
+    def batch_writer(self, overwrite_by_pkeys=None):
+        return FakeBatchWriter(self)
+
+def project(item, projection, names=None):
+    if not projection:
+        return copy.deepcopy(item)
+    names = names or {}
+    fields = [names.get(field.strip(), field.strip()) for field in projection.split(',')]
+    return {field: copy.deepcopy(item[field]) for field in fields if field in item}
+
+class FakeBatchWriter:
+    # Buffers like boto3's batch writer, so a flush is one BatchWriteItem call
+    def __init__(self, table):
+        self.table = table
+        self.requests = []
+
+    def put_item(self, Item):
+        self.requests.append({'PutRequest': {'Item': Item}})
+        self.flush(full_only=True)
+
+    def delete_item(self, Key):
+        self.requests.append({'DeleteRequest': {'Key': Key}})
+        self.flush(full_only=True)
+
+    def flush(self, full_only=False):
+        while self.requests and (len(self.requests) >= 25 or not full_only):
+            batch, self.requests = self.requests[:25], self.requests[25:]
+            self.table.meta.client.batch_write_item(RequestItems={self.table.name: batch})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+class FakeDynamoDBClient:
+    def __init__(self, resource):
+        self.resource = resource
+
+    def get_waiter(self, name):
+        return FakeWaiter()
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        return self.resource.call('BatchWriteItem', self._batch_write_item, RequestItems)
+
+    def _batch_write_item(self, RequestItems):
+        if sum(len(requests) for requests in RequestItems.values()) > 25:
+            raise client_error('ValidationException', 'BatchWriteItem')
+        for table_name, requests in RequestItems.items():
+            table = self.resource.tables[table_name]
+            for request in requests:
+                if 'PutRequest' in request:
+                    item = to_dynamo(copy.deepcopy(request['PutRequest']['Item']))
+                    table.store(table.primary_key(item), item)
+                else:
+                    table.store(table.primary_key(to_dynamo(request['DeleteRequest']['Key'])), None)
+        return {'UnprocessedItems': {}}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        return self.resource.call('BatchGetItem', self._batch_get_item, RequestItems)
+
+    def _batch_get_item(self, RequestItems):
+        if sum(len(request['Keys']) for request in RequestItems.values()) > 100:
+            raise client_error('ValidationException', 'BatchGetItem')
+        responses = {}
+        for table_name, request in RequestItems.items():
+            table = self.resource.tables[table_name]
+            found = [table.items.get(table.primary_key(to_dynamo(key))) for key in request['Keys']]
+            responses[table_name] = [
+                project(item, request.get('ProjectionExpression'), request.get('ExpressionAttributeNames'))
+                for item in found if item is not None
+            ]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        return self.resource.call('TransactWriteItems', self._transact_write_items, TransactItems)
+
+    def _transact_write_items(self, TransactItems):
+        # All or nothing: every condition is checked before anything is written
+        if len(TransactItems) > 100:
+            raise client_error('ValidationException', 'TransactWriteItems')
+        requests = []
+        for request in TransactItems:
+            (operation, params), = request.items()
+            table = self.resource.tables[params['TableName']]
+            key = to_dynamo(params['Item'] if operation == 'Put' else params['Key'])
+            requests.append((operation, params, table, table.items.get(table.primary_key(key))))
+        reasons = []
+        for operation, params, table, current in requests:
+            try:
+                table.check(operation, current, params)
+                reasons.append({'Code': 'None'})
+            except ClientError:
+                reasons.append({'Code': 'ConditionalCheckFailed', 'Message': 'The conditional request failed'})
+        if any(reason['Code'] != 'None' for reason in reasons):
+            error = client_error('TransactionCanceledException', 'TransactWriteItems')
+            error.response['CancellationReasons'] = reasons
+            raise error
+        for operation, params, table, _ in requests:
+            params = {name: value for name, value in params.items() if name not in ('TableName', 'ConditionExpression')}
+            if operation == 'Put':
+                table._put_item(**params)
+            elif operation == 'Update':
+                table._update_item(**params)
+            elif operation == 'Delete':
+                table._delete_item(**params)
+        return {}
+
+class FakeMeta:
+    def __init__(self, client):
+        self.client = client
+
+class FakeDynamoDB(Backend):
+    service = 'dynamodb'
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self.tables = {}
+        self.meta = FakeMeta(FakeDynamoDBClient(self))
+
+    def create_table(self, TableName, KeySchema, GlobalSecondaryIndexes=None, **kwargs):
+        if TableName in self.tables:
+            raise client_error('ResourceInUseException', 'CreateTable')
+        self.tables[TableName] = FakeTable(self, TableName, KeySchema, GlobalSecondaryIndexes)
+        return self.tables[TableName]
+
+    def Table(self, name):
+        return self.tables[name]
+
+# S3
+
+class FakeBody:
+    def __init__(self, data):
+        self.stream = BytesIO(data)
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+class FakePaginator:
+    def __init__(self, s3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix='', **kwargs):
+        keys = sorted(key for bucket, key in self.s3.objects if bucket == Bucket and key.startswith(Prefix))
+        for start in range(0, max(len(keys), 1), 1000):
+            yield self.s3.call('ListObjectsV2', lambda page: {'Contents': [{'Key': key} for key in page]}, keys[start:start + 1000])
+
+class FakeS3(Backend):
+    service = 's3'
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self.objects = {}
+        self.uploads = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        data = Body.encode() if isinstance(Body, str) else bytes(Body)
+        return self.call('PutObject', self._put_object, Bucket, Key, data)
+
+    def _put_object(self, Bucket, Key, data):
+        self.objects[(Bucket, Key)] = data
+        return {}
+
+    def get_object(self, Bucket, Key, Range=None, **kwargs):
+        return self.call('GetObject', self._get_object, Bucket, Key, Range)
+
+    def _get_object(self, Bucket, Key, Range):
+        if (Bucket, Key) not in self.objects:
+            raise client_error('NoSuchKey', 'GetObject')
+        data = self.objects[(Bucket, Key)]
+        if Range:
+            start, end = Range[len('bytes='):].split('-')
+            # bytes=-N is the last N bytes
+            data = data[-int(end):] if not start else data[int(start):int(end) + 1]
+        return {'Body': FakeBody(data), 'ContentLength': len(data)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        return self.call('CreateMultipartUpload', self._create_multipart_upload, Bucket, Key)
+
+    def _create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        return self.call('UploadPart', self._upload_part, UploadId, PartNumber, bytes(Body))
+
+    def _upload_part(self, upload_id, part_number, data):
+        self.uploads[upload_id][part_number] = data
+        return {'ETag': f'"{upload_id}-{part_number}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload, **kwargs):
+        return self.call('CompleteMultipartUpload', self._complete_multipart_upload, Bucket, Key, UploadId, MultipartUpload)
+
+    def _complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+        return {}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId, **kwargs):
+        return self.call('AbortMultipartUpload', self.uploads.pop, UploadId, None)
+
+    def upload_file(self, Filename, Bucket, Key, **kwargs):
+        with open(Filename, 'rb') as handle:
+            return self.put_object(Bucket=Bucket, Key=Key, Body=handle.read())
+
+    def delete_objects(self, Bucket, Delete, **kwargs):
+        return self.call('DeleteObjects', self._delete_objects, Bucket, Delete)
+
+    def _delete_objects(self, Bucket, Delete):
+        for entry in Delete['Objects']:
+            self.objects.pop((Bucket, entry['Key']), None)
+        return {}
+
+    def get_paginator(self, name):
+        return FakePaginator(self)
+
+# Redis
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+        # After WATCH, commands run right away until MULTI, like redis-py
+        self.watched = None
+        self.immediate = False
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, f"_{name}")
+        if self.immediate:
+            return lambda *args, **kwargs: self.redis.call(name.upper(), method, *args, **kwargs)
+
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def watch(self, *keys):
+        self.watched = self.redis.call('WATCH', self.redis.snapshot, keys)
+        self.immediate = True
+
+    def multi(self):
+        self.immediate = False
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        watched, self.watched, self.immediate = self.watched, None, False
+
+        def run():
+            if watched is not None and self.redis.snapshot(watched) != watched:
+                raise WatchError("Watched variable changed.")
+            return [method(*args, **kwargs) for method, args, kwargs in commands]
+        return self.redis.call('PIPELINE', run)
+
+class FakePubSub:
+    def __init__(self, redis):
+        self.redis = redis
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, *channels):
+        self.redis.call('SUBSCRIBE', self.redis.add_subscriber, self, channels)
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            return self.messages.get(timeout=timeout) if timeout else self.messages.get_nowait()
+        except queue.Empty:
+            return None
+
+    def close(self):
+        with self.redis.lock:
+            for channel in self.channels:
+                self.redis.subscribers[channel].discard(self)
+        self.channels = set()
+
+class FakeRedis(Backend):
+    # Strings, lists and sets with expiry, the subset of commands the app uses (decode_responses=True)
+    service = 'redis'
+
+    def __init__(self, latency_ms=0):
+        super().__init__(latency_ms)
+        self.data = {}
+        self.expires = {}
+        self.subscribers = defaultdict(set)
+
+    def __getattr__(self, name):
+        method = getattr(type(self), f"_{name}", None)
+        if method is None:
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name.upper(), method, self, *args, **kwargs)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return FakePipeline(self)
+
+    def transaction(self, func, *watches, **kwargs):
+        # Retries func until no watched key changed before EXEC, like redis-py
+        while True:
+            pipe = self.pipeline()
+            try:
+                pipe.watch(*watches)
+                func(pipe)
+                return pipe.execute()
+            except WatchError:
+                continue
+
+    def snapshot(self, keys):
+        return {key: copy.deepcopy(self.get_value(key)) for key in keys}
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        return FakePubSub(self)
+
+    def add_subscriber(self, pubsub, channels):
+        for channel in channels:
+            self.subscribers[channel].add(pubsub)
+            pubsub.channels.add(channel)
+            pubsub.messages.put({'type': 'subscribe', 'channel': channel, 'data': len(pubsub.channels)})
+
+    def get_value(self, key, default=None):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key, default)
+
+    def _exists(self, *keys):
+        return sum(1 for key in keys if self.get_value(key) is not None)
+
+    def _delete(self, *keys):
+        deleted = self._exists(*keys)
+        for key in keys:
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return deleted
+
+    def _expire(self, key, seconds):
+        if self.get_value(key) is None:
+            return False
+        self.expires[key] = time.monotonic() + seconds
+        return True
+
+    def _get(self, key):
+        return self.get_value(key)
+
+    def _set(self, key, value, ex=None, nx=False, **kwargs):
+        if nx and self.get_value(key) is not None:
+            return None
+        self.data[key] = str(value)
+        self.expires.pop(key, None)
+        if ex:
+            self._expire(key, ex)
+        return True
+
+    def _incr(self, key, amount=1):
+        value = int(self.get_value(key, 0)) + amount
+        self.data[key] = str(value)
+        return value
+
+    def _rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(str(value) for value in values)
+        return len(self.data[key])
+
+    def _rpushx(self, key, *values):
+        if self.get_value(key) is None:
+            return 0
+        return self._rpush(key, *values)
+
+    def _lrange(self, key, start, end):
+        values = self.get_value(key, [])
+        return values[slice(*list_bounds(len(values), start, end))]
+
+    def _ltrim(self, key, start, end):
+        values = self.get_value(key)
+        if values is not None:
+            self.data[key] = values[slice(*list_bounds(len(values), start, end))]
+            if not self.data[key]:
+                self._delete(key)
+        return True
+
+    def _llen(self, key):
+        return len(self.get_value(key, []))
+
+    def _sadd(self, key, *members):
+        members = {str(member) for member in members}
+        current = self.data.setdefault(key, set())
+        added = len(members - current)
+        current |= members
+        return added
+
+    def _srem(self, key, *members):
+        current = self.get_value(key, set())
+        removed = len(current & {str(member) for member in members})
+        current -= {str(member) for member in members}
+        if not current:
+            self._delete(key)
+        return removed
+
+    def _sismember(self, key, member):
+        return str(member) in self.get_value(key, set())
+
+    def _smismember(self, key, members, *args):
+        current = self.get_value(key, set())
+        return [int(str(member) in current) for member in ([members] if isinstance(members, str) else members) + list(args)]
+
+    def _sscan(self, key, cursor=0, match=None, count=None):
+        # Cursor is an offset into the sorted members, enough for callers that loop until 0
+        members = sorted(self.get_value(key, set()))
+        end = cursor + (count or 10)
+        return (end if end < len(members) else 0), members[cursor:end]
+
+    def _smembers(self, key):
+        return set(self.get_value(key, set()))
+
+    def _scard(self, key):
+        return len(self.get_value(key, set()))
+
+    def _publish(self, channel, message):
+        subscribers = list(self.subscribers.get(channel, ()))
+        for pubsub in subscribers:
+            pubsub.messages.put({'type': 'message', 'channel': channel, 'data': str(message)})
+        return len(subscribers)
+
+def list_bounds(length, start, end):
+    # Redis ranges are inclusive and accept negative indexes
+    start = max(length + start, 0) if start < 0 else start
+    end = length + end if end < 0 else min(end, length - 1)
+    return start, max(end + 1, start)
+
+def install(latency_ms=None):
+    # Puts the fakes in place of the real clients and creates the tables from database.py
+    import contextlib
+    import io
+    import clients
+    import database
+    latency_ms = latency_ms or {}
+    fakes = {
+        'dynamodb': FakeDynamoDB(latency_ms.get('dynamodb', 0)),
+        's3': FakeS3(latency_ms.get('s3', 0)),
+        'redis': FakeRedis(latency_ms.get('redis', 0))
+    }
+    for name, fake in fakes.items():
+        clients.install(name, fake)
+    with contextlib.redirect_stdout(io.StringIO()):
+        database.init_db()
+    return fakes
@@ -0,0 +1,176 @@
+import argparse
+import gc
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+# The app modules import each other as top-level modules, like they do on Lambda
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), 'app'))
+os.environ.setdefault('S3_BUCKET_NAME', 'bench')
+os.environ.setdefault('METRICS_ENABLED', 'true')
+# Only used with STORAGE_BACKEND=sqlite
+os.environ.setdefault('SQLITE_PATH', os.path.join(tempfile.mkdtemp(prefix='bench'), 'chat.db'))
+
+import fakes
+import metrics
+from config import config
+
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+BACKENDS = ('dynamodb', 'redis', 's3')
+
+def percentile(ordered, p):
+    return round(metrics.percentile(ordered, p), 3)
+
+def run_workload(name, requests, seed, latency_ms):
+    # Fresh fakes (and a fresh SQLite file) per workload, so one workload's data never shapes another's numbers
+    fakes.install(latency_ms)
+    if config.STORAGE_BACKEND == 'sqlite':
+        import crud_sqlite
+        crud_sqlite.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(config.SQLITE_PATH + suffix):
+                os.remove(config.SQLITE_PATH + suffix)
+    import lambda_function
+    from workloads import Workload
+    logging.getLogger().setLevel(logging.WARNING)
+
+    workload = Workload(name, seed)
+    workload.seed()
+    # Keep the seeded data out of later collections, so a full GC pass doesn't land on one timed request
+    gc.collect()
+    gc.freeze()
+    records = []
+    metrics.listeners.append(records.append)
+    results = defaultdict(lambda: {"latencies": [], "errors": 0, "calls": defaultdict(int)})
+    events = workload.events(requests)
+    response = None
+    started = time.perf_counter()
+    try:
+        while True:
+            try:
+                operation, event = events.send(response)
+            except StopIteration:
+                break
+            start = time.perf_counter()
+            response = lambda_function.lambda_handler(event, None)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            result = results[operation]
+            result["latencies"].append(elapsed_ms)
+            if response['statusCode'] >= 500:
+                result["errors"] += 1
+            for call, stats in records[-1]["calls"].items():
+                backend = call.split('.', 1)[0]
+                if backend in BACKENDS:
+                    result["calls"][backend] += stats["count"]
+    finally:
+        metrics.listeners.remove(records.append)
+        gc.unfreeze()
+    wall = time.perf_counter() - started
+    return summarize(results, wall)
+
+def summarize(results, wall):
+    report = {"requests": 0, "wall_s": round(wall, 3), "operations": {}}
+    for operation, result in sorted(results.items()):
+        latencies = sorted(result["latencies"])
+        count = len(latencies)
+        calls = {backend: round(result["calls"][backend] / count, 2) for backend in BACKENDS}
+        report["requests"] += count
+        report["operations"][operation] = {
+            "requests": count,
+            "errors": result["errors"],
+            "throughput_rps": round(count / (sum(latencies) / 1000), 1) if sum(latencies) else None,
+            "p50_ms": percentile(latencies, 50),
+            "p90_ms": percentile(latencies, 90),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": round(latencies[-1], 3),
+            "calls_per_request": dict(calls, total=round(sum(calls.values()), 2))
+        }
+    report["throughput_rps"] = round(report["requests"] / wall, 1) if wall else None
+    return report
+
+def print_report(name, report):
+    print(f"\n{name}: {report['requests']} requests in {report['wall_s']}s ({report['throughput_rps']} req/s)")
+    header = f"{'operation':<28}{'reqs':>6}{'err':>5}{'req/s':>10}{'p50 ms':>9}{'p90 ms':>9}{'p99 ms':>9}{'ddb':>7}{'redis':>7}{'s3':>6}"
+    print(header)
+    print("-" * len(header))
+    for operation, stats in report["operations"].items():
+        calls = stats["calls_per_request"]
+        print(
+            f"{operation:<28}{stats['requests']:>6}{stats['errors']:>5}{stats['throughput_rps'] or 0:>10}"
+            f"{stats['p50_ms']:>9}{stats['p90_ms']:>9}{stats['p99_ms']:>9}"
+            f"{calls['dynamodb']:>7}{calls['redis']:>7}{calls['s3']:>6}"
+        )
+
+def compare(reports, baseline, calls_tolerance, latency_tolerance):
+    # Backend calls are deterministic for a seed and compared tightly, latency only loosely
+    # (and not at all with latency_tolerance < 0) since it depends on the machine
+    regressions = []
+    for name, report in reports.items():
+        for operation, stats in report["operations"].items():
+            expected = baseline.get(name, {}).get("operations", {}).get(operation)
+            if not expected:
+                continue
+            calls, expected_calls = stats["calls_per_request"]["total"], expected["calls_per_request"]["total"]
+            if calls > expected_calls * (1 + calls_tolerance) + 0.01:
+                regressions.append(f"{name}/{operation}: {calls} backend calls per request, baseline {expected_calls}")
+            if stats["errors"] > expected.get("errors", 0):
+                regressions.append(f"{name}/{operation}: {stats['errors']} errors, baseline {expected.get('errors', 0)}")
+            if latency_tolerance >= 0 and stats["p99_ms"] > expected["p99_ms"] * (1 + latency_tolerance):
+                regressions.append(f"{name}/{operation}: p99 {stats['p99_ms']} ms, baseline {expected['p99_ms']} ms")
+    return regressions
+
+def parse_latency(value):
+    # "dynamodb=4,redis=0.5,s3=15" -> simulated round trip per call in ms
+    latency = {}
+    for part in filter(None, value.split(',')):
+        backend, ms = part.split('=')
+        latency[backend.strip()] = float(ms)
+    return latency
+
+if __name__ == "__main__":
+    from workloads import WORKLOADS
+    parser = argparse.ArgumentParser(description="Benchmark lambda_handler against in-process DynamoDB, Redis and S3 fakes")
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS), help=f"any of {', '.join(WORKLOADS)} (default all)")
+    parser.add_argument("--requests", type=int, default=2000, help="requests per workload")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=parse_latency, default={}, help="simulated backend latency, e.g. dynamodb=4,redis=0.5,s3=15")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="store this run as the baseline")
+    parser.add_argument("--calls-tolerance", type=float, default=0.1, help="allowed relative increase of backend calls per request")
+    parser.add_argument("--latency-tolerance", type=float, default=1.0, help="allowed relative increase of p99, negative to skip")
+    args = parser.parse_args()
+
+    reports = {}
+    for name in args.workloads:
+        # Each engine keeps its own baseline entries
+        key = name if config.STORAGE_BACKEND == 'dynamodb' else f"{config.STORAGE_BACKEND}:{name}"
+        reports[key] = run_workload(name, args.requests, args.seed, args.latency)
+        print_report(key, reports[key])
+    if args.json:
+        with open(args.json, 'w') as handle:
+            json.dump(reports, handle, indent=2)
+    if args.update_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as handle:
+                baseline = json.load(handle)
+        baseline.update(reports)
+        with open(args.baseline, 'w') as handle:
+            json.dump(baseline, handle, indent=2, sort_keys=True)
+            handle.write("\n")
+        print(f"\nBaseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as handle:
+            regressions = compare(reports, json.load(handle), args.calls_tolerance, args.latency_tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            raise SystemExit(1)
+        print("\nNo regressions against the baseline")
@@ -0,0 +1,243 @@
+import json
+import random
+from bisect import bisect_left
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+from uuid import uuid4
+from config import config
+import storage as crud
+
+# Each workload seeds the storage engine straight through its crud functions (not measured), then yields
+# (operation, event) pairs for the harness to send through lambda_handler.
+
+WORKLOADS = {
+    # Day to day traffic: a few chatty users, mostly 1:1 with some small groups
+    "mixed": {
+        "users": 500,
+        "zipf": 1.1,
+        "small_groups": 40,
+        "small_group_size": (3, 20),
+        "large_groups": 0,
+        "deep_chats": 0,
+        "mix": {
+            "send_message": 53,
+            "send_messages": 2,
+            "send_message_to_group": 10,
+            "get_messages:inbox": 7,
+            "get_messages:chat": 12,
+            "sync": 4,
+            "get_inbox": 3,
+            "mark_read": 1,
+            "add_user_to_group": 3,
+            "create_group": 2,
+            "block_user": 2,
+            "register": 1
+        }
+    },
+    # Groups above GROUP_FANOUT_THRESHOLD, stored once and merged into their members' inboxes
+    "large_groups": {
+        "users": 3000,
+        "zipf": 1.0,
+        "small_groups": 20,
+        "small_group_size": (3, 20),
+        "large_groups": 6,
+        "large_group_size": (150, 1500),
+        "deep_chats": 0,
+        "mix": {
+            "send_message_to_group": 45,
+            "get_messages:inbox": 20,
+            "get_inbox": 10,
+            "sync": 10,
+            "send_message": 15
+        }
+    },
+    # Hot conversations sitting just below DB_LIMIT, so sends archive and reads page into S3
+    "deep_history": {
+        "users": 200,
+        "zipf": 1.3,
+        "small_groups": 0,
+        "large_groups": 0,
+        "deep_chats": 20,
+        "deep_chat_messages": config.DB_LIMIT - 5,
+        "mix": {
+            "send_message:deep": 40,
+            "get_messages:chat_pages": 40,
+            "get_messages:inbox": 20
+        }
+    }
+}
+
+class Zipf:
+    # Rank r is drawn with probability proportional to 1 / r^s
+    def __init__(self, population, s, rng):
+        self.population = population
+        self.cumulative = list(accumulate(1 / rank ** s for rank in range(1, len(population) + 1)))
+        self.rng = rng
+
+    def sample(self):
+        position = bisect_left(self.cumulative, self.rng.random() * self.cumulative[-1])
+        return self.population[min(position, len(self.population) - 1)]
+
+def api_event(method, path, body=None, params=None):
+    event = {'httpMethod': method, 'path': path, 'headers': {}, 'isBase64Encoded': False}
+    if body is not None:
+        event['body'] = json.dumps(body)
+    if params is not None:
+        event['queryStringParameters'] = params
+    return event
+
+def seed_users(count):
+    users = []
+    for index in range(count):
+        user_id = str(uuid4())
+        email = f"user{index}@bench.local"
+        crud.reserve_email(email, user_id)
+        crud.create_user({'user_id': user_id, 'email': email, 'password': 'bench'})
+        users.append(user_id)
+    return users
+
+def seed_group(members, name):
+    group_id = str(uuid4())
+    crud.create_group({'group_id': group_id, 'name': name})
+    for user_id in members:
+        crud.add_user_to_group({'group_id': group_id, 'user_id': user_id})
+    return group_id
+
+def seed_chat(sender_id, receiver_id, count, start):
+    # Old enough to be past the recent-messages cache and inside the archive window
+    for index in range(count):
+        timestamp = (start + timedelta(seconds=index)).isoformat()
+        message = crud.prepare_message({
+            'message_id': str(uuid4()),
+            'sender_id': sender_id if index % 2 else receiver_id,
+            'receiver_id': receiver_id if index % 2 else sender_id,
+            'content': f"history {index}",
+            'timestamp': timestamp
+        })
+        crud.create_message(message)
+        crud.record_chat_message(message['chat_id'], message['message_id'], timestamp)
+
+class Workload:
+    def __init__(self, name, seed=1):
+        self.name = name
+        self.spec = WORKLOADS[name]
+        self.rng = random.Random(seed)
+        self.registered = 0
+        self.sync_cursors = {}
+
+    def seed(self):
+        spec, rng = self.spec, self.rng
+        self.users = seed_users(spec["users"])
+        self.zipf = Zipf(self.users, spec["zipf"], rng)
+        self.groups = {}
+        for index in range(spec["small_groups"]):
+            members = rng.sample(self.users, rng.randint(*spec["small_group_size"]))
+            self.groups[seed_group(members, f"small {index}")] = members
+        for index in range(spec["large_groups"]):
+            size = min(rng.randint(*spec["large_group_size"]), len(self.users))
+            members = rng.sample(self.users, size)
+            self.groups[seed_group(members, f"large {index}")] = members
+        self.deep_pairs = []
+        start = datetime.now(timezone.utc) - timedelta(days=2)
+        for _ in range(spec["deep_chats"]):
+            sender_id, receiver_id = rng.sample(self.users, 2)
+            seed_chat(sender_id, receiver_id, spec["deep_chat_messages"], start)
+            self.deep_pairs.append((sender_id, receiver_id))
+        self.operations = list(spec["mix"])
+        self.weights = list(accumulate(spec["mix"].values()))
+
+    def pair(self):
+        sender_id = self.zipf.sample()
+        receiver_id = self.zipf.sample()
+        while receiver_id == sender_id:
+            receiver_id = self.rng.choice(self.users)
+        return sender_id, receiver_id
+
+    def events(self, requests):
+        for _ in range(requests):
+            operation = self.rng.choices(self.operations, cum_weights=self.weights)[0]
+            yield from getattr(self, operation.replace(':', '_'))(operation)
+
+    # Operations, each yields one or more (operation, event)
+
+    def send_message(self, operation):
+        sender_id, receiver_id = self.pair()
+        yield operation, api_event('POST', '/send_message', {
+            'sender_id': sender_id, 'receiver_id': receiver_id, 'content': "x" * self.rng.randint(10, 400)
+        })
+
+    def send_messages(self, operation):
+        # A bridge flushing a batch, spread over a handful of conversations
+        pairs = [self.pair() for _ in range(self.rng.randint(1, 8))]
+        yield operation, api_event('POST', '/send_messages', {'messages': [
+            dict(zip(('sender_id', 'receiver_id'), self.rng.choice(pairs)), content="x" * self.rng.randint(10, 400))
+            for _ in range(self.rng.randint(10, 100))
+        ]})
+
+    def send_message_deep(self, operation):
+        sender_id, receiver_id = self.rng.choice(self.deep_pairs)
+        yield operation, api_event('POST', '/send_message', {
+            'sender_id': sender_id, 'receiver_id': receiver_id, 'content': "deep"
+        })
+
+    def send_message_to_group(self, operation):
+        group_id = self.rng.choice(list(self.groups))
+        yield operation, api_event('POST', '/send_message_to_group', {
+            'group_id': group_id, 'sender_id': self.rng.choice(self.groups[group_id]), 'content': "to the group"
+        })
+
+    def get_messages_inbox(self, operation):
+        yield operation, api_event('GET', '/get_messages', params={'user_id': self.zipf.sample(), 'limit': '50'})
+
+    def get_messages_chat(self, operation):
+        user_id, chat_id = self.pair()
+        yield operation, api_event('GET', '/get_messages', params={'user_id': user_id, 'chat_id': chat_id, 'limit': '50'})
+
+    def get_messages_chat_pages(self, operation):
+        # Scrolls back through a deep history, the harness feeds each next_cursor into the next page
+        user_id, chat_id = self.rng.choice(self.deep_pairs)
+        params = {'user_id': user_id, 'chat_id': chat_id, 'limit': '100'}
+        for _ in range(self.rng.randint(1, 12)):
+            response = yield operation, api_event('GET', '/get_messages', params=dict(params))
+            cursor = response and json.loads(response['body']).get('next_cursor')
+            if not cursor:
+                return
+            params['cursor'] = cursor
+
+    def sync(self, operation):
+        # A client catching up from where its previous sync stopped
+        user_id = self.zipf.sample()
+        params = {'user_id': user_id}
+        if user_id in self.sync_cursors:
+            params['cursor'] = self.sync_cursors[user_id]
+        response = yield operation, api_event('GET', '/sync', params=params)
+        if response and response['statusCode'] == 200:
+            self.sync_cursors[user_id] = json.loads(response['body'])['cursor']
+
+    def get_inbox(self, operation):
+        yield operation, api_event('GET', '/get_inbox', params={'user_id': self.zipf.sample(), 'limit': '50'})
+
+    def mark_read(self, operation):
+        # Opens the newest conversation of the inbox, if there is one
+        user_id = self.zipf.sample()
+        response = yield operation, api_event('GET', '/get_inbox', params={'user_id': user_id, 'limit': '1'})
+        conversations = response and json.loads(response['body']).get('conversations')
+        if conversations:
+            yield operation, api_event('POST', '/mark_read', {'user_id': user_id, 'chat_id': conversations[0]['chat_id']})
+
+    def add_user_to_group(self, operation):
+        group_id = self.rng.choice(list(self.groups))
+        user_id = self.zipf.sample()
+        self.groups[group_id].append(user_id)
+        yield operation, api_event('POST', '/add_user_to_group', {'group_id': group_id, 'user_id': user_id})
+
+    def create_group(self, operation):
+        yield operation, api_event('POST', '/create_group', {'name': "new group", 'creator_id': self.zipf.sample()})
+
+    def block_user(self, operation):
+        blocker_id, blocked_id = self.pair()
+        yield operation, api_event('POST', '/block_user', {'blocker_id': blocker_id, 'blocked_id': blocked_id})
+
+    def register(self, operation):
+        self.registered += 1
+        yield operation, api_event('POST', '/register', {'email': f"new{self.registered}@bench.local", 'password': "bench"})
@@ -0,0 +1,18 @@
+# Daily, once the previous UTC day's hourly archives are all written
+resource "aws_cloudwatch_event_rule" "compaction_schedule" {
+  name                = "compaction-schedule"
+  schedule_expression = "cron(30 1 * * ? *)"
+}
+
+resource "aws_cloudwatch_event_target" "compaction_target" {
+  rule = aws_cloudwatch_event_rule.compaction_schedule.name
+  arn  = aws_lambda_function.compaction_lambda.arn
+}
+
+resource "aws_lambda_permission" "allow_cloudwatch_to_call_compaction_lambda" {
+  statement_id  = "AllowExecutionFromCloudWatch"
+  action        = "lambda:InvokeFunction"
+  function_name = aws_lambda_function.compaction_lambda.function_name
+  principal     = "events.amazonaws.com"
+  source_arn    = aws_cloudwatch_event_rule.compaction_schedule.arn
+}
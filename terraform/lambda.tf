@@ -84,6 +84,8 @@ resource "aws_lambda_function" "messaging_system_lambda" {
   role             = aws_iam_role.lambda_exec_role.arn
   handler          = "lambda_function.lambda_handler"
   runtime          = "python3.9"
+  # Above SYNC_MAX_WAIT_S plus the reads around a /sync long-poll
+  timeout          = 30
   source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   layers = [
     aws_lambda_layer_version.my_layer.arn
@@ -99,6 +101,7 @@ resource "aws_lambda_function" "messaging_system_lambda" {
       DB_LAST_Y_MESSAGES      = "50"
       S3_RETENTION_DAYS       = "365"
       DB_LIMIT                = "1000"
+      SYNC_MAX_WAIT_S         = "20"
     }
   }
 }
@@ -118,15 +121,45 @@ resource "aws_lambda_function" "backup_lambda" {
   role             = aws_iam_role.lambda_exec_role.arn
   handler          = "backup_lambda_function.lambda_handler"
   runtime          = "python3.9"
+  timeout          = 900
   source_code_hash = data.archive_file.lambda_zip.output_base64sha256
   layers = [
     aws_lambda_layer_version.my_layer.arn
   ]
   environment {
     variables = {
-      S3_BUCKET_NAME      = aws_s3_bucket.cold_storage.bucket
-      DB_RETENTION_HOURS  = "24"
-      S3_RETENTION_DAYS   = "365"
+      S3_BUCKET_NAME          = aws_s3_bucket.cold_storage.bucket
+      REDIS_HOST              = aws_elasticache_cluster.redis.cache_nodes[0].address
+      REDIS_PORT              = aws_elasticache_cluster.redis.port
+      DYNAMODB_ENDPOINT_URL   = "https://dynamodb.${var.aws_region}.amazonaws.com"
+      S3_ENDPOINT_URL         = "https://s3.${var.aws_region}.amazonaws.com"
+      DB_RETENTION_HOURS      = "24"
+      S3_RETENTION_DAYS       = "365"
+    }
+  }
+}
+
+resource "aws_lambda_function" "compaction_lambda" {
+  filename         = data.archive_file.lambda_zip.output_path
+  function_name    = "compaction_lambda"
+  role             = aws_iam_role.lambda_exec_role.arn
+  handler          = "compaction.lambda_handler"
+  runtime          = "python3.9"
+  # A run stops COMPACTION_TIME_MARGIN_MS before this and the next one picks up the rest
+  timeout          = 900
+  # Holds a segment (up to SEGMENT_MAX_BYTES) and the day's messages it is built from
+  memory_size      = 1024
+  source_code_hash = data.archive_file.lambda_zip.output_base64sha256
+  layers = [
+    aws_lambda_layer_version.my_layer.arn
+  ]
+  environment {
+    variables = {
+      S3_BUCKET_NAME            = aws_s3_bucket.cold_storage.bucket
+      DYNAMODB_ENDPOINT_URL     = "https://dynamodb.${var.aws_region}.amazonaws.com"
+      S3_ENDPOINT_URL           = "https://s3.${var.aws_region}.amazonaws.com"
+      COMPACTION_LOOKBACK_DAYS  = "7"
+      COMPACTION_TIME_MARGIN_MS = "60000"
     }
   }
 }
@@ -9,6 +9,64 @@ resource "aws_dynamodb_table" "users" {
   }
 }
 
+resource "aws_dynamodb_table" "user_emails" {
+  name           = "user_emails"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "email"
+
+  attribute {
+    name = "email"
+    type = "S"
+  }
+}
+
+resource "aws_dynamodb_table" "chat_messages" {
+  name           = "chat_messages"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "chat_id"
+  range_key      = "sort_key"
+
+  attribute {
+    name = "chat_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "sort_key"
+    type = "S"
+  }
+
+  attribute {
+    name = "sender_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "receiver_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "timestamp"
+    type = "S"
+  }
+
+  global_secondary_index {
+    name            = "receiver_id-index"
+    hash_key        = "receiver_id"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
+
+  global_secondary_index {
+    name            = "sender_id-index"
+    hash_key        = "sender_id"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
+}
+
+# Legacy message_id keyed table, source of migrate_messages. Remove once migrated.
 resource "aws_dynamodb_table" "messages" {
   name           = "messages"
   billing_mode   = "PAY_PER_REQUEST"
@@ -24,6 +82,16 @@ resource "aws_dynamodb_table" "messages" {
     type = "S"
   }
 
+  attribute {
+    name = "receiver_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "timestamp"
+    type = "S"
+  }
+
   global_secondary_index {
     name            = "sender_id-index"
     hash_key        = "sender_id"
@@ -31,6 +99,13 @@ resource "aws_dynamodb_table" "messages" {
     read_capacity   = 5
     write_capacity  = 5
   }
+
+  global_secondary_index {
+    name            = "receiver_id-index"
+    hash_key        = "receiver_id"
+    range_key       = "timestamp"
+    projection_type = "ALL"
+  }
 }
 
 resource "aws_dynamodb_table" "chat_metadata" {
@@ -42,6 +117,18 @@ resource "aws_dynamodb_table" "chat_metadata" {
     name = "chat_id"
     type = "S"
   }
+
+  attribute {
+    name = "dirty_shard"
+    type = "N"
+  }
+
+  # Sparse: only chats with messages not yet backed up carry dirty_shard
+  global_secondary_index {
+    name            = "dirty_shard-index"
+    hash_key        = "dirty_shard"
+    projection_type = "ALL"
+  }
 }
 
 resource "aws_dynamodb_table" "group_members" {
@@ -59,6 +146,29 @@ resource "aws_dynamodb_table" "group_members" {
     name = "user_id"
     type = "S"
   }
+
+  global_secondary_index {
+    name            = "user_id-index"
+    hash_key        = "user_id"
+    projection_type = "ALL"
+  }
+}
+
+resource "aws_dynamodb_table" "group_timeline" {
+  name           = "group_timeline"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "group_id"
+  range_key      = "sort_key"
+
+  attribute {
+    name = "group_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "sort_key"
+    type = "S"
+  }
 }
 
 resource "aws_dynamodb_table" "groups" {
@@ -83,6 +193,88 @@ resource "aws_dynamodb_table" "blocks" {
   }
 }
 
+resource "aws_dynamodb_table" "user_blocks" {
+  name           = "user_blocks"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "blocker_id"
+  range_key      = "blocked_id"
+
+  attribute {
+    name = "blocker_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "blocked_id"
+    type = "S"
+  }
+}
+
+resource "aws_dynamodb_table" "archive_manifest" {
+  name           = "archive_manifest"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "chat_id"
+  range_key      = "start_sort_key"
+
+  attribute {
+    name = "chat_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "start_sort_key"
+    type = "S"
+  }
+}
+
+# User/day prefixes of archive objects waiting for compaction, keyed "<year>/<day of year>"
+resource "aws_dynamodb_table" "archive_days" {
+  name           = "archive_days"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "day"
+  range_key      = "user_id"
+
+  attribute {
+    name = "day"
+    type = "S"
+  }
+
+  attribute {
+    name = "user_id"
+    type = "S"
+  }
+}
+
+resource "aws_dynamodb_table" "user_inbox" {
+  name           = "user_inbox"
+  billing_mode   = "PAY_PER_REQUEST"
+  hash_key       = "user_id"
+  range_key      = "chat_id"
+
+  attribute {
+    name = "user_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "chat_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "last_sort_key"
+    type = "S"
+  }
+
+  # A user's conversations by their latest message, for /get_inbox
+  global_secondary_index {
+    name            = "user_id-last_sort_key-index"
+    hash_key        = "user_id"
+    range_key       = "last_sort_key"
+    projection_type = "ALL"
+  }
+}
+
 resource "aws_s3_bucket" "cold_storage" {
   bucket = "messaging-system-cold-storage"
 }
@@ -9,7 +9,14 @@ output "dynamodb_tables" {
     aws_dynamodb_table.chat_metadata.name,
     aws_dynamodb_table.group_members.name,
     aws_dynamodb_table.groups.name,
-    aws_dynamodb_table.blocks.name
+    aws_dynamodb_table.blocks.name,
+    aws_dynamodb_table.user_emails.name,
+    aws_dynamodb_table.user_blocks.name,
+    aws_dynamodb_table.group_timeline.name,
+    aws_dynamodb_table.chat_messages.name,
+    aws_dynamodb_table.archive_manifest.name,
+    aws_dynamodb_table.archive_days.name,
+    aws_dynamodb_table.user_inbox.name
   ]
 }
 